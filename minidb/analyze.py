@@ -0,0 +1,195 @@
+# analyze.py
+# 2013 Kyle Miller
+# runs a query with each step of it measured, like EXPLAIN ANALYZE
+
+import copy
+import gc
+import time
+
+from queries import (Query, Value, Func, ValueFunc, Bind, Return, Require, Take, OrderBy, GroupBy,
+                     Get, Apply, Constant, Var, Op, Do, Fuel)
+
+# The query is not changed: each Query and Value in a copy of it is
+# given its own compile_query or compile_value, which wraps what the
+# original one compiles.  Queries which are not being analyzed run
+# exactly as before.  A Require or Return is measured through its
+# value, since a Bind of one of them (a filter or a 'let') only
+# compiles the value.
+#
+# Times, fuel and allocations are inclusive, so a step counts what its
+# parts did too.  Allocations are the net number of objects the
+# garbage collector tracks (dictionaries, lists, tuples, ...) which
+# were made, and the collector is off while the query runs so that
+# they can be counted.
+
+class Stats(object) :
+    """What one step of a query did: 'loops' is how many times it was
+    run (for a filter or a value, how many rows were given to it),
+    'rows' is how many results it gave, and 'time', 'fuel' and
+    'allocs' are what was spent doing so."""
+    def __init__(self, node) :
+        self.node = node
+        self.children = []
+        self.loops = 0
+        self.rows = 0
+        self.time = 0.0
+        self.fuel = 0
+        self.allocs = 0
+    def enter(self, fuel) :
+        return (time.time(), fuel.amount, gc.get_count()[0])
+    def leave(self, fuel, start) :
+        t, amount, count = start
+        self.time += time.time() - t
+        self.fuel += amount - fuel.amount
+        self.allocs += gc.get_count()[0] - count
+    def lines(self, depth) :
+        lines = ["%s%s  (loops=%d rows=%d time=%.3fms fuel=%d allocs=%d)"
+                 % ("  " * depth, describe(self.node), self.loops, self.rows,
+                    self.time * 1000, self.fuel, self.allocs)]
+        for c in self.children :
+            lines.extend(c.lines(depth + 1))
+        return lines
+
+class Analysis(object) :
+    """The results of a query function, and the Stats of each step of
+    it, whose str is the query as a tree annotated with the Stats."""
+    def __init__(self, queryfunc, results, stats, elapsed, fuel) :
+        self.queryfunc = queryfunc
+        self.results = results
+        self.stats = stats
+        self.elapsed = elapsed
+        self.fuel = fuel
+    def __str__(self) :
+        lines = ["given %s :  (rows=%d time=%.3fms fuel=%d)"
+                 % (self.queryfunc.var, len(self.results), self.elapsed * 1000, self.fuel)]
+        for s in self.stats :
+            lines.extend(s.lines(1))
+        return "\n".join(lines)
+
+def analyze(data, queryfunc, fuel=None) :
+    """Runs the query function on 'data' like queries.select, and
+    returns an Analysis of what each step did."""
+    fuel = fuel or Fuel()
+    stats = []
+    instrumented = instrument(queryfunc, stats)
+    enabled = gc.isenabled()
+    gc.disable()
+    try :
+        amount = fuel.amount
+        start = time.time()
+        results = [v for p, v in instrumented.compile(paths=False)(fuel, data)]
+        elapsed = time.time() - start
+    finally :
+        if enabled :
+            gc.enable()
+    return Analysis(queryfunc, results, stats, elapsed, amount - fuel.amount)
+
+def instrument(node, stats) :
+    """Returns a copy of a query, value or function in which each
+    Query and Value (except variables and constants) records what it
+    does in a new Stats, which is appended to 'stats'."""
+    if isinstance(node, Do) :
+        node.buildQuery()
+        return instrument(node.query, stats)
+    if isinstance(node, (list, tuple)) :
+        return type(node)(instrument(n, stats) for n in node)
+    if not isinstance(node, (Query, Value, Func, ValueFunc)) :
+        return node
+    node = copy.copy(node)
+    if isinstance(node, Func) :
+        node.compiled = {}
+    measured = not isinstance(node, (Func, ValueFunc, Var, Constant))
+    if measured :
+        s = Stats(node)
+        stats.append(s)
+        stats = s.children
+    for attr in children(node) :
+        setattr(node, attr, instrument(getattr(node, attr), stats))
+    if isinstance(node, (Require, Return)) :
+        compile_test = node.value.compile_value
+        test = isinstance(node, Require)
+        node.value.compile_value = lambda scope : measure_value(s, compile_test(scope), test)
+    elif measured :
+        if isinstance(node, Query) :
+            compile_query = node.compile_query
+            node.compile_query = lambda scope : measure_query(s, compile_query(scope))
+        if isinstance(node, Value) :
+            compile_value = node.compile_value
+            node.compile_value = lambda scope : measure_value(s, compile_value(scope))
+    return node
+
+# the attributes which may hold the parts of a step, in the order they
+# are shown
+order = ["source", "query", "left", "right", "low", "high", "value", "params", "queries", "tests",
+         "key", "lkey", "rkey", "default", "func", "body"]
+
+def children(node) :
+    attrs = vars(node)
+    return ([a for a in order if a in attrs]
+            + sorted(a for a in attrs if a not in order and is_part(attrs[a])))
+
+def is_part(o) :
+    if isinstance(o, (list, tuple)) :
+        return any(is_part(p) for p in o)
+    return isinstance(o, (Query, Value, Func, ValueFunc))
+
+def measure_query(stats, compiled) :
+    def _measured(fuel, frame) :
+        stats.loops += 1
+        start = stats.enter(fuel)
+        try :
+            results = iter(compiled(fuel, frame))
+        finally :
+            stats.leave(fuel, start)
+        while True :
+            start = stats.enter(fuel)
+            try :
+                r = next(results)
+            except StopIteration :
+                stats.leave(fuel, start)
+                return
+            except :
+                stats.leave(fuel, start)
+                raise
+            stats.leave(fuel, start)
+            stats.rows += 1
+            yield r
+    return _measured
+
+def measure_value(stats, compiled, test=False) :
+    """If 'test', only the values which are true count as rows."""
+    def _measured(fuel, frame) :
+        stats.loops += 1
+        start = stats.enter(fuel)
+        try :
+            r = compiled(fuel, frame)
+        finally :
+            stats.leave(fuel, start)
+        if not test or r[1] :
+            stats.rows += 1
+        return r
+    return _measured
+
+def describe(node) :
+    """Returns the name of a step, without its parts."""
+    name = type(node).__name__
+    if isinstance(node, Bind) :
+        return "%s %s" % (name, node.func.var if node.func.var is not None else "_")
+    elif isinstance(node, Apply) :
+        return "%s %s" % (name, node.func.var if node.func.var is not None else "_")
+    elif isinstance(node, Get) :
+        source = node.source.name if isinstance(node.source, Var) else ""
+        return "%s %s%s" % (name, source, "".join("[%r]" % (k,) for k in node.path))
+    elif isinstance(node, Op) :
+        return "%s %s" % (name, node.name)
+    elif isinstance(node, Take) :
+        return "%s %d" % (name, node.n)
+    elif isinstance(node, OrderBy) :
+        return name + (" descending" if node.reverse else "")
+    elif isinstance(node, GroupBy) :
+        return "%s into %s" % (name, node.aggregate.__name__.lower())
+    elif hasattr(node, "lvar") :
+        return "%s %s, %s" % (name, node.lvar, node.rvar)
+    elif hasattr(node, "index") :
+        return "%s %r" % (name, node.index)
+    return name
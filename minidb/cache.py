@@ -0,0 +1,200 @@
+# cache.py
+# 2013 Kyle Miller
+# a cache of query results for the minidb
+
+import collections
+import sys
+import threading
+
+from queries import (Func, Bind, Union, Return, Require, OrderBy, Take, GroupBy, Get, Apply,
+                     Constant, Var, AsList, AsDict, First, Exists, AnyOf, AllOf, Aggregate, Op,
+                     Or, And, Do, UseJoin)
+
+class Uncacheable(Exception) :
+    pass
+
+class Dependencies(object) :
+    """The top-level keys of the database a query looks at (in the end
+    a sorted tuple), or 'everything' if it can look anywhere."""
+    def __init__(self) :
+        self.keys = set()
+        self.everything = False
+
+def query_key(queryfunc, rootkeys=()) :
+    """Returns (key, dependencies) for the query function run on the
+    part of the database at 'rootkeys', where 'key' is the same for
+    query functions which are the same up to the names of their
+    variables, or None if the query function cannot be cached."""
+    deps = Dependencies()
+    try :
+        key = (tuple(freeze(k) for k in rootkeys),
+               structure(queryfunc.query, (queryfunc.var,), deps))
+    except Uncacheable :
+        return None, None
+    if rootkeys :
+        deps.keys = set([rootkeys[0]])
+        deps.everything = False
+    deps.keys = tuple(sorted(deps.keys))
+    return key, deps
+
+def freeze(o) :
+    """Returns a hashable version of a database value.  Types are kept
+    so that, say, 1 and 1.0 are different."""
+    t = type(o)
+    if t is list :
+        return ("list", tuple(freeze(v) for v in o))
+    elif t is dict :
+        return ("dict", tuple(sorted((freeze(k), freeze(v)) for k, v in o.iteritems())))
+    else :
+        return (t.__name__, o)
+
+def var_index(names, name) :
+    """Returns how many binders out the variable is bound, or None if
+    it is free."""
+    for i in xrange(len(names) - 1, -1, -1) :
+        if names[i] == name :
+            return len(names) - 1 - i
+    return None
+
+def structure(node, names, deps) :
+    """Returns a hashable description of the query or value, where
+    variables are described by where they are bound.  'names' are the
+    names of the bound variables, innermost last, where the first is
+    the database.  The parts of the database which are used are added
+    to 'deps'."""
+    if isinstance(node, Do) :
+        node.buildQuery()
+        return structure(node.query, names, deps)
+    elif isinstance(node, Bind) :
+        return ("Bind", structure(node.query, names, deps), binder(node.func, names, deps))
+    elif isinstance(node, Union) :
+        return ("Union",) + tuple(structure(q, names, deps) for q in node.queries)
+    elif isinstance(node, Return) :
+        return ("Return", structure(node.value, names, deps))
+    elif isinstance(node, Require) :
+        return ("Require", structure(node.value, names, deps))
+    elif isinstance(node, OrderBy) :
+        return ("OrderBy", structure(node.query, names, deps), binder(node.key, names, deps),
+                node.reverse)
+    elif isinstance(node, Take) :
+        return ("Take", node.n, structure(node.query, names, deps))
+    elif isinstance(node, UseJoin) :
+        return ("UseJoin", node.kind, structure(node.query, names, deps))
+    elif isinstance(node, GroupBy) :
+        return ("GroupBy", binder(node.key, names, deps), structure(node.query, names, deps),
+                node.aggregate.__name__,
+                binder(node.value, names, deps) if node.value is not None else None)
+    elif isinstance(node, Get) :
+        source = node.source
+        keys = tuple(node.path)
+        if (isinstance(source, Var) and keys
+            and var_index(names, source.name) == len(names) - 1) :
+            # a part of the database
+            deps.keys.add(keys[0])
+            return ("Get", ("Var", len(names) - 1), tuple(freeze(k) for k in keys))
+        return ("Get", structure(source, names, deps), tuple(freeze(k) for k in keys))
+    elif isinstance(node, Apply) :
+        return ("Apply", structure(node.value, names, deps), binder(node.func, names, deps))
+    elif isinstance(node, Constant) :
+        return ("Constant", freeze(node.o))
+    elif isinstance(node, Var) :
+        i = var_index(names, node.name)
+        if i is None :
+            return ("Free", node.name)
+        if i == len(names) - 1 :
+            # the whole database
+            deps.everything = True
+        return ("Var", i)
+    elif isinstance(node, (AsList, AsDict, Exists, AnyOf, AllOf, Aggregate)) :
+        return (type(node).__name__, structure(node.query, names, deps))
+    elif isinstance(node, First) :
+        return ("First", structure(node.query, names, deps), structure(node.default, names, deps))
+    elif isinstance(node, Op) :
+        return ("Op", node.name) + tuple(structure(p, names, deps) for p in node.params)
+    elif isinstance(node, (Or, And)) :
+        return (type(node).__name__,) + tuple(structure(p, names, deps) for p in node.params)
+    else :
+        raise Uncacheable(node)
+
+def binder(func, names, deps) :
+    if isinstance(func, Func) :
+        body = func.query
+    else :
+        body = func.value
+    return ("Func", structure(body, names + (func.var,), deps))
+
+def approximate_size(o) :
+    """Returns roughly how many bytes the object takes, counting each
+    object inside it once."""
+    seen = set()
+    todo = [o]
+    size = 0
+    while todo :
+        o = todo.pop()
+        if id(o) in seen :
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if type(o) is dict :
+            todo.extend(o.iterkeys())
+            todo.extend(o.itervalues())
+        elif type(o) in (list, tuple) :
+            todo.extend(o)
+    return size
+
+def copied(o) :
+    """Returns a copy of 'o' which shares no dictionary or list with
+    it."""
+    t = type(o)
+    if t is dict :
+        return {k : copied(v) for k, v in o.iteritems()}
+    elif t is list :
+        return [copied(v) for v in o]
+    elif t is tuple :
+        return tuple(copied(v) for v in o)
+    return o
+
+class ResultCache(object) :
+    """A cache of the results of queries, which forgets the least
+    recently used results to keep the results it holds below about
+    'maxbytes' bytes.  Each result is stored along with a stamp, and it
+    is only returned when asked for with the same stamp.
+
+    Results are copied going in and coming out, so that each caller
+    gets results of its own, like it would without the cache."""
+    def __init__(self, maxbytes) :
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+    def get(self, key, stamp) :
+        with self.lock :
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != stamp :
+                if entry is not None :
+                    self.size -= entry[2]
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        return copied(entry[1])
+    def put(self, key, stamp, results) :
+        size = approximate_size(results)
+        if size > self.maxbytes :
+            return
+        results = copied(results)
+        with self.lock :
+            old = self.entries.pop(key, None)
+            if old is not None :
+                self.size -= old[2]
+            self.entries[key] = (stamp, results, size)
+            self.size += size
+            while self.size > self.maxbytes :
+                oldkey, (oldstamp, oldresults, oldsize) = self.entries.popitem(last=False)
+                self.size -= oldsize
+    def clear(self) :
+        with self.lock :
+            self.entries.clear()
+            self.size = 0
@@ -0,0 +1,68 @@
+# codecbench.py
+# 2013 Kyle Miller
+# compares the codecs in serialize.py on documents like a database's
+#
+# usage: python codecbench.py [number of users]
+
+import random
+import sys
+import time
+
+import serialize
+
+words = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf",
+         "hotel", "india", "juliet", "kilo", "lima", "mike", "november"]
+
+def make_user(rand, i) :
+    return {"username" : "user%d" % i,
+            "name" : "%s %s" % (rand.choice(words).title(), rand.choice(words).title()),
+            "age" : rand.randint(13, 90),
+            "score" : rand.random() * 1000,
+            "admin" : rand.random() < 0.05,
+            "email" : None if rand.random() < 0.2 else "user%d@example.com" % i,
+            "numbers" : [rand.randint(0, 100000) for j in xrange(rand.randint(0, 8))],
+            "address" : {"street" : "%d %s St" % (rand.randint(1, 9999), rand.choice(words).title()),
+                         "city" : rand.choice(words).title(),
+                         "zip" : "%05d" % rand.randint(0, 99999)},
+            "posts" : [{"id" : rand.randint(0, 10 ** 9),
+                        "title" : " ".join(rand.sample(words, 4)),
+                        "likes" : rand.randint(0, 500),
+                        "tags" : rand.sample(words, 2)}
+                       for j in xrange(rand.randint(0, 4))]}
+
+def make_database(n, seed=0) :
+    rand = random.Random(seed)
+    return {"users" : dict(("user%d" % i, make_user(rand, i)) for i in xrange(n)),
+            "meta" : {"version" : 3, "count" : n}}
+
+def best(f, repeat) :
+    """The least time, in seconds, of 'repeat' runs of f."""
+    times = []
+    for i in xrange(repeat) :
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+def bench(data, repeat=3) :
+    """Returns (name, size, encode seconds, decode seconds) for each
+    codec."""
+    json = serialize.codecs["json"]
+    expected = json.decode(json.encode(data))
+    results = []
+    for name, codec in sorted(serialize.codecs.iteritems()) :
+        s = codec.encode(data)
+        if codec.decode(s) != expected :
+            raise Exception("%s does not round trip" % name)
+        results.append((name, len(s),
+                        best(lambda : codec.encode(data), repeat),
+                        best(lambda : codec.decode(s), repeat)))
+    return results
+
+if __name__ == "__main__" :
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    data = make_database(n)
+    print "%d users" % n
+    print "%-8s %12s %10s %10s" % ("codec", "bytes", "encode", "decode")
+    for name, size, enc, dec in bench(data) :
+        print "%-8s %12d %9.3fs %9.3fs" % (name, size, enc, dec)
@@ -0,0 +1,583 @@
+# indexes.py
+# 2013 Kyle Miller
+# secondary indexes for the minidb
+
+import bisect
+
+import queries
+from queries import Path, Bind, Func, Get, Var, Require, Op, OrderBy
+from util import assert_type
+
+class Index(object) :
+    """An index over the collection (a dictionary or list) at the path
+    'collection' in the database, keyed by the value at the path
+    'field' of each entry.  Subclasses say how the keys of the entries
+    are kept by implementing 'clear', 'insert' and 'discard'.
+
+    Entries whose field is missing (or which the index cannot hold)
+    are kept aside in 'others', and lookups return them too, so that a
+    query using the index sees them just like a scan would.
+
+    Readers might be looking at another version of the collection than
+    the one the index was last brought up to date with (see
+    Database's 'mvcc' option), so the index remembers which one that
+    was in 'synced', and 'version' is odd while the index is being
+    changed."""
+    kind = None
+    def __init__(self, collection, field) :
+        self.collection = assert_type(collection, Path)
+        self.field = assert_type(field, Path)
+        self.ckeys = tuple(collection)
+        self.fkeys = tuple(field)
+        self.version = 0
+        self.synced = None
+        self.clear()
+    def clear(self) :
+        self.values = {}
+        self.others = set()
+        self.islist = False
+        self.building = False
+    def built(self) :
+        """Called once 'build' has inserted every entry, which it does
+        with 'building' set."""
+        pass
+    def insert(self, key, value) :
+        """Adds the entry 'key' whose field is 'value'.  Raises
+        TypeError if the index cannot hold the value."""
+        raise Exception("Unimplemented")
+    def discard(self, key) :
+        """Removes the entry 'key' if it is in the index."""
+        raise Exception("Unimplemented")
+    def collection_of(self, data) :
+        try :
+            for k in self.ckeys :
+                data = data[k]
+        except (KeyError, IndexError, TypeError) :
+            return None
+        return data
+    def build(self, data) :
+        """Indexes the collection from scratch."""
+        self.version += 1
+        try :
+            self.clear()
+            self.building = True
+            coll = self.collection_of(data)
+            if type(coll) is dict :
+                for k, v in coll.iteritems() :
+                    self.add(k, v)
+            elif type(coll) is list :
+                self.islist = True
+                for k, v in enumerate(coll) :
+                    self.add(k, v)
+            self.building = False
+            self.built()
+        finally :
+            self.synced = self.collection_of(data)
+            self.version += 1
+    def agreeing(self, coll, find) :
+        """Returns find() if the index agrees with the collection
+        'coll' throughout, and otherwise None."""
+        version = self.version
+        if version % 2 == 1 or coll is not self.synced :
+            return None
+        try :
+            keys = find()
+        except RuntimeError :
+            # it changed size while being looked at
+            return None
+        if self.version != version :
+            return None
+        return keys
+    def scan(self, coll, inorder=False, reverse=False) :
+        """Returns every key of the collection, which is what a lookup
+        falls back on when the index does not agree with it.  If
+        'inorder' is true, the keys are sorted by the field."""
+        if type(coll) is dict :
+            keys = coll.keys()
+        else :
+            keys = range(len(coll))
+        if inorder :
+            def field(k) :
+                try :
+                    value = coll[k]
+                    for f in self.fkeys :
+                        value = value[f]
+                    return value
+                except (KeyError, IndexError, TypeError) :
+                    raise KeyError(self.field)
+            keys.sort(key=field, reverse=reverse)
+        return keys
+    def add(self, key, entry) :
+        value = entry
+        try :
+            for k in self.fkeys :
+                value = value[k]
+            self.insert(key, value)
+        except (KeyError, IndexError, TypeError) :
+            self.others.add(key)
+    def refresh(self, coll, key) :
+        """Re-indexes the entry 'key' of the collection."""
+        self.discard(key)
+        try :
+            entry = coll[key]
+        except (KeyError, IndexError, TypeError) :
+            return
+        self.add(key, entry)
+    def changed(self, data, changes) :
+        """Brings the index up to date with 'data' after the primitive
+        changes (see util.apply_change), whose keys are from the root
+        of the database."""
+        self.version += 1
+        try :
+            self.update(data, changes)
+        finally :
+            self.synced = self.collection_of(data)
+            self.version += 1
+    def update(self, data, changes) :
+        ckeys = self.ckeys
+        n = len(ckeys)
+        torefresh = set()
+        appended = 0
+        for op, keys, value in changes :
+            keys = tuple(keys)
+            if len(keys) <= n :
+                if keys == ckeys and op == "append" and self.islist :
+                    appended += 1
+                elif (keys == ckeys[:len(keys)]
+                      or (op == "rename" and keys[:-1] + (value,) == ckeys[:len(keys)])) :
+                    self.build(data)
+                    return
+                elif (op in ("del", "rename") and keys[:-1] == ckeys[:len(keys) - 1]
+                      and type(keys[-1]) in (int, long)) :
+                    # an entry of a list the collection is in has gone,
+                    # so the collection may be at another place now
+                    self.build(data)
+                    return
+            elif keys[:n] == ckeys :
+                if len(keys) == n + 1 and self.islist and op in ("del", "rename") :
+                    # the other entries have moved
+                    self.build(data)
+                    return
+                torefresh.add(keys[n])
+                if len(keys) == n + 1 and op == "rename" :
+                    torefresh.add(value)
+        coll = self.collection_of(data)
+        if appended and type(coll) is list :
+            # the entries either side of the end are refreshed so that
+            # this also works when the appends have been undone
+            torefresh.update(xrange(max(0, len(coll) - appended), len(coll) + appended))
+        if torefresh :
+            for key in torefresh :
+                self.refresh(coll, key)
+    def definition(self) :
+        return {"kind" : self.kind, "collection" : list(self.ckeys), "field" : list(self.fkeys)}
+    def __repr__(self) :
+        return "%s(%r, %r)" % (self.__class__.__name__, self.collection, self.field)
+
+class HashIndex(Index) :
+    """An index which finds the entries whose field equals a value.
+    Unhashable values are kept in 'others'."""
+    kind = "hash"
+    def clear(self) :
+        Index.clear(self)
+        self.entries = {}
+    def insert(self, key, value) :
+        self.entries.setdefault(value, set()).add(key)
+        self.values[key] = value
+    def discard(self, key) :
+        if key in self.values :
+            value = self.values.pop(key)
+            bucket = self.entries[value]
+            bucket.discard(key)
+            if not bucket :
+                del self.entries[value]
+        else :
+            self.others.discard(key)
+    def lookup(self, value) :
+        """Returns the keys of the entries whose field might equal
+        'value', in order for lists."""
+        try :
+            keys = self.entries.get(value, ())
+        except TypeError :
+            keys = ()
+        keys = list(keys) + list(self.others)
+        if self.islist :
+            keys.sort()
+        return keys
+
+class Greatest(object) :
+    """Compares greater than everything else, for making bisect find
+    the end of a run of equal values."""
+    def __eq__(self, other) :
+        return self is other
+    def __ne__(self, other) :
+        return self is not other
+    def __lt__(self, other) :
+        return False
+    def __le__(self, other) :
+        return self is other
+    def __gt__(self, other) :
+        return self is not other
+    def __ge__(self, other) :
+        return True
+
+greatest = Greatest()
+
+class OrderedIndex(Index) :
+    """An index which keeps the entries sorted by their field, as a
+    sorted list of (value, key) pairs, so that it can find the entries
+    whose field lies in a range and can give the entries in order of
+    their field.  Values are ordered the way the comparison operations
+    order them, so the index agrees with 'lt', 'le', 'gt' and 'ge'."""
+    kind = "ordered"
+    def clear(self) :
+        Index.clear(self)
+        self.items = []
+    def built(self) :
+        # sorting once is quicker than inserting each entry in place
+        self.items.sort()
+    def insert(self, key, value) :
+        if self.building :
+            self.items.append((value, key))
+        else :
+            bisect.insort(self.items, (value, key))
+        self.values[key] = value
+    def discard(self, key) :
+        if key in self.values :
+            value = self.values.pop(key)
+            del self.items[bisect.bisect_left(self.items, (value, key))]
+        else :
+            self.others.discard(key)
+    def range(self, low=None, high=None, inorder=False, reverse=False) :
+        """Returns the keys of the entries whose field might lie
+        between the bounds, which are each either None or a pair of a
+        value and whether the bound is inclusive.  If 'inorder' is true,
+        the keys are in order of the field (largest first if 'reverse'
+        is true), and otherwise they are in order for lists."""
+        items = self.items
+        lo, hi = 0, len(items)
+        if low is not None :
+            if low[1] :
+                lo = bisect.bisect_left(items, (low[0],))
+            else :
+                lo = bisect.bisect_right(items, (low[0], greatest))
+        if high is not None :
+            if high[1] :
+                hi = bisect.bisect_right(items, (high[0], greatest))
+            else :
+                hi = bisect.bisect_left(items, (high[0],))
+        items = items[lo:hi]
+        if not inorder :
+            keys = [k for v, k in items] + list(self.others)
+            if self.islist :
+                keys.sort()
+            return keys
+        if self.others :
+            # sorting the entries would find that the field is missing
+            raise KeyError(self.field)
+        if not reverse :
+            return [k for v, k in items]
+        # equal values keep their order, as in a stable sort
+        keys = []
+        i = len(items)
+        while i > 0 :
+            j = bisect.bisect_left(items, (items[i - 1][0],), 0, i)
+            keys.extend(k for v, k in items[j:i])
+            i = j
+        return keys
+
+index_kinds = {"hash" : HashIndex, "ordered" : OrderedIndex}
+
+def from_definition(d) :
+    return index_kinds[d["kind"]](queries.path(*d["collection"]), queries.path(*d["field"]))
+
+class IndexLookup(queries.Query) :
+    """Gives the entries of the collection which 'source' gets whose
+    field (as indexed by the HashIndex 'index') might equal 'value'.
+    The planner puts this in place of a scan, leaving the test which
+    picks out the entries in place.  Entries of a list come in the
+    list's order, but entries of a dictionary come in no particular
+    order (not necessarily the dictionary's)."""
+    def __init__(self, index, source, value) :
+        self.index = index
+        self.source = assert_type(source, Get)
+        self.value = assert_type(value, queries.Value)
+    def execute(self, fuel, bindings) :
+        pathprime, data = self.source.eval(fuel, bindings)
+        value = self.value.eval(fuel, bindings)[1]
+        keys = self.index.agreeing(data, lambda : self.index.lookup(value))
+        if keys is None :
+            keys = self.index.scan(data)
+        for k in keys :
+            fuel.consume()
+            yield (pathprime[k] if pathprime is not None else None, data[k])
+    def compile_query(self, scope) :
+        source = self.source.compile_value(scope)
+        value = self.value.compile_value(scope)
+        index = self.index
+        def _lookup(fuel, frame) :
+            pathprime, data = source(fuel, frame)
+            v = value(fuel, frame)[1]
+            keys = index.agreeing(data, lambda : index.lookup(v))
+            if keys is None :
+                keys = index.scan(data)
+            for k in keys :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise queries.OutOfFuel()
+                yield (pathprime[k] if pathprime is not None else None, data[k])
+        return _lookup
+    def freevars(self) :
+        return queries.union_freevars([self.source, self.value])
+    def __repr__(self) :
+        return "IndexLookup(%r, %r, %r)" % (self.index, self.source, self.value)
+
+class RangeScan(queries.Query) :
+    """Gives the entries of the collection which 'source' gets whose
+    field (as indexed by the OrderedIndex 'index') might lie between
+    'low' and 'high', which are each either None or a pair of a Value
+    and whether the bound is inclusive.  If 'inorder' is true, the
+    entries come in order of the field, as an OrderBy would give
+    them, and otherwise they come in order like an IndexLookup's."""
+    def __init__(self, index, source, low=None, high=None, inorder=False, reverse=False) :
+        self.index = index
+        self.source = assert_type(source, Get)
+        self.low = low and (assert_type(low[0], queries.Value), low[1])
+        self.high = high and (assert_type(high[0], queries.Value), high[1])
+        self.inorder = inorder
+        self.reverse = reverse
+    def bounds(self) :
+        return [bound for bound in (self.low, self.high) if bound is not None]
+    def execute(self, fuel, bindings) :
+        pathprime, data = self.source.eval(fuel, bindings)
+        low, high = [bound and (bound[0].eval(fuel, bindings)[1], bound[1])
+                     for bound in (self.low, self.high)]
+        index = self.index
+        keys = index.agreeing(data, lambda : index.range(low, high, self.inorder, self.reverse))
+        if keys is None :
+            keys = index.scan(data, self.inorder, self.reverse)
+        for k in keys :
+            fuel.consume()
+            yield (pathprime[k] if pathprime is not None else None, data[k])
+    def compile_query(self, scope) :
+        source = self.source.compile_value(scope)
+        def compile_bound(bound) :
+            if bound is None :
+                return lambda fuel, frame : None
+            value = bound[0].compile_value(scope)
+            inclusive = bound[1]
+            return lambda fuel, frame : (value(fuel, frame)[1], inclusive)
+        low = compile_bound(self.low)
+        high = compile_bound(self.high)
+        index = self.index
+        inorder, reverse = self.inorder, self.reverse
+        def _rangescan(fuel, frame) :
+            pathprime, data = source(fuel, frame)
+            lowv, highv = low(fuel, frame), high(fuel, frame)
+            keys = index.agreeing(data, lambda : index.range(lowv, highv, inorder, reverse))
+            if keys is None :
+                keys = index.scan(data, inorder, reverse)
+            for k in keys :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise queries.OutOfFuel()
+                yield (pathprime[k] if pathprime is not None else None, data[k])
+        return _rangescan
+    def freevars(self) :
+        return queries.union_freevars([self.source] + [value for value, inclusive in self.bounds()])
+    def __repr__(self) :
+        return "RangeScan(%r, %r, %r, %r, inorder=%r, reverse=%r)" % (
+            self.index, self.source, self.low, self.high, self.inorder, self.reverse)
+
+def plan(queryfunc, indexes, rootkeys=()) :
+    """Returns a query function equivalent to 'queryfunc' which uses
+    the indexes where it can, or 'queryfunc' itself.  The query
+    function is run on the part of the database at 'rootkeys'."""
+    if not indexes or queryfunc.var is None :
+        return queryfunc
+    planner = Planner(indexes, queryfunc.var, tuple(rootkeys))
+    query = planner.plan(queryfunc.query, True)
+    if query is queryfunc.query :
+        return queryfunc
+    return Func(queryfunc.var, query)
+
+class Planner(object) :
+    def __init__(self, indexes, dbvar, rootkeys) :
+        self.indexes = indexes
+        self.dbvar = dbvar
+        self.rootkeys = rootkeys
+    def plan(self, query, dbvisible) :
+        """Returns the query with scans replaced by index lookups.
+        'dbvisible' is whether the database variable is still the
+        database here (it might be shadowed)."""
+        if isinstance(query, queries.Do) :
+            query.buildQuery()
+            return self.plan(query.query, dbvisible)
+        elif isinstance(query, queries.Union) :
+            planned = [self.plan(q, dbvisible) for q in query.queries]
+            if all(p is q for p, q in zip(planned, query.queries)) :
+                return query
+            return queries.Union(*planned)
+        elif isinstance(query, OrderBy) :
+            return self.plan_source(query, None, None, dbvisible)
+        elif isinstance(query, queries.Take) :
+            planned = self.plan(query.query, dbvisible)
+            return query if planned is query.query else queries.Take(query.n, planned)
+        elif isinstance(query, queries.UseJoin) :
+            planned = self.plan(query.query, dbvisible)
+            return query if planned is query.query else queries.UseJoin(query.kind, planned)
+        elif isinstance(query, queries.GroupBy) :
+            planned = self.plan(query.query, dbvisible)
+            if planned is query.query :
+                return query
+            return queries.GroupBy(query.key, planned, query.aggregate, query.value)
+        elif isinstance(query, Bind) :
+            var = query.func.var
+            body = self.plan(query.func.query, dbvisible and var != self.dbvar)
+            source = self.plan_source(query.query, var, body, dbvisible)
+            if source is query.query and body is query.func.query :
+                return query
+            return Bind(source, Func(var, body))
+        else :
+            return query
+    def plan_source(self, source, var, body, dbvisible) :
+        """Plans the query which a bind of 'var' for 'body' goes
+        through."""
+        if isinstance(source, queries.Do) :
+            source.buildQuery()
+            source = source.query
+        if isinstance(source, OrderBy) :
+            inner = self.plan(source.query, dbvisible)
+            if inner is not source.query :
+                source = OrderBy(inner, source.key, source.reverse)
+            return self.use_ordering(source, var, body) if dbvisible else source
+        source = self.plan(source, dbvisible)
+        return self.use_index(source, var, body) if dbvisible else source
+    def collection_keys(self, source) :
+        """Returns the keys from the root of the database of the
+        collection a query scans, or None if it is not a plain scan."""
+        if (isinstance(source, Get) and isinstance(source.source, Var)
+            and source.source.name == self.dbvar) :
+            return self.rootkeys + tuple(source.path)
+        return None
+    def use_index(self, source, var, body) :
+        """Tries to replace a scan over 'source', binding 'var' for
+        'body', by an index lookup."""
+        if var is None :
+            return source
+        ckeys = self.collection_keys(source)
+        if ckeys is None :
+            return source
+        candidates = [index for index in self.indexes if index.ckeys == ckeys]
+        if not candidates :
+            return source
+        tests = list(tests_on(var, body))
+        for index in candidates :
+            if isinstance(index, HashIndex) :
+                for test in tests :
+                    lookup = equality_lookup(index, source, var, test)
+                    if lookup is not None :
+                        return lookup
+        for index in candidates :
+            if isinstance(index, OrderedIndex) :
+                bounds = range_bounds(index, var, tests)
+                if bounds is not None :
+                    return RangeScan(index, source, bounds[0], bounds[1])
+        return source
+    def use_ordering(self, orderby, var, body) :
+        """Tries to replace an OrderBy of a collection by the field of
+        its entries with an ordered RangeScan, which is also narrowed
+        down by the tests which 'body' makes on 'var'."""
+        key = orderby.key
+        ckeys = self.collection_keys(orderby.query)
+        if ckeys is None or key.var is None :
+            return orderby
+        field = field_of(key.var, key.value)
+        for index in self.indexes :
+            if (isinstance(index, OrderedIndex) and index.ckeys == ckeys
+                and index.fkeys == field) :
+                bounds = None
+                if var is not None :
+                    bounds = range_bounds(index, var, list(tests_on(var, body)))
+                low, high = bounds or (None, None)
+                return RangeScan(index, orderby.query, low, high,
+                                 inorder=True, reverse=orderby.reverse)
+        # otherwise there might be an index for narrowing down what is sorted
+        source = self.use_index(orderby.query, var, body)
+        if source is not orderby.query :
+            return OrderBy(source, key, orderby.reverse)
+        return orderby
+
+def tests_on(var, body) :
+    """Yields (value, bound) for each 'require' in the chain of binds
+    in 'body' which is in the scope of 'var', where 'bound' is the set
+    of variables bound since 'var'."""
+    bound = set([var])
+    while isinstance(body, (Bind, queries.Do)) :
+        if isinstance(body, queries.Do) :
+            body.buildQuery()
+            body = body.query
+            continue
+        if isinstance(body.query, Require) :
+            yield body.query.value, bound
+        if body.func.var == var :
+            return
+        bound = bound | set([body.func.var])
+        body = body.func.query
+    if isinstance(body, Require) :
+        yield body.value, bound
+
+def field_of(var, value) :
+    """If 'value' is a Get of a field of 'var', returns the keys of
+    the field."""
+    if (isinstance(value, Get) and isinstance(value.source, Var)
+        and value.source.name == var) :
+        return tuple(value.path)
+    return None
+
+def independent(value, bound) :
+    """Whether 'value' can be evaluated without the variables in
+    'bound'."""
+    fv = value.freevars()
+    return fv is not None and not (fv & bound)
+
+flipped_comparisons = {"eq" : "eq", "lt" : "gt", "le" : "ge", "gt" : "lt", "ge" : "le"}
+
+def comparison_on(index, var, test) :
+    """If the test compares the indexed field of 'var' with a value
+    which does not depend on the scan, returns (name, value) such that
+    the test is Op(name, field, value)."""
+    value, bound = test
+    if not (isinstance(value, Op) and value.name in flipped_comparisons
+            and len(value.params) == 2) :
+        return None
+    left, right = value.params
+    if field_of(var, left) == index.fkeys and independent(right, bound) :
+        return value.name, right
+    if field_of(var, right) == index.fkeys and independent(left, bound) :
+        return flipped_comparisons[value.name], left
+    return None
+
+def equality_lookup(index, source, var, test) :
+    comparison = comparison_on(index, var, test)
+    if comparison is not None and comparison[0] == "eq" :
+        return IndexLookup(index, source, comparison[1])
+    return None
+
+def range_bounds(index, var, tests) :
+    """Returns (low, high) bounds for a RangeScan from the first lower
+    and upper bounds which the tests put on the indexed field, or None
+    if there are none."""
+    low = high = None
+    for test in tests :
+        comparison = comparison_on(index, var, test)
+        if comparison is None :
+            continue
+        name, value = comparison
+        if low is None and name in ("eq", "gt", "ge") :
+            low = (value, name != "gt")
+        if high is None and name in ("eq", "lt", "le") :
+            high = (value, name != "lt")
+    if low is None and high is None :
+        return None
+    return low, high
@@ -0,0 +1,226 @@
+# isolationtest.py
+# 2013 Kyle Miller
+# checks what readers see while the minidb is being changed: snapshots
+# with mvcc, cursors, rolled back transactions, the result cache,
+# locks on paths and watches
+
+from minidb import *
+from plantest import fresh
+import watch
+
+if __name__=="__main__" :
+    from queries import *
+    import random
+    import threading
+    import time
+
+    @queryfunc
+    def balances(db) :
+        return (Do()
+                .foreach(a, Get(db, "accounts"))
+                .ret(Get(a, "balance")))
+
+    @queryfunc
+    def evens(db) :
+        return (Do()
+                .foreach(a, Get(db, "xs"))
+                .require(Op("eq", Op("mod", a, 2), 0))
+                .ret(a))
+
+    @queryfunc
+    def first_account(db) :
+        return Return(Get(db, "accounts", "a1"))
+
+    for mvcc in [False, True] :
+        db = fresh("isolationtest.db", mvcc=mvcc, cache_bytes=1 << 20)
+        db.insert(path("accounts"), dict(("a%d" % i, {"balance" : 100}) for i in xrange(50)))
+        db.insert(path("xs"), range(1000))
+        db.insert(path("other"), 0)
+
+        # transfers keep the total the same, so every reader must see
+        # the same total
+        def transfer(rand) :
+            i, j = rand.sample(xrange(50), 2)
+            with db.transaction() as tx :
+                x = tx.select(lambda db : Return(Get(db, "accounts", "a%d" % i, "balance")))[0]
+                y = tx.select(lambda db : Return(Get(db, "accounts", "a%d" % j, "balance")))[0]
+                tx.insert(path("accounts", "a%d" % i, "balance"), x - 1, overwrite=True)
+                tx.insert(path("accounts", "a%d" % j, "balance"), y + 1, overwrite=True)
+        totals = []
+        def reader() :
+            for n in xrange(200) :
+                totals.append(sum(db.select(balances)))
+        def writer(seed) :
+            rand = random.Random(seed)
+            for n in xrange(200) :
+                transfer(rand)
+        threads = ([threading.Thread(target=reader) for i in xrange(2)]
+                   + [threading.Thread(target=writer, args=(i,)) for i in xrange(2)])
+        for t in threads :
+            t.start()
+        for t in threads :
+            t.join()
+        assert set(totals) == set([5000]), set(totals)
+
+        # a transaction which fails leaves nothing behind, and a nested
+        # one which fails only undoes its own changes
+        try :
+            with db.transaction() as tx :
+                tx.insert(path("accounts", "a0", "balance"), -1, overwrite=True)
+                tx.insert(path("xs"), 1000, append=True)
+                raise ValueError()
+        except ValueError :
+            pass
+        assert sum(db.select(balances)) == 5000
+        assert len(db.data["xs"]) == 1000
+        with db.transaction() as tx :
+            tx.insert(path("other"), 1, overwrite=True)
+            try :
+                with db.transaction() as inner :
+                    inner.insert(path("other"), 2, overwrite=True)
+                    raise ValueError()
+            except ValueError :
+                pass
+            assert tx.select(lambda db : Return(Get(db, "other"))) == [1]
+        assert db.data["other"] == 1
+
+        # a cursor sees a snapshot with mvcc, and otherwise expires
+        # when what it looks at changes; a page token continues from
+        # where its cursor left off, until the data changes
+        full = db.select(evens)
+        cursor = db.select_iter(evens)
+        first = cursor.fetch(10)
+        db.insert(path("other"), 2, overwrite=True)
+        first += cursor.fetch(10)
+        assert first == full[:20]
+        token = cursor.token()
+        assert db.select_iter(evens, limit=5, token=token).fetch() == full[20:25]
+        assert db.select_iter(evens, offset=490).fetch() == full[490:]
+        db.insert(path("xs"), 1000, append=True)
+        try :
+            assert cursor.fetch() == full[20:] and mvcc
+        except CursorExpired :
+            assert not mvcc
+        try :
+            db.select_iter(evens, token=token)
+            assert False
+        except CursorExpired :
+            pass
+        assert db.select(evens) == full + [1000]
+
+        # the cache gives the new results after a change, and each
+        # caller gets its own copy of them
+        hits = db.cache.hits
+        balance = db.select(first_account)[0]["balance"]
+        db.select(first_account)[0]["balance"] = -1
+        assert db.select(first_account) == [{"balance" : balance}]
+        assert db.cache.hits > hits
+        db.insert(path("accounts", "a1", "balance"), balance + 1, overwrite=True)
+        assert db.select(first_account) == [{"balance" : balance + 1}]
+        assert sum(db.select(balances)) == 5001
+
+        # a watch on an entry of a list hears about an earlier entry
+        # being removed (which moves it), but not about later ones;
+        # changes to one entry are made into one event; and a watch with
+        # too many events waiting gives the whole watched part instead
+        db.insert(path("l"), [{"v" : i} for i in xrange(4)])
+        second = db.watch(path("l", 2))
+        first = db.watch(path("l", 0))
+        everything = db.watch(path("l"), maxsize=2)
+        heard = []
+        with db.watch(path("l", 0, "v"), callback=lambda *event : heard.append(event)) :
+            db.remove(lambda db : Return(Get(db, "l", 1)))
+            assert [(list(p), old, new) for p, old, new in second.get(0)] == [(["l", 1], {"v" : 1}, None)]
+            assert first.get(0) == []
+            db.insert(path("l", 0, "v"), 10, overwrite=True)
+            db.insert(path("l", 0, "v"), 11, overwrite=True)
+            assert [(list(p), old, new) for p, old, new in first.get(0)] == [(["l", 0, "v"], 0, 11)]
+            db.insert(path("l"), {"v" : 4}, append=True)
+            (p, old, new), = everything.get(0)
+            assert list(p) == ["l"] and old is watch.lost and new == db.data["l"]
+            with db.transaction() as tx :
+                tx.insert(path("l", 0, "v"), 12, overwrite=True)
+            # the events are copies of the values, so a later change does
+            # not show in them
+            db.insert(path("l", 0, "d"), {"x" : 1})
+            db.insert(path("l", 0, "d", "y"), 2)
+            events = dict((tuple(p), new) for p, old, new in first.get(0))
+            assert events == {("l", 0, "v") : 12, ("l", 0, "d") : {"x" : 1}, ("l", 0, "d", "y") : 2}
+            # the callback is called from another thread
+            for i in xrange(500) :
+                if heard and heard[-1][2] == 12 :
+                    break
+                time.sleep(0.01)
+        assert [list(event[0]) for event in heard] == [["l", 0, "v"]] * len(heard)
+        assert heard[-1][2] == 12, heard
+        db.remove(lambda db : Return(Get(db, "l")))
+
+        # data replaced wholesale and then committed is what readers see
+        saved = db.data
+        db.data = {"accounts" : {"a0" : {"balance" : 5000}}}
+        db.commit()
+        assert db.select(balances) == [5000]
+        db.data = saved
+        db.commit()
+        assert sum(db.select(balances)) == 5001
+
+        db.close()
+
+    # with path locks (and a journal, without which every commit waits
+    # for every writer), a change to one entry does not wait for a
+    # change to another, but a reader of both waits for each
+    for options in [dict(), dict(group_commit_window=0.01)] :
+        db = fresh("isolationtest.db", path_locks=True, journaled=True, **options)
+        db.insert(path("accounts"), dict(("a%d" % i, {"balance" : 100}) for i in xrange(8)))
+        inside = threading.Event()
+        release = threading.Event()
+        def slow() :
+            with db.transaction(path("accounts", "a0")) as tx :
+                tx.insert(path("accounts", "a0", "balance"), 0, overwrite=True)
+                inside.set()
+                release.wait(5)
+        writer = threading.Thread(target=slow)
+        writer.start()
+        inside.wait(5)
+        db.insert(path("accounts", "a1", "balance"), 200, overwrite=True)
+        assert db.select(lambda db : Return(Get(db, "balance")), subpath=path("accounts", "a1")) == [200]
+        totals = []
+        reader = threading.Thread(target=lambda : totals.append(sum(db.select(balances))))
+        reader.start()
+        reader.join(0.2)
+        assert totals == []
+        release.set()
+        writer.join()
+        reader.join()
+        assert totals == [800]
+
+        # a transaction on a path cannot look or change outside it
+        for outside in [lambda tx : tx.insert(path("accounts", "a3", "balance"), 0, overwrite=True),
+                        lambda tx : tx.select(balances)] :
+            try :
+                with db.transaction(path("accounts", "a2")) as tx :
+                    outside(tx)
+                assert False
+            except Exception as x :
+                assert "outside" in str(x), x
+
+        # writers to different entries at once
+        def deposits(i) :
+            for n in xrange(30) :
+                db.update(lambda a : Return(a),
+                          [ToUpdate(path("balance"), lambda a : Op("add", Get(a, "balance"), 1))],
+                          subpath=path("accounts", "a%d" % i))
+        writers = [threading.Thread(target=deposits, args=(i,)) for i in xrange(2, 8)]
+        for t in writers :
+            t.start()
+        for t in writers :
+            t.join()
+        assert sum(db.select(balances)) == 800 + 6 * 30
+        assert db.lock.holders == {}
+        db.close()
+        assert Database("isolationtest.db", journaled=True).data == db.data
+
+    for f in ["isolationtest.db", "isolationtest.db.journal", "isolationtest.db.indexes"] :
+        if os.path.isfile(f) :
+            os.remove(f)
+    print "ok"
@@ -0,0 +1,261 @@
+# joins.py
+# 2013 Kyle Miller
+# hash joins for the minidb, for two scans whose entries are matched by
+# equality
+
+import itertools
+
+import queries
+from queries import (Query, Value, Func, Bind, Union, Return, Require, OrderBy, Take, GroupBy, Op,
+                     Var, Do, UseJoin)
+from util import assert_type
+
+# at most this many pairs of entries are just tried one by one, since
+# it is not worth making a hash table for them
+nested_limit = 64
+
+def plan(queryfunc) :
+    """Returns a query function equivalent to 'queryfunc' in which each
+    chain of binds
+
+      foreach a in q1, foreach b in q2, require x == y, ...
+
+    where q2 does not use a, x uses a but not b, and y uses b but not
+    a (or the other way around) is run by a HashJoin, or 'queryfunc'
+    itself.  Requires between the two foreaches (which can only use a,
+    and are where the optimizer puts them) filter q1 first.  UseJoin in the query says to always use a hash join
+    ("hash") or never to ("nested")."""
+    query = plan_query(queryfunc.query, None)
+    if query is queryfunc.query :
+        return queryfunc
+    return Func(queryfunc.var, query)
+
+def plan_query(query, kind) :
+    if isinstance(query, Do) :
+        query.buildQuery()
+        return plan_query(query.query, kind)
+    elif isinstance(query, UseJoin) :
+        planned = plan_query(query.query, query.kind)
+        return query if planned is query.query else UseJoin(query.kind, planned)
+    elif isinstance(query, Union) :
+        planned = [plan_query(q, kind) for q in query.queries]
+        if all(p is q for p, q in zip(planned, query.queries)) :
+            return query
+        return Union(*planned)
+    elif isinstance(query, OrderBy) :
+        source = plan_query(query.query, kind)
+        return query if source is query.query else OrderBy(source, query.key, query.reverse)
+    elif isinstance(query, Take) :
+        source = plan_query(query.query, kind)
+        return query if source is query.query else Take(query.n, source)
+    elif isinstance(query, GroupBy) :
+        source = plan_query(query.query, kind)
+        if source is query.query :
+            return query
+        return GroupBy(query.key, source, query.aggregate, query.value)
+    elif isinstance(query, Bind) :
+        source = plan_query(query.query, kind)
+        var = query.func.var
+        if kind != "nested" :
+            joined = join_bind(source, var, query.func.query, kind)
+            if joined is not None :
+                return joined
+        body = plan_query(query.func.query, kind)
+        if source is query.query and body is query.func.query :
+            return query
+        return Bind(source, Func(var, body))
+    else :
+        return query
+
+def join_bind(left, lvar, body, kind) :
+    """Returns a HashJoin doing the work of a bind of 'lvar' to the
+    results of 'left' for 'body', or None."""
+    if lvar is None :
+        return None
+    body = built(body)
+    tests = []
+    while isinstance(body, Bind) and isinstance(body.query, Require) and body.func.var is None :
+        tests.append(body.query.value)
+        body = built(body.func.query)
+    if not isinstance(body, Bind) or isinstance(body.query, (Require, Return)) :
+        return None
+    right, rvar = body.query, body.func.var
+    if rvar is None or rvar == lvar :
+        return None
+    rightvars = right.freevars()
+    if rightvars is None or lvar in rightvars :
+        return None
+    rest = built(body.func.query)
+    if not (isinstance(rest, Bind) and isinstance(rest.query, Require) and rest.func.var is None) :
+        return None
+    keys = join_keys(rest.query.value, lvar, rvar)
+    if keys is None :
+        return None
+    if tests :
+        left = filtered(left, lvar, tests)
+    return HashJoin(left, lvar, plan_query(right, kind), rvar, keys[0], keys[1],
+                    plan_query(rest.func.query, kind), always=(kind == "hash"))
+
+def filtered(source, var, tests) :
+    """Returns the query giving the results of 'source' for which each
+    of 'tests' is true when 'var' is bound to the result."""
+    query = Return(Var(var))
+    for test in reversed(tests) :
+        query = Bind(Require(test), Func(None, query))
+    return Bind(source, Func(var, query))
+
+def built(query) :
+    if isinstance(query, Do) :
+        query.buildQuery()
+        return query.query
+    return query
+
+def join_keys(test, lvar, rvar) :
+    """Returns the values which 'test' says must be equal, the one
+    using 'lvar' first, if it is such a test, or None."""
+    if not (isinstance(test, Op) and test.name == "eq" and len(test.params) == 2) :
+        return None
+    x, y = test.params
+    xvars, yvars = x.freevars(), y.freevars()
+    if xvars is None or yvars is None :
+        return None
+    if lvar in xvars and rvar not in xvars and rvar in yvars and lvar not in yvars :
+        return x, y
+    if rvar in xvars and lvar not in xvars and lvar in yvars and rvar not in yvars :
+        return y, x
+    return None
+
+class HashJoin(Query) :
+    """Gives what
+
+      Bind(left, Func(lvar, Bind(right, Func(rvar,
+        Bind(Require(Op("eq", lkey, rkey)), Func(None, body))))))
+
+    gives, where 'right' and 'rkey' do not use 'lvar' and 'lkey' does
+    not use 'rvar', in the same order.  Each source is gone through
+    once: 'left' first (and 'right' not at all if it has no results),
+    then the entries of 'right' are put in a hash table by their key,
+    and then the entries of 'left' look themselves up in it as they
+    come, rather than every pair being tried.  The test is still done for
+    each pair the table gives, so entries whose keys cannot be hashed
+    (or cannot be found) are tried with every entry, and errors are
+    raised just like the binds would.
+
+    Unless 'always' is true, when there are at most nested_limit
+    pairs, every pair is tried."""
+    def __init__(self, left, lvar, right, rvar, lkey, rkey, body, always=False) :
+        self.left = assert_type(left, Query)
+        self.lvar = lvar
+        self.right = assert_type(right, Query)
+        self.rvar = rvar
+        self.lkey = assert_type(lkey, Value)
+        self.rkey = assert_type(rkey, Value)
+        self.body = assert_type(body, Query)
+        self.always = always
+    def nested(self) :
+        """Returns the binds which this does the work of."""
+        test = Bind(Require(Op("eq", self.lkey, self.rkey)), Func(None, self.body))
+        return Bind(self.left, Func(self.lvar, Bind(self.right, Func(self.rvar, test))))
+    def execute(self, fuel, bindings) :
+        return self.nested().execute(fuel, bindings)
+    def freevars(self) :
+        return self.nested().freevars()
+    def compile_query(self, scope) :
+        left = self.left.compile_query(scope)
+        right = self.right.compile_query(scope)
+        lscope, lslot = scope.bind(self.lvar)
+        bothscope, rslot = lscope.bind(self.rvar)
+        lkey = self.lkey.compile_value(lscope)
+        rkey = self.rkey.compile_value(bothscope)
+        test = Op("eq", self.lkey, self.rkey).compile_value(bothscope)
+        body = self.body.compile_query(bothscope)
+        always = self.always
+        def _rows(source, fuel, frame) :
+            rows = []
+            for r in source(fuel, frame) :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise queries.OutOfFuel()
+                rows.append(r)
+            return rows
+        def _stream(source, fuel, frame) :
+            for r in source(fuel, frame) :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise queries.OutOfFuel()
+                yield r
+        def _pairs(lrows, rrows, fuel, frame) :
+            # the pairs the hash table gives, in the order the binds
+            # would try them
+            table, others = build(rrows, rslot, rkey, fuel, frame)
+            everything = range(len(rrows))
+            for l in lrows :
+                frame[lslot] = l
+                for j in lookup(table, others, everything, lkey, fuel, frame) :
+                    yield l, rrows[j]
+        def _hashjoin(fuel, frame) :
+            lrows = _stream(left, fuel, frame)
+            first = list(itertools.islice(lrows, 1))
+            if not first :
+                return
+            rrows = _rows(right, fuel, frame)
+            if not rrows :
+                # the rest of 'left' is still gone through, as the binds
+                # would, in case it raises an exception
+                for l in lrows :
+                    pass
+                return
+            head = first
+            pairs = None
+            if not always :
+                # as many more entries of 'left' as could still be
+                # tried with every entry of 'right'
+                head = first + list(itertools.islice(lrows, nested_limit // len(rrows)))
+                if len(head) * len(rrows) <= nested_limit :
+                    pairs = ((l, r) for l in head for r in rrows)
+            if pairs is None :
+                pairs = _pairs(itertools.chain(head, lrows), rrows, fuel, frame)
+            for l, r in pairs :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise queries.OutOfFuel()
+                frame[lslot] = l
+                frame[rslot] = r
+                if test(fuel, frame)[1] :
+                    for r in body(fuel, frame) :
+                        yield r
+        return _hashjoin
+    def __repr__(self) :
+        return "HashJoin(%r, %r, %r, %r, %r, %r, %r, always=%r)" % (
+            self.left, self.lvar, self.right, self.rvar, self.lkey, self.rkey, self.body, self.always)
+
+def build(rows, slot, key, fuel, frame) :
+    """Returns a table from the key of each of the rows to the places
+    of the rows with that key, and the places of the rows whose key
+    could not be put in the table."""
+    table = {}
+    others = []
+    for i, r in enumerate(rows) :
+        frame[slot] = r
+        try :
+            k = key(fuel, frame)[1]
+            table.setdefault(k, []).append(i)
+        except queries.OutOfFuel :
+            raise
+        except Exception :
+            others.append(i)
+    return table, others
+
+def lookup(table, others, everything, key, fuel, frame) :
+    """Returns the places in order of the rows in the table which might
+    match the row whose key is given by 'key'.  If the key cannot be
+    looked up, that is every row."""
+    try :
+        places = table.get(key(fuel, frame)[1], ())
+    except queries.OutOfFuel :
+        raise
+    except Exception :
+        return everything
+    if others :
+        return sorted(places + others) if places else others
+    return places
@@ -0,0 +1,106 @@
+# journal.py
+# 2013 Kyle Miller
+# an append-only log of changes to the minidb
+
+import json
+import os
+import threading
+
+import util
+
+def json_key(k) :
+    """Returns the key which 'k' becomes when it is a dictionary key
+    that has been through json."""
+    if isinstance(k, basestring) :
+        return k
+    return json.dumps(k)
+
+class Journal(object) :
+    """An append-only file of primitive changes (see
+    util.apply_change), one json record per line.  Together with a
+    snapshot of the database, replaying the journal gives the current
+    state of the database."""
+    def __init__(self, filename) :
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.file = None
+        self.records = 0
+    def encode(self, op, keys, value=None) :
+        """Returns the record for a primitive change.  Since the record
+        is made right away, later changes to 'value' do not affect
+        it."""
+        return json.dumps([op, keys, value], separators=(",", ":")) + "\n"
+    def append(self, records) :
+        """Appends records to the journal, returning once they are on
+        disk."""
+        with self.lock :
+            if self.file is None :
+                self.file = open(self.filename, "a")
+            self.file.write("".join(records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.records += len(records)
+    def replay(self, data, prepare=None) :
+        """Applies the journal to 'data', which should be the snapshot
+        the journal was started from.  A partial record at the end of
+        the file (from a crash during an append) is cut off.  Returns
+        the number of records replayed.
+
+        If 'prepare' is given, it is called with the keys of each
+        record before the record is applied."""
+        with self.lock :
+            self.close()
+            self.records = 0
+            if not os.path.isfile(self.filename) :
+                return 0
+            good = 0
+            with open(self.filename, "r+") as f :
+                for line in iter(f.readline, "") :
+                    if not line.endswith("\n") :
+                        break
+                    try :
+                        op, keys, value = json.loads(line)
+                    except ValueError :
+                        break
+                    if prepare is not None :
+                        prepare(keys)
+                    self.apply(data, op, keys, value)
+                    good += len(line)
+                    self.records += 1
+                f.truncate(good)
+            return self.records
+    def apply(self, data, op, keys, value) :
+        # the snapshot has been through json, so dictionary keys must
+        # be converted the same way
+        parent = data
+        newkeys = []
+        for k in keys :
+            if type(parent) is dict :
+                k = json_key(k)
+            newkeys.append(k)
+            parent = parent.get(k) if type(parent) is dict else parent[k]
+        if op == "rename" :
+            value = json_key(value)
+        util.apply_change(data, op, newkeys, value)
+    def replay_records(self, data, records, prepare=None) :
+        """Applies records which have not been appended yet to 'data'."""
+        for record in records :
+            op, keys, value = json.loads(record)
+            if prepare is not None :
+                prepare(keys)
+            self.apply(data, op, keys, value)
+    def rotate(self) :
+        """Moves the journal out of the way so that new records go to
+        an empty journal.  Returns the name of the old journal."""
+        with self.lock :
+            self.close()
+            oldfile = self.filename + ".old"
+            if os.path.isfile(self.filename) :
+                os.rename(self.filename, oldfile)
+            self.records = 0
+            return oldfile
+    def close(self) :
+        with self.lock :
+            if self.file is not None :
+                self.file.close()
+                self.file = None
@@ -0,0 +1,91 @@
+# journaltest.py
+# 2013 Kyle Miller
+# checks that a journaled minidb comes back as it was after a crash
+
+from minidb import *
+from plantest import fresh
+
+def crash(f) :
+    """Runs f in a child process which exits without cleaning up, like
+    a crash would."""
+    pid = os.fork()
+    if pid == 0 :
+        try :
+            f()
+        finally :
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+if __name__=="__main__" :
+    from queries import *
+
+    def changes(db) :
+        db.insert(path("users"), {})
+        for i in xrange(50) :
+            db.insert(path("users", "u%d" % i), {"n" : i, "tags" : []})
+            db.insert(path("users", "u%d" % i, "tags"), "t%d" % i, append=True)
+        db.remove(lambda db : Return(Get(db, "users", "u3")))
+        db.update(lambda db : Return(Get(db, "users", "u4")),
+                  [ToUpdate(Path(), lambda x : "four", newkey=True)])
+        db.update(lambda db : Do().foreach(a, Get(db, "users")).ret(a),
+                  [ToUpdate(path("n"), lambda x : Op("add", Get(x, "n"), 1))])
+
+    expected = fresh("journaltest.db")
+    changes(expected)
+    expected = expected.data
+
+    # with checkpoints along the way, and with group commit
+    for options in [dict(checkpoint_interval=40), dict(group_commit_window=0.01)] :
+        fresh("journaltest.db", journaled=True, **options).close()
+        crash(lambda : changes(Database("journaltest.db", journaled=True, **options)))
+        assert Database("journaltest.db", journaled=True).data == expected
+
+    # a record only partly written is cut off
+    with open("journaltest.db.journal", "a") as f :
+        f.write('["set",["users","u9"')
+    assert Database("journaltest.db", journaled=True).data == expected
+    assert open("journaltest.db.journal").read().endswith("\n")
+
+    # a checkpoint which stopped after moving the journal out of the
+    # way is finished
+    db = Database("journaltest.db", journaled=True)
+    db.write_snapshot("journaltest.db.tmp")
+    db.journal.rotate()
+    db.insert(path("more"), 1)
+    assert Database("journaltest.db", journaled=True).data == db.data
+    assert not os.path.isfile("journaltest.db.journal.old")
+
+    # after a failed group commit, the database cannot be changed until
+    # it is rolled back, and then it is what the journal says
+    db = Database("journaltest.db", journaled=True, group_commit_window=0.01, sync_commits=False)
+    append = db.journal.append
+    def full(records) :
+        raise IOError("no space left")
+    db.journal.append = full
+    ticket = db.insert(path("lost"), 1)
+    try :
+        ticket.wait()
+        assert False
+    except IOError :
+        pass
+    try :
+        db.insert(path("later"), 1)
+        assert False
+    except Exception as x :
+        assert "rolled back" in str(x)
+    db.journal.append = append
+    db.rollback()
+    db.insert(path("later"), 2).wait()
+    assert Database("journaltest.db", journaled=True).data == db.data
+    assert "lost" not in db.data
+
+    # closing flushes what is waiting and stops the group commit thread
+    db = Database("journaltest.db", journaled=True, group_commit_window=10, sync_commits=False)
+    db.insert(path("closed"), 1)
+    db.close()
+    assert not db.committer.thread.is_alive()
+    assert Database("journaltest.db", journaled=True).data["closed"] == 1
+
+    for f in ["journaltest.db", "journaltest.db.journal"] :
+        os.remove(f)
+    print "ok"
@@ -4,56 +4,563 @@
 # a mini database that stores a dictionary of strings, numbers,
 # booleans, arrays, dictionaries, or None
 
+import base64
+import itertools
 import json
 import os
 import logging
+import threading
+import weakref
 
+import analyze
+import indexes
+import cache
+import joins
+import journal
+import optimizer
+import parallel
 import queries
+import serialize
+import storage
 import util
+import vectorize
+import watch
 from util import assert_type
 
+class CursorExpired(Exception) :
+    pass
+
 class Database(object) :
-    def __init__(self, backingFile) :
+    def __init__(self, backingFile, journaled=False, checkpoint_interval=10000,
+                 group_commit_window=None, group_commit_size=100, sync_commits=True,
+                 cache_bytes=None, mvcc=False, binary=False, codec="json",
+                 path_locks=False) :
+        """Opens the database stored in 'backingFile'.
+
+        If 'journaled' is true, then changes are committed by appending
+        them to a journal next to the backing file rather than by
+        rewriting the whole file.  Every 'checkpoint_interval' records,
+        the journal is compacted into the backing file.
+
+        If 'group_commit_window' is given, then changes are committed
+        together by a background thread, which waits up to that many
+        seconds (or until 'group_commit_size' changes are waiting)
+        before flushing.  Methods which change the database return a
+        util.Ticket for their commit.  If 'sync_commits' is true, they
+        wait for their changes to be durable before returning;
+        otherwise, one can wait on the ticket or call sync().  If a
+        flush fails, the changes since the last one are not durable
+        even though readers see them, so the database cannot be
+        changed until it is rolled back (see check_writable).
+
+        Indexes made with create_index are remembered in a file next
+        to the backing file and are rebuilt when the database is
+        opened.
+
+        If 'cache_bytes' is given, the results of select are cached
+        (using about that many bytes at most) until there is a change
+        to a top-level entry of the database which the query looks
+        at.
+
+        If 'mvcc' is true, then select never waits for writers.  A
+        transaction makes its changes to copies of the dictionaries
+        and lists it modifies (each is copied at most once per
+        transaction) and publishes the new version when it finishes,
+        and readers see the last version published.  Writes to very
+        large collections then pay for copying the collection.
+
+        If 'binary' is true, the backing file is written in the format
+        of storage.py rather than as json.  A backing file in that
+        format (whatever 'binary' is) is mapped into memory rather
+        than read, and each top-level entry of the database is only
+        decoded once something looks at it.  Looking at a 'subpath'
+        only decodes the dictionaries and lists on the way to it.
+
+        Otherwise, the backing file is written with 'codec', a name in
+        serialize.codecs or a serialize.Codec.  It is read with
+        whichever codec wrote it.
+
+        If 'path_locks' is true, then insert, remove and update with a
+        'subpath' (or a transaction with a 'lockpath') lock only that
+        part of the database (see util.PathLock), and select locks
+        only the top-level entries the query looks at or its
+        'subpath'.  So writers of different parts of the database go at
+        the same time, and readers only wait for writers of the parts
+        they read.  Without a journal, though, each commit writes the
+        whole database, which waits until no one is writing.  This
+        cannot be used with 'mvcc'."""
         self.logger = logging
         self.backingFile = os.path.abspath(backingFile)
-        self.lock = util.RWLock()
+        if path_locks and mvcc :
+            raise Exception("path_locks cannot be used with mvcc")
+        self.path_locks = path_locks
+        self.lock = util.PathLock() if path_locks else util.RWLock()
+        # for what writers of different paths share: the indexes and
+        # the versions in the snapshot
+        self.mutex = threading.Lock()
+        self.snapshotlock = threading.Lock()
+        self.local = threading.local()
+        self.journal = None
+        if journaled :
+            self.journal = journal.Journal(self.backingFile + ".journal")
+        self.checkpoint_interval = checkpoint_interval
+        self.committer = None
+        self.sync_commits = sync_commits
+        self.indexes = []
+        self.plans = weakref.WeakKeyDictionary()
+        self.cache = None
+        if cache_bytes is not None :
+            self.cache = cache.ResultCache(cache_bytes)
+        self.cachekeys = weakref.WeakKeyDictionary()
+        self.mvcc = mvcc
+        self.clock = 0
+        self.binary = binary
+        self.codec = serialize.get_codec(codec)
+        self.lazy = False
+        self.loadlock = threading.Lock()
+        self.feed = watch.Feed(copying=not mvcc)
+        self.load_indexes()
         self.rollback(warn=False)
-        self.logger.info("%r initialized")
-    def commit(self) :
-        """Commits the database to disk by first saving it to a
-        temporary file and then copying it over the old database file."""
+        if group_commit_window is not None :
+            self.committer = util.GroupCommit(self.flush_group, group_commit_window, group_commit_size)
+        self.logger.info("%r initialized", self)
+    def commit(self, records=None) :
+        """Commits the database to disk.  Without a journal, this is
+        done by first saving it to a temporary file and then copying
+        it over the old database file.
+
+        In journaled mode, 'records' (from Journal.encode) describe the
+        changes since the last commit, and they are appended to the
+        journal.  If they are not given, a checkpoint is made instead."""
+        if self.journal is None :
+            with self.lock.read_lock, self.snapshotlock :
+                self.logger.info("%r committing", self)
+                tmpfile = self.backingFile + ".tmp"
+                self.write_snapshot(tmpfile)
+                os.rename(tmpfile, self.backingFile)
+                self.logger.info("%r done committing", self)
+        elif records is None :
+            self.checkpoint()
+        else :
+            if records :
+                self.journal.append(records)
+            if self.journal.records >= self.checkpoint_interval :
+                self.checkpoint()
+    def flush_group(self) :
+        """Commits everything waiting for the group commit."""
+        if self.journal is None :
+            with self.lock.read_lock :
+                self.committer.take()
+                self.commit()
+        else :
+            # taking the records and appending them is atomic with
+            # respect to the journal so that rollback sees every record
+            # either in the journal or still pending
+            with self.journal.lock :
+                records = self.committer.take()
+                if records :
+                    self.journal.append(records)
+            if self.journal.records >= self.checkpoint_interval :
+                self.checkpoint()
+    def begin_commit(self, records) :
+        """Called by a writer which still holds the write lock, so that
+        changes are committed in the order they were made.  The result
+        is for end_commit."""
+        if self.committer is not None :
+            return self.committer.add(records)
+        if self.path_locks :
+            # a writer of one path cannot wait for a read lock on the
+            # whole database while holding its own lock, since another
+            # writer might be doing the same, so records go in the
+            # journal now and snapshots are written by end_commit
+            if self.journal is not None and records :
+                self.journal.append(records)
+            return None
+        self.lock.read_lock.acquire()
+        return records
+    def end_commit(self, pending) :
+        """Called by a writer after it has released the write lock to
+        finish committing its changes.  Returns the util.Ticket in
+        group commit mode."""
+        if self.committer is None :
+            if self.path_locks :
+                if self.journal is None :
+                    self.commit()
+                elif self.journal.records >= self.checkpoint_interval :
+                    self.checkpoint()
+                return None
+            try :
+                self.commit(pending)
+            finally :
+                self.lock.read_lock.release()
+            return None
+        if self.sync_commits :
+            pending.wait()
+        return pending
+    def sync(self) :
+        """Waits until every change made so far is durable."""
+        if self.committer is not None :
+            self.committer.sync()
+    def checkpoint(self) :
+        """Compacts the journal into the backing file.  A crash at any
+        point leaves enough on disk for rollback to recover."""
+        if self.committer is not None :
+            self.committer.flush_now(self.write_checkpoint)
+        else :
+            self.write_checkpoint()
+    def write_checkpoint(self) :
         with self.lock.read_lock :
-            self.logger.info("%r committing", self)
-            tmpfile = self.backingFile + ".tmp"
-            with open(tmpfile, "w") as f :
-                json.dump(self.data, f)
-            os.rename(tmpfile, self.backingFile)
-            self.logger.info("%r done committing", self)
+            with self.journal.lock :
+                if self.committer is not None :
+                    # changes waiting for a group commit are already in
+                    # memory, so the snapshot makes them durable
+                    self.committer.take()
+                self.logger.info("%r checkpointing", self)
+                tmpfile = self.backingFile + ".tmp"
+                self.write_snapshot(tmpfile)
+                oldjournal = self.journal.rotate()
+                os.rename(tmpfile, self.backingFile)
+                if os.path.isfile(oldjournal) :
+                    os.remove(oldjournal)
+                self.logger.info("%r done checkpointing", self)
+    def write_snapshot(self, filename) :
+        with open(filename, "wb") as f :
+            if self.binary :
+                # entries which were never decoded are copied as they are
+                storage.dump(self.data, f)
+            else :
+                self.ensure(self.data)
+                self.codec.dump(self.data, f)
+            if self.journal is not None :
+                f.flush()
+                os.fsync(f.fileno())
+    def recover_checkpoint(self) :
+        """Finishes or abandons a checkpoint which was interrupted.
+        The snapshot is completely written before the journal is
+        rotated, so if the old journal is still around the checkpoint
+        can be finished."""
+        tmpfile = self.backingFile + ".tmp"
+        oldjournal = self.journal.filename + ".old"
+        if os.path.isfile(oldjournal) :
+            self.logger.warn("%r finishing interrupted checkpoint", self)
+            if os.path.isfile(tmpfile) :
+                os.rename(tmpfile, self.backingFile)
+            os.remove(oldjournal)
+        elif os.path.isfile(tmpfile) :
+            os.remove(tmpfile)
     def rollback(self, warn=True) :
         """Updates the in-memory representation of the database to
-        what is stored on disk."""
+        what is stored on disk.  In group commit mode, changes waiting
+        to be committed are kept if there is a journal, and otherwise
+        they are dropped (and their tickets raise an exception)."""
         with self.lock.write_lock :
             if warn :
                 self.logger.warn("%r rolling back", self)
-            if os.path.isfile(self.backingFile) :
-                self.logger.info("%r rolling back from file", self)
-                # load the database if it exists
-                with open(self.backingFile) as f :
-                    self.data = json.load(f)
+            if self.journal is None :
+                if self.committer is not None :
+                    self.committer.discard(Exception("Rolled back before commit"))
+                self.load()
             else :
-                self.logger.info("%r rolling back to empty dictionary (no previous file)", self)
-                self.data = {}
+                with self.journal.lock :
+                    self.recover_checkpoint()
+                    self.load()
+                    prepare = lambda keys : self.ensure(self.data, keys[:1])
+                    n = self.journal.replay(self.data, prepare)
+                    self.logger.info("%r replayed %d journal records", self, n)
+                    if self.committer is not None :
+                        with self.committer.cond :
+                            self.journal.replay_records(self.data, self.committer.pending, prepare)
+            for index in self.indexes :
+                self.ensure(self.data, index.ckeys[:1])
+                index.build(self.data)
+            self.clock += 1
+            self.snapshot = Snapshot(self.data, {}, self.clock, self.clock)
+            if self.cache is not None :
+                self.cache.clear()
+            if self.committer is not None :
+                self.committer.reset()
             self.logger.info("%r rolled back", self)
-    def select(self, queryfunc, subpath=None) :
+    def close(self) :
+        """Makes every change durable, and stops the group commit
+        thread and the watches.  The database should not be used
+        afterwards."""
+        for w in self.feed.watches :
+            w.close()
+        try :
+            if self.committer is not None :
+                self.committer.close()
+        finally :
+            if self.journal is not None :
+                self.journal.close()
+    def check_writable(self) :
+        """Raises an exception if a group commit has failed since the
+        database was last rolled back.  What is in memory then has
+        changes which were not made durable, and changes made after
+        them could not be replayed from the journal without them."""
+        if self.committer is not None and self.committer.error is not None :
+            raise Exception("A commit failed (%r), so the database must be rolled back"
+                            % (self.committer.error,))
+    def load(self) :
+        self.lazy = False
+        if os.path.isfile(self.backingFile) :
+            self.logger.info("%r rolling back from file", self)
+            # load the database if it exists
+            if storage.is_binary(self.backingFile) :
+                self.data = storage.MappedFile(self.backingFile).root()
+                self.lazy = True
+            else :
+                with open(self.backingFile, "rb") as f :
+                    self.data = serialize.load(f)
+        else :
+            self.logger.info("%r rolling back to empty dictionary (no previous file)", self)
+            self.data = {}
+    def ensure(self, data, keys=None) :
+        """Decodes the top-level entries of 'data' at 'keys' (or every
+        one, if 'keys' is None) which have not been decoded yet, when
+        the database was loaded lazily.  Decoding an entry does not
+        change what it is, so this is done in place, even for readers."""
+        if not self.lazy :
+            return
+        with self.loadlock :
+            if keys is None :
+                keys = data.keys()
+            for k in keys :
+                v = data.get(k)
+                if type(v) is storage.Lazy :
+                    data[k] = v.load()
+    def readable(self, data, deps, subpath=None) :
+        """Returns the part of 'data' at 'subpath' for a query which
+        looks at the top-level entries in 'deps' (see
+        cache.Dependencies), decoding them first if they need it."""
+        if subpath is None :
+            self.ensure(data, None if deps is None or deps.everything else deps.keys)
+        return subdata(data, subpath)
+    def load_indexes(self) :
+        indexfile = self.backingFile + ".indexes"
+        if os.path.isfile(indexfile) :
+            with open(indexfile) as f :
+                self.indexes = [indexes.from_definition(d) for d in json.load(f)]
+    def save_indexes(self) :
+        indexfile = self.backingFile + ".indexes"
+        with open(indexfile + ".tmp", "w") as f :
+            json.dump([index.definition() for index in self.indexes], f)
+        os.rename(indexfile + ".tmp", indexfile)
+    def create_index(self, collection, field, kind="hash") :
+        """Makes an index on the dictionary or list at the path
+        'collection', keyed by the value at the path 'field' of each
+        entry.  Queries which go through the collection looking for
+        entries whose field is equal to something use the index
+        instead of looking at every entry.
+
+        If 'kind' is "ordered", the index keeps the entries sorted by
+        the field, and it is also used for queries which compare the
+        field with 'lt', 'le', 'gt' or 'ge' and for an OrderBy of the
+        collection by the field.
+
+        The entries of a list come from an index in the list's order,
+        like a scan gives them, but the entries of a dictionary (whose
+        order means nothing) come in no particular order, which may
+        differ from the order a scan gives."""
+        assert_type(collection, queries.Path)
+        assert_type(field, queries.Path)
+        if kind not in indexes.index_kinds :
+            raise Exception("Unknown index kind " + kind)
+        with self.lock.write_lock :
+            for index in self.indexes :
+                if (index.kind == kind and index.ckeys == tuple(collection)
+                    and index.fkeys == tuple(field)) :
+                    return index
+            index = indexes.index_kinds[kind](collection, field)
+            self.ensure(self.data, index.ckeys[:1])
+            index.build(self.data)
+            self.indexes = self.indexes + [index]
+            self.save_indexes()
+            self.plans = weakref.WeakKeyDictionary()
+            return index
+    def drop_index(self, collection, field, kind=None) :
+        """Removes the indexes made by create_index(collection, field)
+        (only the one of the given kind, if 'kind' is given)."""
+        with self.lock.write_lock :
+            self.indexes = [index for index in self.indexes
+                            if not (index.ckeys == tuple(collection) and index.fkeys == tuple(field)
+                                    and kind in (None, index.kind))]
+            self.save_indexes()
+            self.plans = weakref.WeakKeyDictionary()
+    def changed(self, data, changes) :
+        """Brings the indexes up to date with 'data' after the
+        primitive changes, whose keys are from the root of the
+        database."""
+        with self.mutex :
+            for index in self.indexes :
+                index.changed(data, changes)
+    def publish(self, data, changes, events=()) :
+        """Makes 'data', which is the result of the primitive changes,
+        what readers see, and gives the watches the events of the
+        changes (see watch.py).  Called with the write lock."""
+        with self.mutex :
+            if events :
+                self.feed.publish(events, data)
+            versions = self.snapshot.versions
+            if changes :
+                self.clock += 1
+                versions = dict(versions)
+                for op, keys, value in changes :
+                    versions[keys[0]] = self.clock
+                    if op == "rename" and len(keys) == 1 :
+                        versions[value] = self.clock
+            self.data = data
+            self.snapshot = Snapshot(data, versions, self.clock, self.snapshot.epoch)
+    def current(self) :
+        """Returns the Snapshot readers see.  If 'data' was replaced
+        other than by a writer (say, assigned and then committed), the
+        indexes are rebuilt and readers see the new data, as if the
+        database had been rolled back to it."""
+        snapshot = self.snapshot
+        if snapshot.data is self.data :
+            return snapshot
+        with self.mutex :
+            if self.snapshot.data is not self.data :
+                for index in self.indexes :
+                    self.ensure(self.data, index.ckeys[:1])
+                    index.build(self.data)
+                self.clock += 1
+                self.snapshot = Snapshot(self.data, {}, self.clock, self.clock)
+            return self.snapshot
+    def plan(self, queryfunc, subpath=None) :
+        """Returns the query function to run in place of 'queryfunc'
+        on the database restricted to 'subpath', which is rewritten by
+        the optimizer, uses the indexes where it can, runs simple
+        filters on chunks of results with numpy if it is installed
+        (see vectorize.py) and runs equality joins of two scans with
+        a hash table (see joins.py).  Plans are
+        cached for as long as the query function is around."""
+        rootkeys = tuple(subpath) if subpath is not None else ()
+        cached = self.plans.get(queryfunc)
+        if cached is None :
+            cached = self.plans.setdefault(queryfunc, {})
+        planned = cached.get(rootkeys)
+        if planned is None :
+            planned = indexes.plan(optimizer.optimize(queryfunc), self.indexes, rootkeys)
+            planned = joins.plan(vectorize.plan(planned))
+            cached[rootkeys] = planned
+        return planned
+    def explain(self, queryfunc, subpath=None) :
+        """Returns a description of how the query function would be
+        run by select (see optimizer.explain)."""
+        queryfunc = util.assert_type(queryfunc, queries.Func)
+        with self.lock.read_lock :
+            return optimizer.explain(self.plan(queryfunc, subpath))
+    def explain_analyze(self, queryfunc, subpath=None) :
+        """Runs the query function like select (without the cache), and
+        returns the plan it was run with, where each step says how many
+        times it ran, how many results it gave, and the time, fuel and
+        allocations it took (see analyze.py)."""
+        queryfunc = util.assert_type(queryfunc, queries.Func)
+        key, deps = self.query_key(queryfunc, subpath)
+        def _analyze() :
+            data = self.readable(self.current().data, deps, subpath)
+            return str(analyze.analyze(data, self.plan(queryfunc, subpath)))
+        if self.mvcc :
+            return _analyze()
+        with self.reading(deps, subpath) :
+            return _analyze()
+    def transaction(self, lockpath=None) :
+        """Returns a Transaction for making several changes which are
+        committed together, to be used in a 'with' statement.  With the
+        'path_locks' option, if 'lockpath' is given, the transaction
+        only locks (and may only change or select from) the part of
+        the database at that path."""
+        return Transaction(self, getattr(self.local, "transaction", None), lockpath)
+    def select(self, queryfunc, subpath=None, workers=None) :
         """Returns the results of the query function when given the
         database.  The database can be restricted using the 'subpath'
-        argument."""
+        argument.
+
+        If 'workers' is given, the outermost foreach of the query is
+        split across up to that many processes (see parallel.py),
+        which is worth it for long scans which do a lot with each
+        item."""
         queryfunc = util.assert_type(queryfunc, queries.Func)
-        with self.lock.read_lock :
-            data = self.data
-            if subpath is not None and assert_type(subpath, queries.Path) :
-                data = subpath.get(data)
-            return queries.select(data, queryfunc)
+        tx = getattr(self.local, "transaction", None)
+        if tx is not None :
+            return tx.select(queryfunc, subpath, workers)
+        if self.mvcc :
+            return self.select_from(self.current(), queryfunc, subpath, workers)
+        key, deps = self.query_key(queryfunc, subpath)
+        with self.reading(deps, subpath) :
+            return self.select_from(self.current(), queryfunc, subpath, workers)
+    def reading(self, deps, subpath=None) :
+        """Returns the lock to hold while running a query at 'subpath'
+        which looks at the top-level entries in 'deps' (see
+        cache.Dependencies)."""
+        if not self.path_locks :
+            return self.lock.read_lock
+        if subpath is not None :
+            return self.lock.hold([tuple(subpath)], "S")
+        if deps is None or deps.everything :
+            return self.lock.read_lock
+        return self.lock.hold([(k,) for k in deps.keys], "S")
+    def query_key(self, queryfunc, subpath=None) :
+        """Returns cache.query_key for the query function run at
+        'subpath', remembered for as long as the query function is
+        around."""
+        rootkeys = tuple(subpath) if subpath is not None else ()
+        keys = self.cachekeys.get(queryfunc)
+        if keys is None :
+            keys = self.cachekeys.setdefault(queryfunc, {})
+        if rootkeys not in keys :
+            keys[rootkeys] = cache.query_key(queryfunc, rootkeys)
+        return keys[rootkeys]
+    def select_from(self, snapshot, queryfunc, subpath=None, workers=None) :
+        key, deps = self.query_key(queryfunc, subpath)
+        data = self.readable(snapshot.data, deps, subpath)
+        def _select() :
+            planned = self.plan(queryfunc, subpath)
+            if workers is None :
+                return queries.select(data, planned)
+            return parallel.select(data, planned, workers)
+        if self.cache is None or key is None :
+            return _select()
+        stamp = snapshot.stamp(deps)
+        results = self.cache.get(key, stamp)
+        if results is None :
+            results = _select()
+            self.cache.put(key, stamp, results)
+        return results
+    def watch(self, path=None, callback=None, maxsize=1000) :
+        """Returns a watch.Watch of the changes to the part of the
+        database at 'path' (everything if it is None) made from now
+        on, which can be gone through to get each change as it is
+        made, or which calls callback(path, old, new) for each change.
+        Changes are seen once readers can see them, which might be
+        before they are on disk.  At most 'maxsize' changes wait to be
+        seen, and a change to an entry which has not been seen yet is
+        put together with the earlier one.  The watch should be closed
+        when it is no longer wanted."""
+        keys = list(assert_type(path, queries.Path)) if path is not None else []
+        return self.feed.watch(keys, maxsize, callback)
+    def select_iter(self, queryfunc, limit=None, offset=None, subpath=None, token=None) :
+        """Returns a Cursor over the results of the query function
+        which finds them as they are asked for, rather than all at
+        once like select.  The first 'offset' results are skipped, and
+        at most 'limit' are given.
+
+        If 'token' is a page token from Cursor.token, the results
+        continue from where that cursor left off (and 'offset' counts
+        from there).  That raises CursorExpired if the part of the
+        database the query looks at has changed since."""
+        queryfunc = util.assert_type(queryfunc, queries.Func)
+        position = 0
+        if token is not None :
+            position, stamp = decode_token(token)
+        position += offset or 0
+        snapshot = self.current()
+        key, deps = self.query_key(queryfunc, subpath)
+        cursor = Cursor(self, snapshot, snapshot.stamp(deps), deps,
+                        self.plan(queryfunc, subpath), subpath, position, limit)
+        if token is not None and cursor.stamp != stamp :
+            raise CursorExpired("the database changed since the page token was made")
+        return cursor
     def insert(self, path, o, append=False, overwrite=False, subpath=None) :
         """Insert an object into a given path.  The database can be
         restricted using the subpath parameter.
@@ -67,50 +574,31 @@ class Database(object) :
         overwritten.
 
         The database is committed to disk on success."""
-        if not check_type_is_ok(o) :
-            raise TypeError("Object contains database-unfriendly type.")
-        with self.lock.write_lock :
-            attachmentPoint = self.data
-            if subpath is not None and assert_type(subpath, queries.Path) :
-                attachmentPoint = subpath.get(attachmentPoint)
-            if path is None or (path.parent is None and path.key is None):
-                raise Exception("Cannot insert an object with None path")
-            elif path.parent is not None :
-                attachmentPoint = path.parent.get(attachmentPoint)
-            if append :
-                attachmentPoint = attachmentPoint.setdefault(path.key, [])
-                if type(attachmentPoint) is not list :
-                    raise Exception("Cannot append to non-list")
-                attachmentPoint.append(o)
-            else :
-                if path.key in attachmentPoint and not overwrite :
-                    raise Exception("Cannot insert object over another object")
-                attachmentPoint[path.key] = o
-                self.commit()
+        with self.transaction(concat(subpath, path)) as tx :
+            tx.insert(path, o, append=append, overwrite=overwrite, subpath=subpath)
+        return tx.ticket
+    def insert_many(self, items, append=False, overwrite=False, subpath=None) :
+        """Inserts each object in the list of (path, object) pairs
+        'items', like insert, but as one change to the database.  All
+        the objects are checked in one pass before anything is
+        inserted, and the indexes are brought up to date once at the
+        end."""
+        items = list(items)
+        lockpath = None
+        if items and all(path is not None for path, o in items) :
+            lockpath = common_prefix([list(path) for path, o in items])
+        with self.transaction(concat(subpath, lockpath)) as tx :
+            tx.insert_many(items, append=append, overwrite=overwrite, subpath=subpath)
+        return tx.ticket
     def remove(self, queryfunc, subpath=None) :
         """Remove from the database all entries returned by the given
         query function when applied to the database.  The database can
         be restricted using the 'subpath' parameter.
 
         The database is committed to disk on success."""
-        self.lock.write_lock.acquire()
-        try :
-            data = self.data
-            if subpath is not None and assert_type(subpath, queries.Path) :
-                data = subpath.get(data)
-            queries.remove(data, queryfunc)
-        except queries.InconsistentData :
-            self.rollback()
-            raise
-        except :
-            # no changes made
-            raise
-        else :
-            self.lock.read_lock.acquire()
-        finally :
-            self.lock.write_lock.release()
-        self.commit()
-        self.lock.read_lock.release()
+        with self.transaction(subpath) as tx :
+            tx.remove(queryfunc, subpath=subpath)
+        return tx.ticket
     def update(self, queryfunc, changes, subpath=None) :
         """Updates the database by running the query and then running
         each of the instructions in 'changes'.  The update can be
@@ -122,24 +610,319 @@ class Database(object) :
         of the results of running the queryfunc on the database, and
         that path in the object is updated to the result of the
         value."""
-        queryfunc = util.assert_type(queryfunc, queries.Func)
-        self.lock.write_lock.acquire()
-        try :
-            data = self.data
-            if subpath is not None and assert_type(subpath, queries.Path) :
-                data = subpath.get(data)
-            queries.update(data, queryfunc, changes)
-        except queries.InconsistentData :
-            self.rollback()
-            raise
-        except :
-            # no changes made
-            raise
-        else :
-            self.lock.read_lock.acquire()
-        finally :
-            self.lock.write_lock.release()
-        self.commit()
-        self.lock.read_lock.release()
+        with self.transaction(subpath) as tx :
+            tx.update(queryfunc, changes, subpath=subpath)
+        return tx.ticket
     def __repr__(self) :
         return "Database(%r)" % self.backingFile
+
+def concat(subpath, keys) :
+    """Returns the keys of 'subpath' followed by 'keys' (a Path or
+    list), or None if 'keys' is None."""
+    if keys is None :
+        return None
+    return (list(subpath) if subpath is not None else []) + list(keys)
+
+def common_prefix(keylists) :
+    """Returns the longest list of keys which each list in 'keylists'
+    starts with."""
+    prefix = keylists[0]
+    for keys in keylists[1:] :
+        n = 0
+        while n < len(prefix) and n < len(keys) and prefix[n] == keys[n] :
+            n += 1
+        prefix = prefix[:n]
+    return prefix
+
+def within(keys, lockpath) :
+    """Returns whether the path with the list of keys 'keys' is in the
+    part of the database at the tuple 'lockpath'."""
+    return tuple(keys[:len(lockpath)]) == lockpath
+
+def subdata(data, subpath=None) :
+    """Returns the part of 'data' at 'subpath'."""
+    if subpath is not None and assert_type(subpath, queries.Path) :
+        data = subpath.get(data)
+        if type(data) is storage.Lazy :
+            data = data.load()
+    return data
+
+class Snapshot(object) :
+    """What readers of a Database see: the data, and for the result
+    cache, the versions of its top-level entries.  A version is the
+    'clock' of the Database when the entry last changed, and entries
+    which have not changed since the Database was last rolled back, at
+    'epoch', are missing."""
+    def __init__(self, data, versions, clock, epoch) :
+        self.data = data
+        self.versions = versions
+        self.clock = clock
+        self.epoch = epoch
+    def stamp(self, deps) :
+        """Returns something which differs from the stamp of an earlier
+        snapshot if the parts of the database in 'deps' (see
+        cache.Dependencies, where None means everything) may have
+        changed in between."""
+        if deps is None or deps.everything :
+            return self.clock
+        return (self.epoch,) + tuple(self.versions.get(k, 0) for k in deps.keys)
+
+class Cursor(object) :
+    """The results of a query on a snapshot of a Database, which are
+    found as they are asked for (see Database.select_iter), either by
+    iterating over the cursor or with 'fetch'.
+
+    With the Database's 'mvcc' option the snapshot never changes.
+    Otherwise the snapshot is the data itself, and the cursor raises
+    CursorExpired when asked for more results after a change to the
+    part of the database the query looks at."""
+    batch = 100
+    def __init__(self, db, snapshot, stamp, deps, queryfunc, subpath, position, limit) :
+        self.db = db
+        self.snapshot = snapshot
+        self.stamp = stamp
+        self.deps = deps
+        self.queryfunc = queryfunc
+        self.subpath = subpath
+        # the number of results before the next one
+        self.position = position
+        self.remaining = limit
+        self.results = None
+        self.done = False
+    def __iter__(self) :
+        while True :
+            results = self.fetch(self.batch)
+            for r in results :
+                yield r
+            if len(results) < self.batch :
+                return
+    def fetch(self, n=None) :
+        """Returns a list of up to 'n' more results, or of every
+        remaining result if 'n' is None."""
+        if self.db.mvcc :
+            return self.take(n)
+        with self.db.reading(self.deps, self.subpath) :
+            if self.db.current().stamp(self.deps) != self.stamp :
+                raise CursorExpired("the database changed while the cursor was open")
+            return self.take(n)
+    def take(self, n) :
+        if self.remaining is not None :
+            n = self.remaining if n is None else min(n, self.remaining)
+        if self.done or n == 0 :
+            return []
+        if self.results is None :
+            data = self.db.readable(self.snapshot.data, self.deps, self.subpath)
+            self.results = queries.select_iter(data, self.queryfunc)
+            skipped = sum(1 for r in itertools.islice(self.results, self.position))
+            if skipped < self.position :
+                self.done = True
+                return []
+        results = list(itertools.islice(self.results, n))
+        self.position += len(results)
+        if self.remaining is not None :
+            self.remaining -= len(results)
+        if n is None or len(results) < n :
+            self.done = True
+        return results
+    def token(self) :
+        """Returns a page token which Database.select_iter can continue
+        from after the results given so far, or None if there are no
+        more."""
+        if self.done :
+            return None
+        return base64.urlsafe_b64encode(json.dumps([self.position, self.stamp]))
+    def close(self) :
+        """Lets go of the query, which is otherwise kept until the
+        cursor is garbage collected."""
+        self.results = None
+        self.done = True
+
+def decode_token(token) :
+    """Returns the position and stamp in a page token."""
+    try :
+        position, stamp = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError) :
+        raise ValueError("Malformed page token %r" % token)
+    if type(stamp) is list :
+        stamp = tuple(stamp)
+    return position, stamp
+
+class Transaction(object) :
+    """A group of changes to a Database which are made under one write
+    lock and committed together.  For instance,
+
+    with db.transaction() as tx :
+        tx.insert(path("users", "kmill"), {"username" : "kmill"})
+        tx.update(...)
+
+    If the 'with' block raises an exception, every change made in it
+    is undone using an in-memory undo log (or, with the Database's
+    'mvcc' option, the copies being changed are dropped).  Each
+    operation is undone by itself if it fails.  A transaction started
+    in a thread which is already in a transaction becomes part of the
+    outer one.
+
+    The indexes are brought up to date at the end of each operation.
+
+    With the Database's 'path_locks' option, a transaction with a
+    'lockpath' locks only that part of the database, and raises an
+    exception if it is asked to change or select from anything else."""
+    def __init__(self, db, parent=None, lockpath=None) :
+        self.db = db
+        self.parent = parent
+        if lockpath is not None and db.path_locks :
+            lockpath = tuple(lockpath) or None
+        else :
+            lockpath = None
+        if parent is not None :
+            if (lockpath is not None and parent.top.lockpath is not None
+                and not within(lockpath, parent.top.lockpath)) :
+                raise Exception("Cannot go outside %r, which is all the transaction has locked"
+                                % (parent.top.lockpath,))
+            self.top = parent.top
+            self.records = parent.records
+            self.changes = parent.changes
+            self.events = parent.events
+            self.undolog = parent.undolog
+        else :
+            self.top = self
+            self.records = []
+            self.changes = []
+            self.events = []
+            self.indexed = 0
+            self.undolog = util.UndoLog()
+            # the version being changed and the copies made for it
+            self.data = None
+            self.owned = {}
+            self.lockpath = lockpath
+            if lockpath is None :
+                self.locked = db.lock.write_lock
+            else :
+                self.locked = db.lock.hold([lockpath], "X")
+        self.ticket = None
+    def __enter__(self) :
+        if self.parent is None :
+            self.locked.acquire()
+            try :
+                self.db.check_writable()
+            except :
+                self.locked.release()
+                raise
+            self.data = self.db.current().data
+        self.mark = (len(self.records), self.undolog.mark(), len(self.changes), len(self.events))
+        self.db.local.transaction = self
+        return self
+    def __exit__(self, type, value, traceback) :
+        self.db.local.transaction = self.parent
+        top = self.top
+        if type is not None :
+            data = top.data
+            if self.db.mvcc and self.parent is None :
+                data = self.db.data
+            else :
+                self.undolog.undo(self.mark[1])
+            del self.records[self.mark[0]:]
+            try :
+                # the indexes look at the data itself, so they can be
+                # brought back from the undone changes
+                self.db.changed(data, self.changes[self.mark[2]:])
+            finally :
+                del self.changes[self.mark[2]:]
+                del self.events[self.mark[3]:]
+                top.indexed = min(top.indexed, len(self.changes))
+                if self.parent is None :
+                    self.locked.release()
+            return False
+        if top.indexed < len(self.changes) :
+            self.db.changed(top.data, self.changes[top.indexed:])
+            top.indexed = len(self.changes)
+        if self.parent is None :
+            try :
+                self.db.publish(self.data, self.changes, self.events)
+                pending = self.db.begin_commit(self.records)
+            finally :
+                self.locked.release()
+            self.ticket = self.db.end_commit(pending)
+    def subdata(self, subpath=None) :
+        """Returns the part at 'subpath' of the version of the database
+        being changed."""
+        return subdata(self.top.data, subpath)
+    def applier(self, subpath=None) :
+        """Returns an 'apply' function for queries.update and
+        queries.remove which makes changes to the database restricted
+        to 'subpath' as part of this transaction."""
+        prefix = list(subpath) if subpath is not None else []
+        top = self.top
+        mvcc = self.db.mvcc
+        journal = self.db.journal
+        feed = self.db.feed
+        lockpath = top.lockpath
+        def apply(op, keys, value=None) :
+            keys = prefix + keys
+            if lockpath is not None :
+                self.check_locked(keys)
+                if op == "rename" :
+                    self.check_locked(keys[:-1] + [value])
+            self.db.ensure(top.data, keys[:1])
+            if mvcc :
+                top.data = util.own_path(top.data, op, keys, top.owned)
+            events = feed.events(top.data, op, keys, value) if feed.watches else None
+            self.undolog.apply(top.data, op, keys, value)
+            self.changes.append((op, keys, value))
+            if events :
+                self.events.extend(events)
+            if journal is not None :
+                self.records.append(journal.encode(op, keys, value))
+        return apply
+    def select(self, queryfunc, subpath=None, workers=None) :
+        """Like Database.select, seeing the changes made so far."""
+        queryfunc = util.assert_type(queryfunc, queries.Func)
+        data = self.readable(queryfunc, subpath)
+        if workers is None :
+            return queries.select(data, self.db.plan(queryfunc, subpath))
+        return parallel.select(data, self.db.plan(queryfunc, subpath), workers)
+    def readable(self, queryfunc, subpath=None) :
+        """Like Database.readable for the version of the database being
+        changed."""
+        if self.top.lockpath is not None :
+            self.check_locked(list(subpath) if subpath is not None else [])
+        key, deps = self.db.query_key(queryfunc, subpath)
+        return self.db.readable(self.top.data, deps, subpath)
+    def check_locked(self, keys) :
+        if not within(keys, self.top.lockpath) :
+            raise Exception("Cannot go outside %r, which is all the transaction has locked"
+                            % (self.top.lockpath,))
+    def insert(self, path, o, append=False, overwrite=False, subpath=None) :
+        """Like Database.insert, but part of the transaction."""
+        self.insert_many([(path, o)], append=append, overwrite=overwrite, subpath=subpath)
+    def insert_many(self, items, append=False, overwrite=False, subpath=None) :
+        """Like Database.insert_many, but part of the transaction."""
+        items = list(items)
+        if not util.check_type_is_ok([o for path, o in items]) :
+            raise TypeError("Object contains database-unfriendly type.")
+        prefix = list(subpath) if subpath is not None else []
+        with Transaction(self.db, self) :
+            apply = self.applier(subpath)
+            for path, o in items :
+                if path is None or (path.parent is None and path.key is None):
+                    raise Exception("Cannot insert an object with None path")
+                self.db.ensure(self.top.data, (prefix + list(path))[:1])
+                # with mvcc, each change may have copied the data
+                attachmentPoint = self.subdata(subpath)
+                if path.parent is not None :
+                    attachmentPoint = path.parent.get(attachmentPoint)
+                if not append and path.key in attachmentPoint and not overwrite :
+                    raise Exception("Cannot insert object over another object")
+                apply("append" if append else "set", list(path), o)
+    def remove(self, queryfunc, subpath=None) :
+        """Like Database.remove, but part of the transaction."""
+        queryfunc = util.assert_type(queryfunc, queries.Func)
+        with Transaction(self.db, self) :
+            data = self.readable(queryfunc, subpath)
+            queries.remove(data, self.db.plan(queryfunc, subpath), self.applier(subpath))
+    def update(self, queryfunc, changes, subpath=None) :
+        """Like Database.update, but part of the transaction."""
+        queryfunc = util.assert_type(queryfunc, queries.Func)
+        with Transaction(self.db, self) :
+            data = self.readable(queryfunc, subpath)
+            queries.update(data, self.db.plan(queryfunc, subpath), changes, self.applier(subpath))
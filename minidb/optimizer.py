@@ -0,0 +1,329 @@
+# optimizer.py
+# 2013 Kyle Miller
+# rewrites queries for the minidb into equivalent faster ones
+
+import joins
+import util
+from queries import (Func, ValueFunc, Bind, Union, Return, Require, OrderBy, Take, GroupBy, Get,
+                     Apply, Constant, Var, AsList, AsDict, First, Exists, AnyOf, AllOf, Aggregate,
+                     Op, Or, And, Do, UseJoin)
+
+def optimize(queryfunc, reorder=False) :
+    """Returns a query function which gives the same results as
+    'queryfunc', rewritten so that
+
+    - a 'require' in a chain of binds is moved up to just after the
+      bind of the last variable it uses (see hoist_requires),
+    - an Op, Or or And whose arguments are constants is replaced by
+      its value,
+    - Op("any", AsList(q)) and Op("all", AsList(q)) become AnyOf(q)
+      and AllOf(q), which stop at the first result which decides them,
+      and
+    - a 'let' whose variable is not used is dropped.
+
+    A 'require' is only moved, and a 'let' only dropped, where this
+    cannot change whether the query raises an exception, unless
+    'reorder' is true.  Then a moved 'require' might fail on data for
+    which the original query would not have looked at it, and a query
+    which would have failed on a dropped 'let' might not.  Either way,
+    the results AnyOf and AllOf skip are not checked for errors."""
+    query = optimize_query(queryfunc.query, reorder)
+    if query is queryfunc.query :
+        return queryfunc
+    return Func(queryfunc.var, query)
+
+def optimize_query(query, reorder=False) :
+    if isinstance(query, Do) :
+        query.buildQuery()
+        return optimize_query(query.query, reorder)
+    elif isinstance(query, Bind) :
+        return optimize_chain(query, reorder)
+    elif isinstance(query, Union) :
+        queries = [optimize_query(q, reorder) for q in query.queries]
+        if all(new is old for new, old in zip(queries, query.queries)) :
+            return query
+        return Union(*queries)
+    elif isinstance(query, Return) :
+        value = fold(query.value, reorder)
+        return query if value is query.value else Return(value)
+    elif isinstance(query, Require) :
+        value = fold(query.value, reorder)
+        return query if value is query.value else Require(value)
+    elif isinstance(query, OrderBy) :
+        source = optimize_query(query.query, reorder)
+        key = fold(query.key.value, reorder)
+        if source is query.query and key is query.key.value :
+            return query
+        return OrderBy(source, ValueFunc(query.key.var, key), query.reverse)
+    elif isinstance(query, Take) :
+        source = optimize_query(query.query, reorder)
+        return query if source is query.query else Take(query.n, source)
+    elif isinstance(query, UseJoin) :
+        source = optimize_query(query.query, reorder)
+        return query if source is query.query else UseJoin(query.kind, source)
+    elif isinstance(query, GroupBy) :
+        source = optimize_query(query.query, reorder)
+        return query if source is query.query else GroupBy(query.key, source, query.aggregate, query.value)
+    elif isinstance(query, Get) :
+        return fold(query, reorder)
+    else :
+        return query
+
+def optimize_chain(query, reorder=False) :
+    """Optimizes a chain of binds, Bind(q1, Func(v1, Bind(q2, ...))),
+    as a list of steps (v1, q1), (v2, q2), ... and a final query."""
+    steps = []
+    while isinstance(query, (Bind, Do)) :
+        if isinstance(query, Do) :
+            query.buildQuery()
+            query = query.query
+            continue
+        steps.append((query.func.var, optimize_query(query.query, reorder)))
+        query = query.func.query
+    last = optimize_query(query, reorder)
+    steps = [step for step in steps if not always_passes(step)]
+    steps = drop_dead_lets(hoist_requires(steps, reorder), last, reorder)
+    for var, q in reversed(steps) :
+        last = Bind(q, Func(var, last))
+    return last
+
+def always_passes(step) :
+    var, query = step
+    return (var is None and isinstance(query, Require)
+            and isinstance(query.value, Constant) and query.value.o)
+
+def is_filter(step) :
+    var, query = step
+    return var is None and isinstance(query, Require)
+
+def hoist_requires(steps, reorder=False) :
+    """Moves each 'require' to just after the step which binds the last
+    of the variables it uses, keeping the 'require's in order.  Unless
+    'reorder' is true, it is only moved past steps which are not
+    foreaches, and only when neither it nor they can raise an
+    exception there (see cannot_raise)."""
+    hoisted = []
+    for step in steps :
+        if not is_filter(step) :
+            hoisted.append(step)
+            continue
+        used = step[1].freevars()
+        if used is None :
+            hoisted.append(step)
+            continue
+        i = len(hoisted)
+        while i > 0 and hoisted[i - 1][0] not in used and (reorder or can_pass(hoisted, i - 1, step)) :
+            i -= 1
+        while i < len(hoisted) and is_filter(hoisted[i]) :
+            i += 1
+        hoisted.insert(i, step)
+    return hoisted
+
+def can_pass(steps, i, step) :
+    """Whether 'step' can be moved before steps[i] without changing
+    which rows raise an exception."""
+    var, query = steps[i]
+    if not isinstance(query, (Require, Return)) :
+        return False
+    seen = dereferenced(steps[:i])
+    return cannot_raise(query.value, seen) and cannot_raise(step[1].value, seen)
+
+def drop_dead_lets(steps, last, reorder=False) :
+    """Drops each 'let' whose variable is not used by the rest of the
+    chain, and each 'let' which binds no variable at all.  Unless
+    'reorder' is true, only those which cannot raise an exception are
+    dropped."""
+    live = last.freevars()
+    kept = []
+    for i in xrange(len(steps) - 1, -1, -1) :
+        var, query = steps[i]
+        if (isinstance(query, Return) and (var is None or (live is not None and var not in live))
+            and (reorder or cannot_raise(query.value, dereferenced(steps[:i])))) :
+            continue
+        kept.append((var, query))
+        if live is not None :
+            used = query.freevars()
+            live = None if used is None else (live - set([var])) | used
+    kept.reverse()
+    return kept
+
+def dereferenced(steps) :
+    """Returns the set of (var, keys) for the Gets which every row
+    which gets through the steps has had looked up, where the same
+    Get can then be looked up again without raising an exception."""
+    seen = set()
+    for var, query in steps :
+        if isinstance(query, (Require, Return)) :
+            looked_up(query.value, seen)
+        elif isinstance(query, Get) :
+            looked_up(query, seen)
+        if var is not None :
+            # what was looked up in an earlier binding means nothing now
+            seen = set(s for s in seen if s[0] != var)
+    return seen
+
+def looked_up(value, seen) :
+    """Adds to 'seen' the Gets evaluating 'value' always looks up."""
+    if isinstance(value, Get) :
+        keys = get_keys(value)
+        if keys is not None :
+            var, path = keys
+            for n in xrange(1, len(path) + 1) :
+                seen.add((var, path[:n]))
+        looked_up(value.source, seen)
+    elif isinstance(value, Op) :
+        for p in value.params :
+            looked_up(p, seen)
+    elif isinstance(value, (Or, And)) and value.params :
+        # only the first argument is always evaluated
+        looked_up(value.params[0], seen)
+
+def get_keys(value) :
+    """Returns the variable and keys a Get (of Gets) of a variable
+    looks up, or None."""
+    keys = ()
+    while isinstance(value, Get) :
+        keys = tuple(value.path) + keys
+        value = value.source
+    if isinstance(value, Var) :
+        return value.name, keys
+    return None
+
+# the operations which cannot raise an exception on any values
+safe_operations = set(["eq", "ne", "lt", "le", "gt", "ge"])
+
+def cannot_raise(value, seen) :
+    """Whether evaluating 'value' cannot raise an exception, given the
+    Gets in 'seen' (see dereferenced) which have already been looked
+    up."""
+    if isinstance(value, (Constant, Var)) :
+        return True
+    elif isinstance(value, Get) :
+        keys = get_keys(value)
+        return keys is not None and (not keys[1] or keys in seen)
+    elif isinstance(value, Op) :
+        return value.name in safe_operations and all(cannot_raise(p, seen) for p in value.params)
+    elif isinstance(value, (Or, And)) :
+        return all(cannot_raise(p, seen) for p in value.params)
+    return False
+
+def fold(value, reorder=False) :
+    """Returns 'value' with the parts which only depend on constants
+    replaced by constants."""
+    if isinstance(value, Op) :
+        if value.name in ("any", "all") and len(value.params) == 1 and isinstance(value.params[0], AsList) :
+            short = AnyOf if value.name == "any" else AllOf
+            return short(optimize_query(value.params[0].query, reorder))
+        params = [fold(p, reorder) for p in value.params]
+        if all(isinstance(p, Constant) for p in params) :
+            try :
+                result = value.op(*[p.o for p in params])
+            except Exception :
+                # the error is left for when the query is run
+                pass
+            else :
+                # mutable results are left alone so that each use gets
+                # its own copy
+                if type(result) in util.allowed_types :
+                    return Constant(result)
+        if all(new is old for new, old in zip(params, value.params)) :
+            return value
+        return Op(value.name, *params)
+    elif isinstance(value, (Or, And)) :
+        return fold_logical(value, reorder)
+    elif isinstance(value, Get) :
+        source = fold(value.source, reorder)
+        return value if source is value.source else Get(source, value.path)
+    elif isinstance(value, Apply) :
+        arg = fold(value.value, reorder)
+        body = fold(value.func.value, reorder)
+        if arg is value.value and body is value.func.value :
+            return value
+        return Apply(arg, ValueFunc(value.func.var, body))
+    elif isinstance(value, (AsList, AsDict, Exists, AnyOf, Aggregate)) :
+        query = optimize_query(value.query, reorder)
+        return value if query is value.query else type(value)(query)
+    elif isinstance(value, First) :
+        query = optimize_query(value.query, reorder)
+        default = fold(value.default, reorder)
+        if query is value.query and default is value.default :
+            return value
+        return First(query, default)
+    else :
+        return value
+
+def fold_logical(value, reorder=False) :
+    """Folds an Or or And, which gives the first of its arguments
+    which is true (respectively false), or else the last one."""
+    decisive = bool(isinstance(value, Or))
+    params = []
+    for p in (fold(p, reorder) for p in value.params) :
+        if isinstance(p, Constant) and bool(p.o) == decisive :
+            # nothing after a decisive constant is evaluated
+            params.append(p)
+            break
+        params.append(p)
+    # a constant which is not decisive is skipped unless it is last
+    params = [p for i, p in enumerate(params)
+              if not (isinstance(p, Constant) and bool(p.o) != decisive and i < len(params) - 1)]
+    if not params :
+        return Constant(not decisive)
+    if len(params) == 1 :
+        return params[0]
+    if len(params) == len(value.params) and all(new is old for new, old in zip(params, value.params)) :
+        return value
+    return type(value)(*params)
+
+def explain(queryfunc) :
+    """Returns a description of the query function, with one line per
+    step of each chain of binds."""
+    return "\n".join(["given %s :" % queryfunc.var] + explain_query(queryfunc.query, 1))
+
+def explain_query(query, depth) :
+    indent = "  " * depth
+    if isinstance(query, Do) :
+        query.buildQuery()
+        return explain_query(query.query, depth)
+    elif isinstance(query, Bind) :
+        lines = []
+        while isinstance(query, Bind) :
+            var, q = query.func.var, query.query
+            if isinstance(q, Require) :
+                lines.append("%srequire %r" % (indent, q.value))
+            elif isinstance(q, Return) and var is not None :
+                lines.append("%slet %s = %r" % (indent, var, q.value))
+            else :
+                lines.append("%sforeach %s in" % (indent, var if var is not None else "_"))
+                lines.extend(explain_query(q, depth + 1))
+            query = query.func.query
+        return lines + explain_query(query, depth)
+    elif isinstance(query, Union) :
+        lines = ["%sunion" % indent]
+        for q in query.queries :
+            lines.extend(explain_query(q, depth + 1))
+        return lines
+    elif isinstance(query, Return) :
+        return ["%sreturn %r" % (indent, query.value)]
+    elif isinstance(query, Require) :
+        return ["%srequire %r" % (indent, query.value)]
+    elif isinstance(query, OrderBy) :
+        return (["%sorder by %r%s" % (indent, query.key, " descending" if query.reverse else "")]
+                + explain_query(query.query, depth + 1))
+    elif isinstance(query, Take) :
+        return ["%stake %d" % (indent, query.n)] + explain_query(query.query, depth + 1)
+    elif isinstance(query, UseJoin) :
+        return ["%suse %s joins" % (indent, query.kind)] + explain_query(query.query, depth + 1)
+    elif isinstance(query, joins.HashJoin) :
+        return (["%shash join %s in" % (indent, query.lvar)] + explain_query(query.left, depth + 1)
+                + ["%swith %s in" % (indent, query.rvar)] + explain_query(query.right, depth + 1)
+                + ["%son %r == %r%s" % (indent, query.lkey, query.rkey,
+                                        " (always hashed)" if query.always else "")]
+                + explain_query(query.body, depth))
+    elif isinstance(query, GroupBy) :
+        return (["%sgroup by %r into %s%s" % (indent, query.key, query.aggregate.__name__.lower(),
+                                              " of %r" % query.value if query.value is not None else "")]
+                + explain_query(query.query, depth + 1))
+    elif isinstance(query, Get) :
+        return ["%sscan %r" % (indent, query)]
+    else :
+        return ["%s%r" % (indent, query)]
@@ -0,0 +1,172 @@
+# parallel.py
+# 2013 Kyle Miller
+# runs the outermost foreach of a query in several processes
+
+import cPickle
+import os
+import threading
+
+from queries import (Query, Bind, Require, Return, Do, UseJoin, Scope, Path, Fuel,
+                     needs_paths)
+from joins import HashJoin
+from vectorize import VectorScan
+import queries
+
+# The query's results are split at its outermost foreach: the
+# collection it goes through is found in this process, and then the
+# rest of the query is run on contiguous chunks of it in processes
+# forked for the query.  Forked processes share the data with this one
+# (the operating system copies pages only when they are written), so
+# nothing but the results are sent between processes, and they are
+# pickled back through a pipe.  The chunks' results are put together in
+# order, so they are the same as from queries.select.  The fuel left
+# after finding the collection is shared out evenly between the
+# processes, so the query cannot use more in all than it could in one
+# process (though a chunk which does more of the work than the others
+# can run out when the whole query would not have).
+#
+# A forked process has only the thread which forked it, and whatever
+# locks the other threads held stay held in it forever, so nothing is
+# forked while other threads are running (such as a Database's group
+# commit, a watch's callbacks, or the rpc server's), and the query is
+# run in this process instead.
+
+# the fewest items of the collection it is worth a process to go through
+min_chunk = 2000
+
+def select(data, queryfunc, workers) :
+    """Like queries.select, but with the outermost foreach of the query
+    function split across at most 'workers' processes.  Queries which
+    do not start with a foreach (or a VectorScan or HashJoin doing the
+    work of one), collections too small to be worth it, processes with
+    more than one thread, and systems without os.fork are run in this
+    process."""
+    split = splitter(queryfunc.query)
+    if (workers <= 1 or not hasattr(os, "fork") or split is None
+        or threading.active_count() > 1) :
+        return queries.select(data, queryfunc)
+    source, rebuild = split
+    given = Rows()
+    scope, slot = Scope().bind(queryfunc.var)
+    rows = source.compile_query(scope)
+    rest = rebuild(given).compile_query(scope)
+    frame = scope.frame()
+    if slot is not None :
+        frame[slot] = (Path() if needs_paths(queryfunc.query) else None, data)
+    fuel = Fuel()
+    items = list(rows(fuel, frame))
+    def _run(items) :
+        given.rows = items
+        return [v for p, v in rest(fuel, frame)]
+    workers = min(workers, len(items) // min_chunk)
+    if workers <= 1 :
+        return _run(items)
+    size = -(-len(items) // workers)
+    chunks = [items[i:i + size] for i in xrange(0, len(items), size)]
+    share = fuel.amount // len(chunks)
+    def _child(items) :
+        fuel.amount = share
+        return _run(items)
+    children = []
+    results = []
+    error = None
+    try :
+        for chunk in chunks :
+            children.append(fork(_child, chunk))
+        for child in children :
+            ok, value = child.wait()
+            if not ok :
+                error = error or value
+            elif error is None :
+                results.extend(value)
+    finally :
+        # every child is waited for, even if something went wrong
+        for child in children :
+            child.close()
+    if error is not None :
+        raise error
+    return results
+
+def splitter(query) :
+    """Returns (source, rebuild) for a query which goes through the
+    results of 'source', where rebuild(rows) is the query going through
+    'rows' instead, or None if the query cannot be split."""
+    if isinstance(query, Do) :
+        query.buildQuery()
+        return splitter(query.query)
+    elif isinstance(query, UseJoin) :
+        # only the planner looks at it
+        return splitter(query.query)
+    elif isinstance(query, Bind) and not isinstance(query.query, (Require, Return)) :
+        return query.query, lambda rows : Bind(rows, query.func)
+    elif isinstance(query, VectorScan) :
+        return query.query, lambda rows : VectorScan(rows, query.var, query.tests, query.value)
+    elif isinstance(query, HashJoin) :
+        return query.left, lambda rows : HashJoin(rows, query.lvar, query.right, query.rvar,
+                                                  query.lkey, query.rkey, query.body, query.always)
+    else :
+        return None
+
+class Rows(Query) :
+    """Gives 'rows', the results of a query found already, as (path,
+    value) pairs.  They may be set after the query is compiled."""
+    def __init__(self, rows=()) :
+        self.rows = rows
+    def execute(self, fuel, bindings) :
+        return iter(self.rows)
+    def freevars(self) :
+        return set()
+    def compile_query(self, scope) :
+        def _rows(fuel, frame) :
+            return iter(self.rows)
+        return _rows
+    def __repr__(self) :
+        return "Rows(<%d rows>)" % len(self.rows)
+
+class Child(object) :
+    """A forked process working out f(arg), which 'wait' returns as
+    (True, value), or (False, exception) if f raised one.  'close'
+    waits for the process to exit without the result."""
+    def __init__(self, pid, pipe) :
+        self.pid = pid
+        self.pipe = pipe
+        self.exited = False
+    def wait(self) :
+        pipe, self.pipe = self.pipe, None
+        try :
+            with os.fdopen(pipe, "rb") as f :
+                message = f.read()
+        finally :
+            self.close()
+        if not message :
+            return False, Exception("Worker process %d died" % self.pid)
+        return cPickle.loads(message)
+    def close(self) :
+        if self.pipe is not None :
+            # the child gets an error writing the result, and exits
+            os.close(self.pipe)
+            self.pipe = None
+        if not self.exited :
+            self.exited = True
+            os.waitpid(self.pid, 0)
+
+def fork(f, arg) :
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid != 0 :
+        os.close(w)
+        return Child(pid, r)
+    # the child: nothing may leave this block but os._exit
+    try :
+        os.close(r)
+        try :
+            message = cPickle.dumps((True, f(arg)), cPickle.HIGHEST_PROTOCOL)
+        except Exception as x :
+            try :
+                message = cPickle.dumps((False, x), cPickle.HIGHEST_PROTOCOL)
+            except Exception :
+                message = cPickle.dumps((False, Exception(repr(x))), cPickle.HIGHEST_PROTOCOL)
+        with os.fdopen(w, "wb") as f :
+            f.write(message)
+    finally :
+        os._exit(0)
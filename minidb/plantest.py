@@ -0,0 +1,288 @@
+# plantest.py
+# 2013 Kyle Miller
+# checks that queries run by the planner (with indexes) give what a
+# plain scan of the data gives
+
+import random
+
+from minidb import *
+import analyze
+import cache
+import optimizer
+import vectorize
+
+def same(a, b) :
+    """Whether two lists of results have the same results, in any
+    order."""
+    return sorted(map(repr, a)) == sorted(map(repr, b))
+
+def check(db, query, uses=None, inorder=True, workers=None) :
+    """Checks that db.select (with 'workers') gives what queries.select
+    on the data itself gives, and that the plan has a step named
+    'uses'.  Unless 'inorder' is true, the results may come in another
+    order (as they do from an index on a dictionary)."""
+    planned = db.plan(query)
+    if uses is not None :
+        assert uses in repr(planned), "%s not used in %r" % (uses, planned)
+    results = db.select(query, workers=workers)
+    expected = queries.select(db.data, query)
+    if inorder :
+        assert results == expected, "%r gave %r rather than %r" % (query, results, expected)
+    else :
+        assert same(results, expected), "%r gave %r rather than %r" % (query, results, expected)
+    return results
+
+def outcome(f) :
+    """Returns ("ok", what f returns) or ("error", the type of the
+    exception it raises)."""
+    try :
+        return ("ok", f())
+    except Exception as x :
+        return ("error", type(x))
+
+def fresh(filename, **options) :
+    for f in [filename, filename + ".journal", filename + ".indexes"] :
+        if os.path.isfile(f) :
+            os.remove(f)
+    return Database(filename, **options)
+
+if __name__=="__main__" :
+    from queries import *
+
+    def colored(coll, color) :
+        @queryfunc
+        def query(db) :
+            return (Do()
+                    .foreach(a, Get(db, *coll))
+                    .require(Op("eq", Get(a, "c"), color))
+                    .ret(a))
+        return query
+
+    @queryfunc
+    def big(db) :
+        return (Do()
+                .foreach(a, Get(db, "colors"))
+                .require(Op("gt", Get(a, "n"), 50))
+                .ret(Get(a, "n")))
+
+    db = fresh("plantest.db")
+    db.insert(path("colors"), {"x" : {"c" : "red", "n" : 1}, "y" : {"c" : "blue", "n" : 60},
+                               "z" : {"c" : 2, "n" : 99}})
+    db.create_index(path("colors"), path("c"))
+    db.create_index(path("colors"), path("n"), kind="ordered")
+    check(db, colored(["colors"], "red"), "Index", inorder=False)
+    check(db, big, "RangeScan", inorder=False)
+    db.insert(path("colors", "w"), {"c" : "red", "n" : 70})
+    db.remove(lambda db : Return(Get(db, "colors", "x")))
+    check(db, colored(["colors"], "red"), "Index", inorder=False)
+    check(db, big, "RangeScan", inorder=False)
+
+    # an index on a collection inside a list, which moves when an
+    # earlier entry of the list is removed
+    db.insert(path("groups"), [{"items" : [{"c" : "blue"}]},
+                               {"items" : [{"c" : "green"}]},
+                               {"items" : [{"c" : "red"}]}])
+    db.create_index(path("groups", 1, "items"), path("c"))
+    assert check(db, colored(["groups", 1, "items"], "red"), "Index") == []
+    db.remove(lambda db : Return(Get(db, "groups", 0)))
+    assert check(db, colored(["groups", 1, "items"], "red"), "Index") == [{"c" : "red"}]
+
+    # the entries of a list come from an index in the list's order
+    db.insert(path("nums"), [{"n" : (i * 37) % 100} for i in xrange(200)])
+    db.create_index(path("nums"), path("n"), kind="ordered")
+    @queryfunc
+    def bignums(db) :
+        return (Do()
+                .foreach(a, Get(db, "nums"))
+                .require(Op("ge", Get(a, "n"), 90))
+                .ret(a))
+    n = len(check(db, bignums, "RangeScan"))
+
+    # explain_analyze runs the plan, counting the rows of each step
+    text = db.explain_analyze(bignums)
+    assert "RangeScan" in text and "(rows=%d " % n in text.splitlines()[0], text
+    analyzed = analyze.analyze(db.data, bignums)
+    assert analyzed.results == queries.select(db.data, bignums)
+    assert "Require  (loops=200 rows=%d " % n in str(analyzed), analyzed
+
+    # the optimizer does not change whether a query raises an exception
+    # on data which is partly missing
+    db.insert(path("people"), {"p" : [{"x" : 1, "items" : [1, 2]}], "q" : [{"items" : []}],
+                               "r" : [{"x" : 2, "items" : [3]}], "s" : [{"x" : 1}],
+                               "t" : [{"items" : [5]}]})
+    def hoistable(coll) :
+        @queryfunc
+        def query(db) :
+            return (Do()
+                    .foreach(a, Get(db, "people", coll))
+                    .foreach(b, Get(a, "items"))
+                    .require(Op("eq", Get(a, "x"), 1))
+                    .ret(b))
+        return query
+    def dead(coll) :
+        @queryfunc
+        def query(db) :
+            return (Do()
+                    .foreach(a, Get(db, "people", coll))
+                    .let(b, Get(a, "x"))
+                    .ret(a))
+        return query
+    for coll in ["p", "q", "r", "s", "t"] :
+        for query in [hoistable(coll), dead(coll)] :
+            expected = outcome(lambda : queries.select(db.data, query))
+            assert outcome(lambda : queries.select(db.data, optimizer.optimize(query))) == expected
+            assert outcome(lambda : db.select(query)) == expected
+    assert outcome(lambda : db.select(hoistable("q"))) == ("ok", [])
+    assert outcome(lambda : db.select(dead("q")))[0] == "error"
+
+    # Take, First, Exists, AnyOf and AllOf stop at the results they
+    # need, so never divide by the zero at the end of the list
+    db.insert(path("divisors"), range(1, 1000) + [0])
+    def quotients(test=None) :
+        do = Do().foreach(a, Get(Var("db"), "divisors"))
+        if test is not None :
+            do = do.require(test)
+        return do.ret(Op("div", 1000, a))
+    for query, expected in [(Take(3, quotients()), [1000, 500, 333]),
+                            (Take(2, quotients(Op("lt", Op("div", 1000, a), 400))), [333, 250]),
+                            (Return(First(quotients())), [1000]),
+                            (Return(Exists(quotients())), [True]),
+                            (Return(AnyOf(quotients(Op("lt", Op("div", 1000, a), 100)))), [True]),
+                            (Return(AllOf(Do().foreach(a, Get(Var("db"), "divisors"))
+                                          .ret(Op("gt", Op("div", 1000, a), 500)))), [False])] :
+        query = Func("db", query)
+        assert check(db, query) == expected
+        assert cache.query_key(query)[0] is not None
+    assert outcome(lambda : db.select(Func("db", quotients()))) == ("error", ZeroDivisionError)
+
+    # aggregates and groups
+    db.insert(path("sales"), [{"who" : "abc"[i % 3], "amount" : i % 7} for i in xrange(100)])
+    amounts = Do().foreach(a, Get(Var("db"), "sales")).ret(Get(a, "amount"))
+    for aggregate, expected in [(Count, 100), (Sum, 295), (Min, 0), (Max, 6), (Avg, 2.95)] :
+        assert check(db, Func("db", Return(aggregate(amounts)))) == [expected]
+    bs = (Do().foreach(a, Get(Var("db"), "sales"))
+          .require(Op("eq", Get(a, "who"), "b")).ret(Get(a, "amount")))
+    assert check(db, Func("db", Return(Sum(bs)))) == [sum(i % 7 for i in xrange(1, 100, 3))]
+    totals = check(db, Func("db", GroupBy(ValueFunc(a, Get(a, "who")), Get(Var("db"), "sales"), "sum",
+                                          value=ValueFunc(a, Get(a, "amount")))))
+    assert totals == [{"key" : who, "value" : sum(i % 7 for i in xrange(j, 100, 3))}
+                      for j, who in enumerate("abc")]
+    counts = check(db, Func("db", GroupBy(ValueFunc(a, Get(a, "who")), Get(Var("db"), "sales"), Count)))
+    assert counts == [{"key" : "a", "value" : 34}, {"key" : "b", "value" : 33}, {"key" : "c", "value" : 33}]
+
+    # random changes to the indexed collections and the lists they are
+    # in, checking every indexed query after each one
+    rand = random.Random(1)
+    colors = ["red", "green", "blue", 2, None]
+    for step in xrange(300) :
+        kind = rand.randrange(6)
+        keys = sorted(db.data["colors"].keys())
+        if kind == 0 or not keys :
+            db.insert(path("colors", "k%d" % rand.randrange(40)),
+                      {"c" : rand.choice(colors), "n" : rand.randrange(100)}, overwrite=True)
+        elif kind == 1 :
+            k = rand.choice(keys)
+            db.remove(lambda db : Return(Get(db, "colors", k)))
+        elif kind == 2 :
+            k = rand.choice(keys)
+            db.update(lambda db : Return(Get(db, "colors", k)),
+                      [ToUpdate(Path(), lambda x : "k%d" % rand.randrange(40), newkey=True)])
+        elif kind == 3 :
+            k = rand.choice(keys)
+            db.insert(path("colors", k, "c"), rand.choice(colors), overwrite=True)
+        elif kind == 4 and len(db.data["groups"]) > 2 :
+            i = rand.randrange(len(db.data["groups"]))
+            db.remove(lambda db : Return(Get(db, "groups", i)))
+        else :
+            db.insert(path("groups"), {"items" : [{"c" : rand.choice(colors)}
+                                                  for i in xrange(rand.randrange(4))]},
+                      append=True)
+        for color in colors :
+            check(db, colored(["colors"], color), "Index", inorder=False)
+            check(db, colored(["groups", 1, "items"], color), "Index")
+        check(db, big, "RangeScan", inorder=False)
+
+    # simple filters of a list, which are run with numpy if it is
+    # installed
+    db.insert(path("xs"), [{"score" : i % 100, "f" : (i % 7) / 7.0} for i in xrange(5000)])
+    db.insert(path("xs"), {"score" : "high", "f" : 0.1}, append=True)
+    @queryfunc
+    def scored(db) :
+        return (Do()
+                .foreach(a, Get(db, "xs"))
+                .require(Op("gt", Get(a, "score"), 90))
+                .require(Op("lt", Get(a, "f"), 0.5))
+                .ret(a))
+    check(db, scored, "VectorScan" if vectorize.enabled else None)
+    # and only as much of the list is looked at as Take needs
+    @queryfunc
+    def first_scored(db) :
+        return Take(3, Do()
+                    .foreach(a, Get(db, "xs"))
+                    .require(Op("gt", Get(a, "score"), 90))
+                    .require(Op("lt", Get(a, "f"), 0.5))
+                    .ret(a))
+    assert check(db, first_scored) == queries.select(db.data, scored)[:3]
+    assert len(list(queries.select_iter(db.data, db.plan(first_scored), Fuel(500)))) == 3
+
+    # an equality join of two collections, also after a filter of the
+    # first which cannot be vectorized, and going through the first
+    # only as far as it needs to
+    db.insert(path("orders"), [{"user" : "u%d" % (i % 70), "amt" : i, "tags" : ["t%d" % (i % 3)]}
+                               for i in xrange(400)])
+    db.insert(path("users"), dict(("u%d" % i, {"name" : "u%d" % i, "age" : i}) for i in xrange(0, 70, 3)))
+    def joined(test=None) :
+        do = Do().foreach(a, Get(Var("db"), "orders"))
+        if test is not None :
+            do = do.require(test)
+        return (do.foreach(b, Get(Var("db"), "users"))
+                .require(Op("eq", Get(b, "name"), Get(a, "user")))
+                .ret(Op("add", Get(a, "amt"), Get(b, "age"))))
+    check(db, Func("db", joined()), "HashJoin")
+    check(db, Func("db", joined(Op("contains", Get(a, "tags"), "t1"))), "HashJoin")
+    first_joined = Func("db", Take(3, joined()))
+    assert check(db, first_joined, "HashJoin") == queries.select(db.data, Func("db", joined()))[:3]
+    assert len(list(queries.select_iter(db.data, db.plan(first_joined), Fuel(200)))) == 3
+    # and the second collection is not looked at when the first is
+    # empty
+    db.insert(path("empty"), [])
+    @queryfunc
+    def nothing(db) :
+        return UseJoin("hash", Do()
+                       .foreach(a, Get(db, "empty"))
+                       .foreach(b, Get(db, "missing"))
+                       .require(Op("eq", b, a))
+                       .ret(b))
+    assert check(db, nothing, "HashJoin") == []
+
+    # the outermost foreach split across processes, in order, whether
+    # it is run by a bind, a VectorScan or a HashJoin
+    db.insert(path("members"), [{"name" : "p%d" % i, "age" : i % 90} for i in xrange(100)])
+    @queryfunc
+    def doubled(db) :
+        return (Do()
+                .foreach(a, Get(db, "xs"))
+                .require(Op("ne", Get(a, "score"), 3))
+                .ret(Op("add", Get(a, "f"), Get(a, "f"))))
+    @queryfunc
+    def ages(db) :
+        return (Do()
+                .foreach(a, Get(db, "xs"))
+                .foreach(b, Get(db, "members"))
+                .require(Op("eq", Get(b, "age"), Get(a, "score")))
+                .ret(Get(b, "name")))
+    for query, uses in [(doubled, None), (scored, "VectorScan" if vectorize.enabled else None),
+                        (ages, "HashJoin")] :
+        assert check(db, query, uses, workers=3) == queries.select(db.data, query)
+    # but not while another thread is running
+    import threading
+    done = threading.Event()
+    thread = threading.Thread(target=done.wait)
+    thread.start()
+    check(db, doubled, workers=3)
+    done.set()
+    thread.join()
+
+    os.remove("plantest.db")
+    os.remove("plantest.db.indexes")
+    print "ok"
@@ -5,21 +5,30 @@
 import util
 from util import assert_type
 import itertools
+import weakref
 
 class InconsistentData(Exception) :
     pass
 
 def select(data, queryfunc) :
     """Selects everything from data which is returned by the query function."""
-    return [v for p, v in queryfunc.query.execute(Fuel(), Bindings(queryfunc.var, (Path(), data)))]
+    return [v for p, v in queryfunc.compile(paths=False)(Fuel(), data)]
 
-def remove(data, queryfunc) :
+def select_iter(data, queryfunc, fuel=None) :
+    """Like select, but returns an iterator which finds each result
+    when it is asked for.  The fuel is shared by all the results."""
+    return (v for p, v in queryfunc.compile(paths=False)(fuel or Fuel(), data))
+
+def remove(data, queryfunc, apply=None) :
     """Removes everything from 'data' which the query function returns from it.
 
     The data is untouched unless either the function returns
-    successfully or InconsistentData is raised."""
-    dbvar = queryfunc.var
-    query = queryfunc.query
+    successfully or InconsistentData is raised.
+
+    Each deletion is carried out by calling apply("del", keys) (see
+    util.apply_change), which by default deletes from 'data'."""
+    if apply is None :
+        apply = default_apply(data)
     paths = {}
     # paths will be an object which overlays all the deleted paths
     # on each other. Things that are deleted have a None at the
@@ -36,69 +45,84 @@ def remove(data, queryfunc) :
                 return parentPaths.setdefault(path.key, {})
         else :
             return None
-    for p, v in query.execute(Fuel(), Bindings(dbvar, (Path(), data))) :
+    for p, v in queryfunc.compile()(Fuel(), data) :
         if p is None :
             raise Exception("Cannot remove an element which did not come directly from the database.")
         addPath(p, True)
 
-    def removePaths(data, paths) :
+    def removePaths(data, paths, keys) :
         if paths is None :
             raise InconsistentData("Unexpected path removal.")
         if type(data) is dict :
             for k, subpath in paths.iteritems() :
                 if subpath is None :
-                    del data[k]
+                    apply("del", keys + [k])
                 else :
-                    removePaths(data[k], subpath)
+                    removePaths(data[k], subpath, keys + [k])
         else :
             todelete = []
             for k, subpath in paths.iteritems() :
                 if subpath is None :
                     todelete.append(int(k))
                 else :
-                    removePaths(data[k], subpath)
+                    removePaths(data[k], subpath, keys + [k])
             for i in reversed(sorted(todelete)) :
-                del data[i]
+                apply("del", keys + [i])
     try :
-        removePaths(data, paths)
+        removePaths(data, paths, [])
     except InconsistentData :
         raise
     except Exception as x :
         raise InconsistentData(str(x))
 
-def update(data, queryfunc, changes) :
-    rootbinding = Bindings(queryfunc.var, (Path(), data))
-    res = list(queryfunc.query.execute(Fuel(), rootbinding))
-    instructions = []
-    for p, v in res :
-        newdata = []
-        instructions.append(newdata)
-        for change in changes :
-            p2, v2 = change.valuefunc.value.eval(Fuel(), Bindings(change.valuefunc.var, (None, v), parent=rootbinding))
-            newdata.append(v2)
+def update(data, queryfunc, changes, apply=None) :
+    """Runs the query function on 'data' and then, for each result,
+    carries out each of the ToUpdate instructions in 'changes'.
+
+    The new values are all computed before anything is modified, as
+    the query goes, so that only the changes to make are kept rather
+    than the results too.  Each modification is carried out by calling
+    apply(op, keys, value) with a primitive change (see
+    util.apply_change), which by default modifies 'data'."""
+    if apply is None :
+        apply = default_apply(data)
+    # each value can see the database as well as the result
+    scope, rootslot = Scope().bind(queryfunc.var)
+    valuefuncs = []
+    for change in changes :
+        subscope, slot = scope.bind(change.valuefunc.var)
+        if change.append :
+            op = "append"
+        elif change.newkey :
+            op = "rename"
+        else :
+            op = "set"
+        valuefuncs.append((op, change.path, slot, change.valuefunc.value.compile_value(subscope)))
+    frame = scope.frame()
+    frame[rootslot] = (Path(), data)
+    todo = []
+    for p, v in queryfunc.compile()(Fuel(), data) :
+        for op, changepath, slot, value in valuefuncs :
+            if slot is not None :
+                frame[slot] = (None, v)
+            p2, v2 = value(Fuel(), frame)
+            keys = list(p.concat(changepath)) if p is not None else []
+            if not keys :
+                raise InconsistentData("Cannot insert an object with None path")
+            todo.append((op, keys, v2))
     try :
-        for (p, v), newdata in zip(res, instructions) :
-            for change, new in zip(changes, newdata) :
-                changepath = p.concat(change.path)
-                if changepath is None or (changepath.parent is None and changepath.key is None) :
-                    raise Exception("Cannot insert an object with None path")
-                attachmentPoint = data
-                if changepath.parent is not None :
-                    attachmentPoint = changepath.parent.get(attachmentPoint)
-                if change.append :
-                    attachmentPoint = attachmentPoint.setdefault(changepath.key, [])
-                    if type(attachmentPoint) is not list :
-                        raise Exception("Cannot append to non-list")
-                    attachmentPoint.append(new)
-                elif change.newkey :
-                    moved_data = change.path.get(v)
-                    del attachmentPoint[changepath.key]
-                    attachmentPoint[new] = moved_data
-                else :
-                    attachmentPoint[changepath.key] = new
+        for op, keys, new in todo :
+            apply(op, keys, new)
     except Exception as x :
         raise InconsistentData(repr(x))
 
+def default_apply(data) :
+    """Returns a function which applies primitive changes directly to
+    'data'."""
+    def _apply(op, keys, value=None) :
+        util.apply_change(data, op, keys, value)
+    return _apply
+
 class ToUpdate(object) :
     def __init__(self, path, valuefunc, append=False, newkey=False) :
         if append and newkey :
@@ -115,13 +139,20 @@ class Fuel(object) :
     """Represents some amount of fuel.  When the fuel runs out, it
     throws OutOfFuel.  The purpose is to limit queries somehow.  The
     default is an amount where a loop taking that many iterations
-    takes about a second."""
+    takes about a second.
+
+    Compiled queries do what 'consume' does inline rather than calling
+    it, since it happens for every result of every step."""
     def __init__(self, amount=10000000) :
         self.amount = amount
     def consume(self) :
         self.amount -= 1
         if self.amount <= 0 :
             raise OutOfFuel()
+    def consume_many(self, n) :
+        self.amount -= n
+        if self.amount <= 0 :
+            raise OutOfFuel()
 
 class Bindings(object) :
     def __init__(self, key=None, value=None, parent=None) :
@@ -145,10 +176,70 @@ class Bindings(object) :
             b = b.parent
         return repr(pairs)
 
+class Scope(object) :
+    """Compiled queries keep variables in a flat list, the frame,
+    rather than in Bindings.  A scope says which slot of the frame
+    holds each variable visible at some point in the query.  Every
+    binding of a variable gets its own slot, so the frame is allocated
+    once per run of the query."""
+    def __init__(self, slots=None, size=None) :
+        self.slots = slots or {}
+        self.size = size or [0]
+    def bind(self, name) :
+        """Returns a scope in which 'name' refers to a new slot, and
+        the slot.  If 'name' is None, nothing is bound."""
+        if name is None :
+            return self, None
+        slot = self.size[0]
+        self.size[0] += 1
+        slots = dict(self.slots)
+        slots[name] = slot
+        return Scope(slots, self.size), slot
+    def frame(self) :
+        return [None] * self.size[0]
+    def bindings(self, frame) :
+        """Returns Bindings with the variables in scope."""
+        bindings = Bindings()
+        for slot, name in sorted((slot, name) for name, slot in self.slots.iteritems()) :
+            bindings = bindings.extend(name, frame[slot])
+        return bindings
+
+def union_freevars(nodes) :
+    """Returns the union of the free variables of the nodes, or None
+    if any of them is not known."""
+    names = set()
+    for n in nodes :
+        fv = n.freevars()
+        if fv is None :
+            return None
+        names |= fv
+    return names
+
+def bound_freevars(outer, var, body) :
+    """Returns the free variables of 'outer' together with those of
+    'body' other than 'var', which it binds."""
+    fv = outer.freevars()
+    bodyfv = body.freevars()
+    if fv is None or bodyfv is None :
+        return None
+    return fv | (bodyfv - set([var]))
+
 class Query(object) :
     def execute(self, fuel, bindings) :
         """Returns [(path, data)]"""
         raise Exception("Unimplemented")
+    def freevars(self) :
+        """Returns the set of names of the variables which the query
+        uses but does not bind, or None if that is not known."""
+        return None
+    def compile_query(self, scope) :
+        """Returns a function of a fuel and a frame (see Scope) which
+        behaves like 'execute'.  Queries which have nothing better fall
+        back to 'execute' itself."""
+        execute = self.execute
+        def _execute(fuel, frame) :
+            return execute(fuel, scope.bindings(frame))
+        return _execute
     def __ge__(self, other) :
         if isinstance(other, Func) :
             return Bind(self, other)
@@ -169,6 +260,17 @@ class Value(object) :
     def eval(self, fuel, bindings) :
         """Returns (path, data)."""
         raise NotImplemented()
+    def freevars(self) :
+        """Returns the set of names of the variables which the value
+        uses but does not bind, or None if that is not known."""
+        return None
+    def compile_value(self, scope) :
+        """Returns a function of a fuel and a frame (see Scope) which
+        behaves like 'eval'."""
+        ev = self.eval
+        def _eval(fuel, frame) :
+            return ev(fuel, scope.bindings(frame))
+        return _eval
 
 @util.add_assert_type_coercion(Value)
 def coerce_basic_types_to_constant(v) :
@@ -206,6 +308,27 @@ class Apply(Value) :
         if self.func.var is not None :
             subbindings = bindings.extend(self.func.var, v)
         return self.func.value.eval(fuel, subbindings)
+    def freevars(self) :
+        return bound_freevars(self.value, self.func.var, self.func.value)
+    def compile_value(self, scope) :
+        value = self.value.compile_value(scope)
+        subscope, slot = scope.bind(self.func.var)
+        body = self.func.value.compile_value(subscope)
+        if slot is None :
+            def _apply(fuel, frame) :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise OutOfFuel()
+                value(fuel, frame)
+                return body(fuel, frame)
+        else :
+            def _apply(fuel, frame) :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise OutOfFuel()
+                frame[slot] = value(fuel, frame)
+                return body(fuel, frame)
+        return _apply
 
 class Get(Query, Value) :
     def __init__(self, source, *pathparts) :
@@ -217,9 +340,10 @@ class Get(Query, Value) :
     def execute(self, fuel, bindings) :
         path = self.path
         pathprime, data = self.source.eval(fuel, bindings)
+        base = pathprime.concat(path) if pathprime is not None else None
         def makepath(k) :
-            if pathprime is not None :
-                return pathprime.concat(path)[k]
+            if base is not None :
+                return base[k]
             else :
                 return None
         source = path.get(data)
@@ -232,6 +356,41 @@ class Get(Query, Value) :
         itspath, value = self.source.eval(fuel, bindings)
         value = path.get(value)
         return (itspath.concat(path) if itspath is not None else None, value)
+    def freevars(self) :
+        return self.source.freevars()
+    def compile_query(self, scope) :
+        path = self.path
+        source = self.source.compile_value(scope)
+        def _get(fuel, frame) :
+            pathprime, data = source(fuel, frame)
+            data = path.get(data)
+            if pathprime is None :
+                if type(data) is dict :
+                    return ((None, v) for v in data.itervalues())
+                else :
+                    return ((None, v) for v in data)
+            base = pathprime.concat(path)
+            if type(data) is dict :
+                return ((base[k], v) for k, v in data.iteritems())
+            else :
+                return ((base[i], v) for i, v in enumerate(data))
+        return _get
+    def compile_value(self, scope) :
+        path = self.path
+        keys = tuple(path)
+        source = self.source.compile_value(scope)
+        def _get(fuel, frame) :
+            itspath, value = source(fuel, frame)
+            try :
+                for k in keys :
+                    value = value[k]
+            except KeyError :
+                raise KeyError(path)
+            if itspath is not None :
+                for k in keys :
+                    itspath = Path(k, itspath)
+            return (itspath, value)
+        return _get
     def __repr__(self) :
         return "Get(%r, %r)" % (self.source, self.path)
 
@@ -241,6 +400,30 @@ class Func(object) :
         if isinstance(var, Var) :
             self.var = var.name
         self.query = assert_type(query, Query)
+        self.compiled = {}
+    def compile(self, paths=True) :
+        """Returns a function of a fuel and some data which gives the
+        results of the query function on the data, like 'execute'.
+        The function is cached.
+
+        If 'paths' is false, the paths of the results (which say where
+        in the data they came from) are None rather than being made
+        for every result, unless the query needs them (see
+        needs_paths)."""
+        if not paths and needs_paths(self.query) :
+            paths = True
+        compiled = self.compiled.get(paths)
+        if compiled is None :
+            scope, slot = Scope().bind(self.var)
+            query = self.query.compile_query(scope)
+            root = Path() if paths else None
+            def _func(fuel, data) :
+                frame = scope.frame()
+                if slot is not None :
+                    frame[slot] = (root, data)
+                return query(fuel, frame)
+            compiled = self.compiled.setdefault(paths, _func)
+        return compiled
     def __call__(self, arg) :
         return Bind(Return(arg), self)
     def __repr__(self) :
@@ -268,6 +451,71 @@ class Bind(Query) :
             for r2 in funcquery.execute(fuel, subbindings) :
                 fuel.consume()
                 yield r2
+    def freevars(self) :
+        return bound_freevars(self.query, self.func.var, self.func.query)
+    def compile_query(self, scope) :
+        funcquery = self.func.query
+        subscope, slot = scope.bind(self.func.var)
+        body = funcquery.compile_query(subscope)
+        if isinstance(self.query, Require) :
+            # a filter
+            test = self.query.value.compile_value(scope)
+            def _require(fuel, frame) :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise OutOfFuel()
+                if test(fuel, frame)[1] :
+                    return body(fuel, frame)
+                else :
+                    return ()
+            return _require
+        if isinstance(self.query, Return) :
+            # a 'let'
+            value = self.query.value.compile_value(scope)
+            if slot is None :
+                def _let(fuel, frame) :
+                    fuel.amount -= 1
+                    if fuel.amount <= 0 :
+                        raise OutOfFuel()
+                    value(fuel, frame)
+                    return body(fuel, frame)
+            else :
+                def _let(fuel, frame) :
+                    fuel.amount -= 1
+                    if fuel.amount <= 0 :
+                        raise OutOfFuel()
+                    frame[slot] = value(fuel, frame)
+                    return body(fuel, frame)
+            return _let
+        source = self.query.compile_query(scope)
+        if isinstance(funcquery, Return) and slot is not None :
+            value = funcquery.value.compile_value(subscope)
+            def _map(fuel, frame) :
+                for r in source(fuel, frame) :
+                    fuel.amount -= 1
+                    if fuel.amount <= 0 :
+                        raise OutOfFuel()
+                    frame[slot] = r
+                    yield value(fuel, frame)
+            return _map
+        if slot is None :
+            def _bind(fuel, frame) :
+                for r in source(fuel, frame) :
+                    fuel.amount -= 1
+                    if fuel.amount <= 0 :
+                        raise OutOfFuel()
+                    for r2 in body(fuel, frame) :
+                        yield r2
+        else :
+            def _bind(fuel, frame) :
+                for r in source(fuel, frame) :
+                    fuel.amount -= 1
+                    if fuel.amount <= 0 :
+                        raise OutOfFuel()
+                    frame[slot] = r
+                    for r2 in body(fuel, frame) :
+                        yield r2
+        return _bind
     def __repr__(self) :
         return "Bind(%r, %r)" % (self.query, self.func)
 
@@ -278,6 +526,15 @@ class Union(Query) :
         for q in self.queries :
             for r in q.execute(fuel, bindings) :
                 yield r
+    def freevars(self) :
+        return union_freevars(self.queries)
+    def compile_query(self, scope) :
+        queries = [q.compile_query(scope) for q in self.queries]
+        def _union(fuel, frame) :
+            for q in queries :
+                for r in q(fuel, frame) :
+                    yield r
+        return _union
     def __repr__(self) :
         return "Union(*%r)" % self.queries
 
@@ -286,6 +543,13 @@ class Return(Query) :
         self.value = assert_type(value, Value)
     def execute(self, fuel, bindings) :
         return [self.value.eval(fuel, bindings)]
+    def freevars(self) :
+        return self.value.freevars()
+    def compile_query(self, scope) :
+        value = self.value.compile_value(scope)
+        def _return(fuel, frame) :
+            return (value(fuel, frame),)
+        return _return
     def __repr__(self) :
         return "Return(%r)" % self.value
 
@@ -297,14 +561,112 @@ class Require(Query) :
             return [(None, ())]
         else :
             return []
+    def freevars(self) :
+        return self.value.freevars()
+    def compile_query(self, scope) :
+        test = self.value.compile_value(scope)
+        def _require(fuel, frame) :
+            if test(fuel, frame)[1] :
+                return ((None, ()),)
+            else :
+                return ()
+        return _require
     def __repr__(self) :
         return "Require(%r)" % self.value
 
+class OrderBy(Query) :
+    """Gives the results of 'query' sorted by the value of the
+    ValueFunc 'key' on each of them, largest first if 'reverse' is
+    true.  Results with equal keys keep their order.  With an ordered
+    index on the key, the results are streamed from the index instead
+    of being sorted (see indexes.py)."""
+    def __init__(self, query, key, reverse=False) :
+        self.query = assert_type(query, Query)
+        self.key = assert_type(key, ValueFunc)
+        self.reverse = reverse
+    def execute(self, fuel, bindings) :
+        var = self.key.var
+        decorated = []
+        for r in self.query.execute(fuel, bindings) :
+            fuel.consume()
+            subbindings = bindings
+            if var is not None :
+                subbindings = bindings.extend(var, r)
+            decorated.append((self.key.value.eval(fuel, subbindings)[1], r))
+        decorated.sort(key=lambda d : d[0], reverse=self.reverse)
+        return (r for k, r in decorated)
+    def freevars(self) :
+        return bound_freevars(self.query, self.key.var, self.key.value)
+    def compile_query(self, scope) :
+        source = self.query.compile_query(scope)
+        subscope, slot = scope.bind(self.key.var)
+        key = self.key.value.compile_value(subscope)
+        reverse = self.reverse
+        def _orderby(fuel, frame) :
+            decorated = []
+            for r in source(fuel, frame) :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise OutOfFuel()
+                if slot is not None :
+                    frame[slot] = r
+                decorated.append((key(fuel, frame)[1], r))
+            decorated.sort(key=lambda d : d[0], reverse=reverse)
+            return (r for k, r in decorated)
+        return _orderby
+    def __repr__(self) :
+        return "OrderBy(%r, %r, reverse=%r)" % (self.query, self.key, self.reverse)
+
+class UseJoin(Query) :
+    """Gives the results of 'query', telling the planner how to run
+    the joins in it (see joins.py): 'kind' is "hash" to always use a
+    hash join where one would work, or "nested" to never use one."""
+    kinds = ("hash", "nested")
+    def __init__(self, kind, query) :
+        if kind not in self.kinds :
+            raise Exception("The kind of join must be one of %s, not %r" % (", ".join(self.kinds), kind))
+        self.kind = kind
+        self.query = assert_type(query, Query)
+    def execute(self, fuel, bindings) :
+        return self.query.execute(fuel, bindings)
+    def freevars(self) :
+        return self.query.freevars()
+    def compile_query(self, scope) :
+        return self.query.compile_query(scope)
+    def __repr__(self) :
+        return "UseJoin(%r, %r)" % (self.kind, self.query)
+
+class Take(Query) :
+    """Gives the first 'n' results of 'query', which is not asked for
+    any more than that."""
+    def __init__(self, n, query) :
+        self.n = assert_type(n, (int, long))
+        self.query = assert_type(query, Query)
+    def execute(self, fuel, bindings) :
+        return itertools.islice(self.query.execute(fuel, bindings), self.n)
+    def freevars(self) :
+        return self.query.freevars()
+    def compile_query(self, scope) :
+        source = self.query.compile_query(scope)
+        n = self.n
+        def _take(fuel, frame) :
+            return itertools.islice(source(fuel, frame), n)
+        return _take
+    def __repr__(self) :
+        return "Take(%r, %r)" % (self.n, self.query)
+
 class Constant(Value) :
     def __init__(self, o) :
         self.o = o
     def eval(self, fuel, bindings) :
         return (None, self.o)
+    def freevars(self) :
+        return set()
+    def compile_value(self, scope) :
+        r = (None, self.o)
+        def _constant(fuel, frame) :
+            return r
+        return _constant
     def __repr__(self) :
         return "Constant(%r)" % self.o
 
@@ -313,6 +675,18 @@ class Var(Value) :
         self.name = assert_type(name, basestring)
     def eval(self, fuel, bindings) :
         return bindings[self.name]
+    def freevars(self) :
+        return set([self.name])
+    def compile_value(self, scope) :
+        name = self.name
+        slot = scope.slots.get(name)
+        if slot is None :
+            def _var(fuel, frame) :
+                raise KeyError(name)
+        else :
+            def _var(fuel, frame) :
+                return frame[slot]
+        return _var
     def __repr__(self) :
         return "Var(%r)" % self.name
 
@@ -324,6 +698,13 @@ class AsList(Value) :
         self.query = assert_type(query, Query)
     def eval(self, fuel, bindings) :
         return (None, [r[1] for r in self.query.execute(fuel, bindings)])
+    def freevars(self) :
+        return self.query.freevars()
+    def compile_value(self, scope) :
+        query = self.query.compile_query(scope)
+        def _aslist(fuel, frame) :
+            return (None, [r[1] for r in query(fuel, frame)])
+        return _aslist
     def __repr__(self) :
         return "AsList(%r)" % self.query
 
@@ -336,9 +717,272 @@ class AsDict(Value) :
                 return p
             return p.key
         return (None, dict((make_key(r[0]), r[1]) for r in self.query.execute(fuel, bindings)))
+    def freevars(self) :
+        return self.query.freevars()
+    def compile_value(self, scope) :
+        query = self.query.compile_query(scope)
+        def _asdict(fuel, frame) :
+            return (None, dict((p.key if p is not None else None, v) for p, v in query(fuel, frame)))
+        return _asdict
     def __repr__(self) :
         return "AsList(%r)" % self.query
 
+class First(Value) :
+    """The first result of 'query', or 'default' if there is none.
+    The rest of the results are never looked for."""
+    def __init__(self, query, default=None) :
+        self.query = assert_type(query, Query)
+        self.default = assert_type(default, Value)
+    def eval(self, fuel, bindings) :
+        for r in self.query.execute(fuel, bindings) :
+            return r
+        return self.default.eval(fuel, bindings)
+    def freevars(self) :
+        return union_freevars([self.query, self.default])
+    def compile_value(self, scope) :
+        query = self.query.compile_query(scope)
+        default = self.default.compile_value(scope)
+        def _first(fuel, frame) :
+            for r in query(fuel, frame) :
+                return r
+            return default(fuel, frame)
+        return _first
+    def __repr__(self) :
+        return "First(%r, %r)" % (self.query, self.default)
+
+class Exists(Value) :
+    """Whether 'query' has any results, stopping at the first one."""
+    def __init__(self, query) :
+        self.query = assert_type(query, Query)
+    def eval(self, fuel, bindings) :
+        for r in self.query.execute(fuel, bindings) :
+            return (None, True)
+        return (None, False)
+    def freevars(self) :
+        return self.query.freevars()
+    def compile_value(self, scope) :
+        query = self.query.compile_query(scope)
+        def _exists(fuel, frame) :
+            for r in query(fuel, frame) :
+                return (None, True)
+            return (None, False)
+        return _exists
+    def __repr__(self) :
+        return "Exists(%r)" % self.query
+
+class AnyOf(Value) :
+    """Whether any result of 'query' is true, like Op("any",
+    AsList(query)) but stopping at the first true one."""
+    decisive = True
+    def __init__(self, query) :
+        self.query = assert_type(query, Query)
+    def eval(self, fuel, bindings) :
+        decisive = self.decisive
+        for p, v in self.query.execute(fuel, bindings) :
+            if bool(v) == decisive :
+                return (None, decisive)
+        return (None, not decisive)
+    def freevars(self) :
+        return self.query.freevars()
+    def compile_value(self, scope) :
+        query = self.query.compile_query(scope)
+        decisive = self.decisive
+        def _anyof(fuel, frame) :
+            for p, v in query(fuel, frame) :
+                if bool(v) == decisive :
+                    return (None, decisive)
+            return (None, not decisive)
+        return _anyof
+    def __repr__(self) :
+        return "%s(%r)" % (type(self).__name__, self.query)
+
+class AllOf(AnyOf) :
+    """Whether every result of 'query' is true, like Op("all",
+    AsList(query)) but stopping at the first false one."""
+    decisive = False
+
+class Aggregate(Value) :
+    """A value computed from the results of 'query' in one pass,
+    without keeping them.  Subclasses say how with 'start', which gives
+    the state before any result, 'step', which gives the state after
+    one more result, and 'finish', which gives the value from the
+    state."""
+    def __init__(self, query) :
+        self.query = assert_type(query, Query)
+    def eval(self, fuel, bindings) :
+        step = self.step
+        state = self.start()
+        for p, v in self.query.execute(fuel, bindings) :
+            fuel.consume()
+            state = step(state, v)
+        return (None, self.finish(state))
+    def freevars(self) :
+        return self.query.freevars()
+    def compile_value(self, scope) :
+        query = self.query.compile_query(scope)
+        start, step, finish = self.start, self.step, self.finish
+        def _aggregate(fuel, frame) :
+            state = start()
+            for p, v in query(fuel, frame) :
+                fuel.amount -= 1
+                if fuel.amount <= 0 :
+                    raise OutOfFuel()
+                state = step(state, v)
+            return (None, finish(state))
+        return _aggregate
+    def __repr__(self) :
+        return "%s(%r)" % (type(self).__name__, self.query)
+
+class Count(Aggregate) :
+    """The number of results."""
+    @staticmethod
+    def start() :
+        return 0
+    @staticmethod
+    def step(n, v) :
+        return n + 1
+    @staticmethod
+    def finish(n) :
+        return n
+
+class Sum(Aggregate) :
+    """The sum of the results, which is 0 if there are none."""
+    @staticmethod
+    def start() :
+        return 0
+    @staticmethod
+    def step(total, v) :
+        return total + v
+    @staticmethod
+    def finish(total) :
+        return total
+
+class Min(Aggregate) :
+    """The least result, or None if there are none."""
+    @staticmethod
+    def start() :
+        return ()
+    @staticmethod
+    def step(state, v) :
+        if not state or v < state[0] :
+            return (v,)
+        return state
+    @staticmethod
+    def finish(state) :
+        return state[0] if state else None
+
+class Max(Min) :
+    """The greatest result, or None if there are none."""
+    @staticmethod
+    def step(state, v) :
+        if not state or v > state[0] :
+            return (v,)
+        return state
+
+class Avg(Aggregate) :
+    """The mean of the results, or None if there are none."""
+    @staticmethod
+    def start() :
+        return (0, 0)
+    @staticmethod
+    def step(state, v) :
+        return (state[0] + v, state[1] + 1)
+    @staticmethod
+    def finish(state) :
+        total, n = state
+        if n == 0 :
+            return None
+        return float(total) / n
+
+aggregates = {
+    "count" : Count,
+    "sum" : Sum,
+    "min" : Min,
+    "max" : Max,
+    "avg" : Avg,
+    }
+
+class GroupBy(Query) :
+    """Groups the results of 'query' by the value of the ValueFunc
+    'key' on each of them, and gives one {"key" : k, "value" : v}
+    per group, in the order the groups were first seen, where v is the
+    aggregate (an Aggregate subclass or its name in 'aggregates') of
+    the group's results.  If 'value' is given, it is a ValueFunc whose
+    value on each result is what is aggregated instead.
+
+    Only the state of each group's aggregate is kept.  The keys must be
+    strings, numbers, booleans or None."""
+    def __init__(self, key, query, aggregate, value=None) :
+        self.key = assert_type(key, ValueFunc)
+        self.query = assert_type(query, Query)
+        if isinstance(aggregate, basestring) :
+            if aggregate not in aggregates :
+                raise Exception("Unknown aggregate " + aggregate)
+            aggregate = aggregates[aggregate]
+        if not (isinstance(aggregate, type) and issubclass(aggregate, Aggregate)) :
+            raise TypeError("expecting an aggregate")
+        self.aggregate = aggregate
+        self.value = None if value is None else assert_type(value, ValueFunc)
+    def execute(self, fuel, bindings) :
+        def value(r) :
+            if self.value is None :
+                return r
+            subbindings = bindings
+            if self.value.var is not None :
+                subbindings = bindings.extend(self.value.var, r)
+            return self.value.value.eval(fuel, subbindings)
+        def key(r) :
+            subbindings = bindings
+            if self.key.var is not None :
+                subbindings = bindings.extend(self.key.var, r)
+            return self.key.value.eval(fuel, subbindings)
+        return self.group(fuel, self.query.execute(fuel, bindings), key, value)
+    def group(self, fuel, results, key, value) :
+        start, step, finish = self.aggregate.start, self.aggregate.step, self.aggregate.finish
+        states = {}
+        order = []
+        for r in results :
+            fuel.consume()
+            k = key(r)[1]
+            if type(k) not in util.allowed_types :
+                raise TypeError("GroupBy keys must be strings, numbers, booleans or None")
+            state = states.get(k, states)
+            if state is states :
+                order.append(k)
+                state = start()
+            states[k] = step(state, value(r)[1])
+        return ((None, {"key" : k, "value" : finish(states[k])}) for k in order)
+    def freevars(self) :
+        fv = bound_freevars(self.query, self.key.var, self.key.value)
+        if self.value is not None and fv is not None :
+            valuefv = self.value.value.freevars()
+            fv = None if valuefv is None else fv | (valuefv - set([self.value.var]))
+        return fv
+    def compile_query(self, scope) :
+        source = self.query.compile_query(scope)
+        keyscope, keyslot = scope.bind(self.key.var)
+        keyvalue = self.key.value.compile_value(keyscope)
+        valuevalue = None
+        if self.value is not None :
+            valuescope, valueslot = scope.bind(self.value.var)
+            valuevalue = self.value.value.compile_value(valuescope)
+        group = self.group
+        def _groupby(fuel, frame) :
+            def key(r) :
+                if keyslot is not None :
+                    frame[keyslot] = r
+                return keyvalue(fuel, frame)
+            def value(r) :
+                if valuevalue is None :
+                    return r
+                if valueslot is not None :
+                    frame[valueslot] = r
+                return valuevalue(fuel, frame)
+            return group(fuel, source(fuel, frame), key, value)
+        return _groupby
+    def __repr__(self) :
+        return "GroupBy(%r, %r, %r, value=%r)" % (self.key, self.query, self.aggregate.__name__, self.value)
+
 class Op(Value) :
     def __init__(self, name, *params) :
         if name not in util.allowed_operations :
@@ -349,6 +993,29 @@ class Op(Value) :
     def eval(self, fuel, bindings) :
         eparams = [p.eval(fuel, bindings)[1] for p in self.params]
         return (None, self.op(*eparams))
+    def freevars(self) :
+        return union_freevars(self.params)
+    def compile_value(self, scope) :
+        op = self.op
+        params = [p.compile_value(scope) for p in self.params]
+        if len(params) == 1 :
+            p1, = params
+            def _op(fuel, frame) :
+                return (None, op(p1(fuel, frame)[1]))
+        elif len(params) == 2 :
+            p1, p2 = params
+            if isinstance(self.params[1], Constant) :
+                # comparing against a constant is the usual case
+                c = self.params[1].o
+                def _op(fuel, frame) :
+                    return (None, op(p1(fuel, frame)[1], c))
+            else :
+                def _op(fuel, frame) :
+                    return (None, op(p1(fuel, frame)[1], p2(fuel, frame)[1]))
+        else :
+            def _op(fuel, frame) :
+                return (None, op(*[p(fuel, frame)[1] for p in params]))
+        return _op
     def __repr__(self) :
         return "Op(%r, *%r)" % (self.name, self.params)
 
@@ -365,12 +1032,24 @@ class Or(Value) :
             return (None, False)
         else :
             return r
+    def freevars(self) :
+        return union_freevars(self.params)
+    def compile_value(self, scope) :
+        params = [p.compile_value(scope) for p in self.params]
+        def _or(fuel, frame) :
+            r = (None, False)
+            for p in params :
+                r = p(fuel, frame)
+                if r[1] :
+                    return r
+            return r
+        return _or
     def __repr__(self) :
         return "Or(*%r)" % (self.params,)
 class And(Value) :
     def __init__(self, *params) :
         self.params = [assert_type(p, Value) for p in params]
-    def execute(self, fuel, bindings) :
+    def eval(self, fuel, bindings) :
         r = None
         for p in self.params :
             r = p.eval(fuel, bindings)
@@ -380,52 +1059,122 @@ class And(Value) :
             return (None, True)
         else :
             return r
+    def freevars(self) :
+        return union_freevars(self.params)
+    def compile_value(self, scope) :
+        params = [p.compile_value(scope) for p in self.params]
+        def _and(fuel, frame) :
+            r = (None, True)
+            for p in params :
+                r = p(fuel, frame)
+                if not r[1] :
+                    return r
+            return r
+        return _and
     def __repr__(self) :
         return "And(*%r)" % (self.params,)
 
 class Path(object) :
+    """A place in the database: the entry 'key' of the place 'parent',
+    or the root if both are None.  p[k] is the path of the entry k of
+    p, which is made without copying p.  The tuple of keys from the
+    root, 'keys', is found when it is first needed and kept, and paths
+    are equal (and hash the same) when their keys are."""
+    __slots__ = ["key", "parent", "keytuple", "hashcode", "__weakref__"]
     def __init__(self, key=None, parent=None) :
         self.key = key
         self.parent = parent
+        self.keytuple = None
+        self.hashcode = None
+    @property
+    def keys(self) :
+        keys = self.keytuple
+        if keys is None :
+            # the keys up to the nearest ancestor which knows its own
+            rest = []
+            p = self
+            while p is not None and p.keytuple is None :
+                if p.key is not None :
+                    rest.append(p.key)
+                p = p.parent
+            rest.reverse()
+            keys = self.keytuple = (p.keytuple if p is not None else ()) + tuple(rest)
+        return keys
     def get(self, o) :
-        if self.parent is not None :
-            o = self.parent.get(o)
-        if self.key is None :
-            return o
-        else :
-            try :
-                return o[self.key]
-            except KeyError, IndexError :
-                raise KeyError(self)
+        try :
+            for k in self.keys :
+                o = o[k]
+        except KeyError :
+            raise KeyError(self)
+        return o
     def concat(self, other) :
         if other is None :
             return self
         p = self
         for k in other :
-            p = p[k]
+            p = Path(k, p)
         return p
     def __getitem__(self, key) :
-        return Path(key, parent=self)
+        return Path(key, self)
     def __iter__(self) :
-        if self.parent is not None :
-            for k in self.parent :
-                yield k
-        if self.key is not None :
-            yield self.key
+        return iter(self.keys)
+    def __len__(self) :
+        return len(self.keys)
+    def __nonzero__(self) :
+        # a Path is true even if it is the root
+        return True
+    def __eq__(self, other) :
+        if self is other :
+            return True
+        if not isinstance(other, Path) :
+            return False
+        return hash(self) == hash(other) and self.keys == other.keys
+    def __ne__(self, other) :
+        return not self == other
+    def __hash__(self) :
+        if self.hashcode is None :
+            self.hashcode = hash(self.keys)
+        return self.hashcode
     def __repr__(self) :
-        if self.parent is None :
-            if self.key is None :
-                return "Path()"
-            else :
-                return "Path()[%r]" % self.key
-        else :
-            return "%r[%r]" % (self.parent, self.key)
+        return "Path()" + "".join("[%r]" % (k,) for k in self.keys)
+
+# the paths made by 'path', so that making the same one again gives
+# the one which already knows its keys and hash.  They are found by
+# their keys with the types of the keys (like cache.freeze), since,
+# say, path(1) and path(True) are equal but are not the same path.
+interned = weakref.WeakValueDictionary()
 
 def path(*keys) :
-    if len(keys) == 0 :
-        return Path()
-    else :
-        return Path(key=keys[-1], parent=path(*keys[:-1]))
+    typed = tuple((type(k), k) for k in keys)
+    try :
+        p = interned.get(typed)
+    except TypeError :
+        # an unhashable key, which will fail when it is used anyway
+        p = None
+    if p is None :
+        p = Path()
+        for k in keys :
+            p = Path(k, p)
+        p.keytuple = keys
+        try :
+            p = interned.setdefault(typed, p)
+        except TypeError :
+            pass
+    return p
+
+def needs_paths(node) :
+    """Returns whether the results of a query or value can depend on
+    the paths of the results of its parts, which they do when it has
+    an AsDict, whose keys come from the paths."""
+    if isinstance(node, AsDict) :
+        return True
+    if isinstance(node, (list, tuple)) :
+        return any(needs_paths(n) for n in node)
+    if isinstance(node, (Query, Value, Func, ValueFunc)) :
+        for attr, o in vars(node).iteritems() :
+            if attr != "compiled" and needs_paths(o) :
+                return True
+    return False
 
 class Do(Query) :
     """A pseudo-query which builds up a query using some nicer syntax.
@@ -472,6 +1221,12 @@ class Do(Query) :
         """Builds the query then executes it."""
         self.buildQuery()
         return self.query.execute(fuel, bindings)
+    def freevars(self) :
+        self.buildQuery()
+        return self.query.freevars()
+    def compile_query(self, scope) :
+        self.buildQuery()
+        return self.query.compile_query(scope)
     def __repr__(self) :
         self.buildQuery()
         return repr(self.query)
@@ -0,0 +1,270 @@
+# serialize.py
+# 2013 Kyle Miller
+# codecs for turning database values into strings, for files and rpc
+
+import json
+import struct
+
+from journal import json_key
+
+class Codec(object) :
+    """A way of turning a database value into a string and back.
+    Subclasses give 'encode' and 'decode', and, if they begin what they
+    encode with something which tells them apart from json, 'magic'."""
+    name = None
+    magic = None
+    def encode(self, o) :
+        raise NotImplementedError
+    def decode(self, s) :
+        raise NotImplementedError
+    def dump(self, o, f) :
+        f.write(self.encode(o))
+    def load(self, f) :
+        return self.decode(f.read())
+    def __repr__(self) :
+        return "<%s codec>" % self.name
+
+class JsonCodec(Codec) :
+    name = "json"
+    def encode(self, o) :
+        return json.dumps(o)
+    def decode(self, s) :
+        return json.loads(s)
+    def dump(self, o, f) :
+        json.dump(o, f)
+    def load(self, f) :
+        return json.load(f)
+
+# The binary codec writes 'magic' and then the value.  Each value
+# starts with one byte:
+#
+#   0x80-0xff      an integer from 0 to 127, that byte minus 0x80
+#   "n", "t", "f"  None, True and False
+#   "i"            a non-negative integer, as a varint
+#   "j"            a negative integer, as the varint of its negation
+#   "d"            a float, as an 8-byte little-endian double
+#   "s"            a string, as the varint of its length and utf-8
+#   "l"            a list, as the varint of its length and its entries
+#   "m"            a dictionary, as the varint of its size and then for
+#                  each entry its key and its value
+#
+# A varint is 7 bits per byte, least significant first, with the high
+# bit set on every byte but the last.  Each dictionary key is either
+# the varint of twice its length followed by its utf-8, the first time
+# it is seen, or the varint of one more than twice its place in the
+# list of keys seen so far.  Like with json, dictionary keys become
+# strings.
+
+double = struct.Struct("<d")
+frame = struct.Struct("<I")
+smallints = [chr(0x80 + i) for i in xrange(0x80)]
+onebyte = [chr(i) for i in xrange(0x80)]
+
+def varint(n) :
+    if n < 0x80 :
+        return onebyte[n]
+    parts = []
+    while n >= 0x80 :
+        parts.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    parts.append(chr(n))
+    return "".join(parts)
+
+class BinaryCodec(Codec) :
+    """A compact codec: numbers are varints or doubles rather than
+    text, and each dictionary key is written in full only once."""
+    name = "binary"
+    magic = "\x00MB\x01"
+    def encode(self, o) :
+        out = [self.magic]
+        write = out.append
+        keys = {}
+        # this is the slow part of the codec, so the common cases come
+        # first and lengths under 0x80 skip the call to varint
+        def _encode(o) :
+            t = type(o)
+            if t is unicode or t is str :
+                if t is unicode :
+                    o = o.encode("utf-8")
+                n = len(o)
+                write("s" + onebyte[n] if n < 0x80 else "s" + varint(n))
+                write(o)
+            elif t is dict :
+                n = len(o)
+                write("m" + onebyte[n] if n < 0x80 else "m" + varint(n))
+                for k, v in o.iteritems() :
+                    i = keys.get(k)
+                    if i is None and type(k) is not str :
+                        k = json_key(k)
+                        if type(k) is unicode :
+                            k = k.encode("utf-8")
+                        i = keys.get(k)
+                    if i is None :
+                        keys[k] = len(keys)
+                        n = 2 * len(k)
+                        write(onebyte[n] if n < 0x80 else varint(n))
+                        write(k)
+                    else :
+                        n = 2 * i + 1
+                        write(onebyte[n] if n < 0x80 else varint(n))
+                    _encode(v)
+            elif t is int or t is long :
+                if 0 <= o < 0x80 :
+                    write(smallints[o])
+                elif o >= 0 :
+                    write("i" + varint(o))
+                else :
+                    write("j" + varint(-o))
+            elif t is list or t is tuple :
+                n = len(o)
+                write("l" + onebyte[n] if n < 0x80 else "l" + varint(n))
+                for v in o :
+                    _encode(v)
+            elif t is float :
+                write("d" + double.pack(o))
+            elif o is None :
+                write("n")
+            elif t is bool :
+                write("t" if o else "f")
+            else :
+                raise TypeError("Cannot encode %r" % (o,))
+        _encode(o)
+        return "".join(out)
+    def decode(self, s) :
+        if not s.startswith(self.magic) :
+            raise ValueError("Not in the binary codec")
+        try :
+            o, pos = decode_value(s, len(self.magic))
+        except IndexError :
+            raise ValueError("Truncated data")
+        if pos != len(s) :
+            raise ValueError("Extra data after position %d" % pos)
+        return o
+
+def decode_value(s, pos) :
+    """Decodes the value of the binary codec at 'pos' in 's', returning
+    it and the position after it."""
+    keys = []
+    ordinal = ord
+    # as in encode, lengths under 0x80 are read without calling _varint
+    def _varint(pos) :
+        b = ordinal(s[pos])
+        if b < 0x80 :
+            return b, pos + 1
+        n = b & 0x7f
+        shift = 7
+        pos += 1
+        while True :
+            b = ordinal(s[pos])
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80 :
+                return n, pos
+            shift += 7
+    def _value(pos) :
+        tag = s[pos]
+        pos += 1
+        if tag >= "\x80" :
+            return ordinal(tag) - 0x80, pos
+        elif tag == "s" :
+            n = ordinal(s[pos])
+            if n < 0x80 :
+                pos += 1
+            else :
+                n, pos = _varint(pos)
+            end = pos + n
+            return s[pos:end].decode("utf-8"), end
+        elif tag == "m" :
+            d = {}
+            count, pos = _varint(pos)
+            for i in xrange(count) :
+                n = ordinal(s[pos])
+                if n < 0x80 :
+                    pos += 1
+                else :
+                    n, pos = _varint(pos)
+                if n & 1 :
+                    k = keys[n >> 1]
+                else :
+                    end = pos + (n >> 1)
+                    k = s[pos:end].decode("utf-8")
+                    keys.append(k)
+                    pos = end
+                d[k], pos = _value(pos)
+            return d, pos
+        elif tag == "l" :
+            count, pos = _varint(pos)
+            o = []
+            append = o.append
+            for i in xrange(count) :
+                v, pos = _value(pos)
+                append(v)
+            return o, pos
+        elif tag == "i" :
+            return _varint(pos)
+        elif tag == "j" :
+            n, pos = _varint(pos)
+            return -n, pos
+        elif tag == "d" :
+            return double.unpack_from(s, pos)[0], pos + double.size
+        elif tag == "n" :
+            return None, pos
+        elif tag == "t" :
+            return True, pos
+        elif tag == "f" :
+            return False, pos
+        raise ValueError("Bad tag %r at %d" % (tag, pos - 1))
+    return _value(pos)
+
+codecs = {
+    "json" : JsonCodec(),
+    "binary" : BinaryCodec(),
+    }
+
+def get_codec(codec) :
+    """Returns the Codec named 'codec' (or 'codec' itself if it is a
+    Codec)."""
+    if isinstance(codec, Codec) :
+        return codec
+    if codec not in codecs :
+        raise Exception("Unknown codec %s" % codec)
+    return codecs[codec]
+
+def detect(s) :
+    """Returns the Codec which encoded the string 's', which is json
+    unless it begins with the magic of another codec."""
+    for codec in codecs.itervalues() :
+        if codec.magic is not None and s.startswith(codec.magic) :
+            return codec
+    return codecs["json"]
+
+def load(f) :
+    """Returns the value in the file 'f', using the codec that wrote
+    it."""
+    start = f.read(max(len(c.magic) for c in codecs.itervalues() if c.magic is not None))
+    codec = detect(start)
+    if codec.name == "json" :
+        f.seek(0)
+        return codec.load(f)
+    return codec.decode(start + f.read())
+
+def write_frame(sock, s) :
+    """Sends the string 's' on the socket as one message of the rpc
+    server: a 4-byte little-endian length and then 's'."""
+    sock.sendall(frame.pack(len(s)))
+    sock.sendall(s)
+
+def read_frame(sock) :
+    """Returns the next message sent by write_frame on the socket."""
+    size, = frame.unpack(recv_exactly(sock, frame.size))
+    return recv_exactly(sock, size)
+
+def recv_exactly(sock, n) :
+    parts = []
+    while n > 0 :
+        part = sock.recv(n)
+        if not part :
+            raise EOFError("Connection closed in the middle of a message")
+        parts.append(part)
+        n -= len(part)
+    return "".join(parts)
@@ -0,0 +1,288 @@
+# shards.py
+# 2013 Kyle Miller
+# a minidb split across several databases, each with its own file and
+# lock
+
+import os
+import sys
+import threading
+import urllib
+import weakref
+
+import analyze
+import cache
+import indexes
+import joins
+import minidb
+import optimizer
+import parallel
+import queries
+import vectorize
+from util import assert_type
+
+class ShardedDatabase(object) :
+    def __init__(self, directory, shard_of=None, **options) :
+        """Opens the database stored in the directory 'directory',
+        where each top-level entry is in the shard named by
+        'shard_of(key)' (by default, each top-level entry is a shard
+        of its own).  'shard_of' must give the same name for a key
+        every time the database is opened, and the name must be a
+        string (a byte string is taken to be in utf-8).
+
+        Each shard is a Database with its own backing file, lock and
+        commits, opened with 'options' (see Database), so changes to
+        different shards do not wait for each other and are committed
+        in parallel.  Queries which look at several shards see all of
+        them together, but a change to several shards is committed to
+        each one separately, so a crash can leave some of them
+        changed."""
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory) :
+            os.makedirs(self.directory)
+        self.shard_of = shard_of if shard_of is not None else (lambda key : key)
+        self.options = options
+        self.mvcc = options.get("mvcc", False)
+        # for adding shards; self.shards is replaced rather than changed
+        self.lock = threading.Lock()
+        self.shards = {}
+        for filename in sorted(os.listdir(self.directory)) :
+            if filename.endswith(".db") :
+                name = urllib.unquote(filename[:-len(".db")]).decode("utf-8")
+                self.shards[name] = minidb.Database(self.filename(name), **options)
+        self.plans = weakref.WeakKeyDictionary()
+    def filename(self, name) :
+        return os.path.join(self.directory, urllib.quote(name.encode("utf-8"), safe="") + ".db")
+    def name_of(self, key) :
+        """Returns the name of the shard for the top-level entry 'key',
+        as unicode, like the names of the shards found on disk."""
+        name = self.shard_of(key)
+        if type(name) is str :
+            return name.decode("utf-8")
+        elif type(name) is unicode :
+            return name
+        raise TypeError("The shard name for %r must be a string, not %r" % (key, name))
+    def shard(self, key, create=False) :
+        """Returns the Database for the top-level entry 'key', which is
+        made if it does not exist yet and 'create' is true (and
+        otherwise is None)."""
+        name = self.name_of(key)
+        db = self.shards.get(name)
+        if db is None and create :
+            with self.lock :
+                db = self.shards.get(name)
+                if db is None :
+                    db = minidb.Database(self.filename(name), **self.options)
+                    # the backing file is how the shard is found again
+                    # (a journaled database only writes it at checkpoints)
+                    if not os.path.isfile(db.backingFile) :
+                        db.commit()
+                    shards = dict(self.shards)
+                    shards[name] = db
+                    self.shards = shards
+        return db
+    def involved(self, queryfunc) :
+        """Returns the shards the query function may look at, in the
+        order their locks are taken in (see 'locking_order'), and the
+        cache.Dependencies of the query function."""
+        shards = self.shards
+        key, deps = cache.query_key(queryfunc)
+        if deps is None or deps.everything :
+            names = sorted(shards)
+        else :
+            names = sorted(set(self.name_of(k) for k in deps.keys if self.name_of(k) in shards))
+        return locking_order(shards[name] for name in names), deps
+    def plan(self, queryfunc, dbs) :
+        """Like Database.plan for a query which looks at the shards
+        'dbs', using the indexes of all of them."""
+        allindexes = tuple(index for db in dbs for index in db.indexes)
+        cached = self.plans.get(queryfunc)
+        if cached is None :
+            cached = self.plans.setdefault(queryfunc, {})
+        planned = cached.get(allindexes)
+        if planned is None :
+            planned = indexes.plan(optimizer.optimize(queryfunc), list(allindexes))
+            planned = joins.plan(vectorize.plan(planned))
+            cached[allindexes] = planned
+        return planned
+    def explain(self, queryfunc, subpath=None) :
+        """Like Database.explain."""
+        queryfunc = assert_type(queryfunc, queries.Func)
+        if subpath is not None :
+            return self.subpath_shard(subpath).explain(queryfunc, subpath)
+        dbs, deps = self.involved(queryfunc)
+        return optimizer.explain(self.plan(queryfunc, dbs))
+    def subpath_shard(self, subpath, create=False) :
+        keys = list(assert_type(subpath, queries.Path))
+        if not keys :
+            raise Exception("The subpath of a sharded database must not be empty")
+        db = self.shard(keys[0], create)
+        if db is None :
+            raise KeyError(subpath)
+        return db
+    def select(self, queryfunc, subpath=None, workers=None) :
+        """Like Database.select.  A query on one shard (or at a
+        'subpath') is run by that shard.  Otherwise, the query sees
+        the top-level entries of the shards it looks at together, with
+        a read lock on each of them."""
+        return self.run(queryfunc, subpath, False, workers)
+    def explain_analyze(self, queryfunc, subpath=None) :
+        """Like Database.explain_analyze, running the query like
+        select does."""
+        return self.run(queryfunc, subpath, True)
+    def run(self, queryfunc, subpath, analyzing, workers=None) :
+        queryfunc = assert_type(queryfunc, queries.Func)
+        if subpath is not None :
+            db = self.subpath_shard(subpath)
+            if analyzing :
+                return db.explain_analyze(queryfunc, subpath)
+            return db.select(queryfunc, subpath, workers)
+        dbs, deps = self.involved(queryfunc)
+        if len(dbs) == 1 :
+            return dbs[0].explain_analyze(queryfunc) if analyzing else dbs[0].select(queryfunc, workers=workers)
+        locked = []
+        try :
+            if not self.mvcc :
+                for db in dbs :
+                    db.lock.read_lock.acquire()
+                    locked.append(db)
+            data = {}
+            for db in dbs :
+                data.update(db.readable(db.current().data, deps))
+            if analyzing :
+                return str(analyze.analyze(data, self.plan(queryfunc, dbs)))
+            if workers is not None :
+                return parallel.select(data, self.plan(queryfunc, dbs), workers)
+            return queries.select(data, self.plan(queryfunc, dbs))
+        finally :
+            for db in reversed(locked) :
+                db.lock.read_lock.release()
+    def write(self, dbs, f) :
+        """Calls f with a Transaction on each of the shards 'dbs' (in
+        locking order), and returns the Tickets of their commits.
+        If f raises an exception, every transaction is undone."""
+        txs = []
+        exc = (None, None, None)
+        try :
+            for db in dbs :
+                tx = db.transaction()
+                tx.__enter__()
+                txs.append(tx)
+            f(txs)
+        except :
+            exc = sys.exc_info()
+        for tx in reversed(txs) :
+            try :
+                tx.__exit__(*exc)
+            except :
+                if exc[0] is None :
+                    exc = sys.exc_info()
+        if exc[0] is not None :
+            raise exc[0], exc[1], exc[2]
+        return Tickets([tx.ticket for tx in txs])
+    def insert(self, path, o, append=False, overwrite=False, subpath=None) :
+        """Like Database.insert."""
+        return self.insert_many([(path, o)], append=append, overwrite=overwrite, subpath=subpath)
+    def insert_many(self, items, append=False, overwrite=False, subpath=None) :
+        """Like Database.insert_many.  The objects are inserted into
+        each shard as one change, but the shards are committed
+        separately."""
+        prefix = list(subpath) if subpath is not None else []
+        groups = {}
+        for path, o in items :
+            keys = prefix + list(path) if path is not None else prefix
+            if not keys :
+                raise Exception("Cannot insert an object with None path")
+            db = self.shard(keys[0], create=True)
+            groups.setdefault(db, []).append((path, o))
+        dbs = locking_order(groups)
+        def _insert(txs) :
+            for tx in txs :
+                tx.insert_many(groups[tx.db], append=append, overwrite=overwrite, subpath=subpath)
+        return self.write(dbs, _insert)
+    def change(self, queryfunc, subpath, run) :
+        """Calls run(data, queryfunc, apply) with transactions on the
+        shards the query function looks at, where 'data' has their
+        top-level entries together and 'apply' (see queries.update)
+        sends each change to the shard it is for."""
+        queryfunc = assert_type(queryfunc, queries.Func)
+        if subpath is not None :
+            db = self.subpath_shard(subpath)
+            def _run(txs) :
+                tx, = txs
+                run(tx.readable(queryfunc, subpath), db.plan(queryfunc, subpath), tx.applier(subpath))
+            return self.write([db], _run)
+        dbs, deps = self.involved(queryfunc)
+        def _run(txs) :
+            data = {}
+            appliers = {}
+            for tx in txs :
+                data.update(tx.readable(queryfunc))
+                appliers[tx.db] = tx.applier()
+            def apply(op, keys, value=None) :
+                db = self.shard(keys[0])
+                if db not in appliers :
+                    raise Exception("Cannot change %r, whose shard the query does not look at" % keys[0])
+                if op == "rename" and len(keys) == 1 and self.shard(value) is not db :
+                    raise Exception("Cannot move %r to another shard" % keys[0])
+                appliers[db](op, keys, value)
+            run(data, self.plan(queryfunc, dbs), apply)
+        return self.write(dbs, _run)
+    def remove(self, queryfunc, subpath=None) :
+        """Like Database.remove."""
+        return self.change(queryfunc, subpath, queries.remove)
+    def update(self, queryfunc, changes, subpath=None) :
+        """Like Database.update."""
+        def _update(data, queryfunc, apply) :
+            queries.update(data, queryfunc, changes, apply)
+        return self.change(queryfunc, subpath, _update)
+    def watch(self, path, callback=None, maxsize=1000) :
+        """Like Database.watch, on the shard with the entry at 'path',
+        which must not be empty."""
+        return self.subpath_shard(path, create=True).watch(path, callback, maxsize)
+    def create_index(self, collection, field, kind="hash") :
+        """Like Database.create_index, on the shard with the
+        collection."""
+        return self.subpath_shard(collection, create=True).create_index(collection, field, kind)
+    def drop_index(self, collection, field, kind=None) :
+        """Like Database.drop_index."""
+        db = self.shard(list(collection)[0])
+        if db is not None :
+            db.drop_index(collection, field, kind)
+    def rollback(self) :
+        """Rolls back every shard (see Database.rollback)."""
+        for name, db in sorted(self.shards.iteritems()) :
+            db.rollback()
+    def sync(self) :
+        """Waits until every change made so far is durable."""
+        for db in self.shards.values() :
+            db.sync()
+    def close(self) :
+        """Like Database.close, for every shard."""
+        errors = []
+        for db in self.shards.values() :
+            try :
+                db.close()
+            except Exception as x :
+                errors.append(x)
+        if errors :
+            raise errors[0]
+    def __repr__(self) :
+        return "ShardedDatabase(%r)" % self.directory
+
+def locking_order(dbs) :
+    """Returns the shards sorted by their files.  Locks on several
+    shards are always taken in this order so that two changes cannot
+    each wait for the other."""
+    return sorted(dbs, key=lambda db : db.backingFile)
+
+class Tickets(object) :
+    """The util.Ticket of a change to several shards, or None for
+    those which did not use group commit."""
+    def __init__(self, tickets) :
+        self.tickets = tickets
+    def done(self) :
+        return all(t is None or t.done() for t in self.tickets)
+    def wait(self) :
+        for t in self.tickets :
+            if t is not None :
+                t.wait()
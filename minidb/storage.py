@@ -0,0 +1,234 @@
+# storage.py
+# 2013 Kyle Miller
+# a binary file format for the minidb which is read lazily through mmap
+
+import mmap
+import struct
+import threading
+
+from journal import json_key
+
+# The file is 'magic' followed by the database, a dictionary.  Each
+# value starts with a one-byte tag:
+#
+#   "n", "t", "f"  None, True and False
+#   "i"            an integer, as a signed 8-byte number
+#   "l"            an integer too big for that, as a string
+#   "d"            a float, as an 8-byte double
+#   "s"            a string, as a 4-byte length and utf-8
+#   "D"            a dictionary: the 8-byte size of the whole value,
+#                  the 4-byte number of entries, and for each entry the
+#                  8-byte offsets of its key (a string) and its value,
+#                  sorted by key
+#   "L"            a list: the 8-byte size, the 4-byte number of
+#                  entries, and the 8-byte offset of each entry
+#
+# Offsets are from the tag of the dictionary or list, so the encoding
+# of a value does not depend on where it is, and dictionary keys are
+# strings, converted like json does.  All numbers are little-endian.
+
+magic = "MINIDB\x00\x01"
+
+header = struct.Struct("<QI")
+offset = struct.Struct("<Q")
+entry = struct.Struct("<QQ")
+length = struct.Struct("<I")
+integer = struct.Struct("<q")
+double = struct.Struct("<d")
+
+class StorageError(Exception) :
+    pass
+
+def dump(data, f) :
+    """Writes the database 'data' to the file 'f'.  Parts of it which
+    are still Lazy are copied from their file without being decoded."""
+    f.write(magic)
+    f.write(encode(data))
+
+def encode(o) :
+    """Returns the encoding of a database value."""
+    t = type(o)
+    if o is None :
+        return "n"
+    elif t is bool :
+        return "t" if o else "f"
+    elif t is int or t is long :
+        if -2 ** 63 <= o < 2 ** 63 :
+            return "i" + integer.pack(o)
+        digits = str(o)
+        return "l" + length.pack(len(digits)) + digits
+    elif t is float :
+        return "d" + double.pack(o)
+    elif t is str or t is unicode :
+        return encode_string(o)
+    elif t is dict :
+        items = sorted((utf8(json_key(k)), v) for k, v in o.iteritems())
+        parts = []
+        for k, v in items :
+            parts.append(encode_string(k))
+            parts.append(encode(v))
+        return container("D", len(items), parts, 2)
+    elif t is list :
+        return container("L", len(o), [encode(v) for v in o], 1)
+    elif t is Lazy :
+        return o.raw()
+    else :
+        raise TypeError("Cannot encode %r" % (o,))
+
+def encode_string(s) :
+    s = utf8(s)
+    return "s" + length.pack(len(s)) + s
+
+def utf8(s) :
+    return s.encode("utf-8") if type(s) is unicode else s
+
+def container(tag, count, parts, perentry) :
+    """Returns the encoding of a dictionary or list whose entries are
+    encoded as 'parts', 'perentry' parts for each entry."""
+    start = 1 + header.size + count * perentry * offset.size
+    offsets = []
+    pos = start
+    for p in parts :
+        offsets.append(pos)
+        pos += len(p)
+    table = struct.pack("<%dQ" % len(offsets), *offsets)
+    return "".join([tag, header.pack(pos, count), table] + parts)
+
+class MappedFile(object) :
+    """A database file in this format, mapped into memory.  Values are
+    decoded when they are asked for, and each dictionary and list is
+    decoded at most once."""
+    def __init__(self, filename) :
+        with open(filename, "rb") as f :
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(magic)] != magic :
+            raise StorageError("%s is not a minidb binary file" % filename)
+        self.lock = threading.RLock()
+        self.decoded = {}
+    def root(self) :
+        """Returns the database as a dictionary whose dictionaries and
+        lists are Lazy."""
+        pos = len(magic)
+        if self.map[pos] != "D" :
+            raise StorageError("The database is not a dictionary")
+        return dict(self.entries(pos))
+    def entries(self, pos) :
+        """Gives the (key, value) pairs of the dictionary or list at
+        'pos', where the values which are dictionaries or lists are
+        Lazy."""
+        size, count = header.unpack_from(self.map, pos + 1)
+        table = pos + 1 + header.size
+        if self.map[pos] == "D" :
+            for i in xrange(count) :
+                k, v = entry.unpack_from(self.map, table + i * entry.size)
+                yield self.value(pos + k), self.value(pos + v)
+        else :
+            for i in xrange(count) :
+                v, = offset.unpack_from(self.map, table + i * offset.size)
+                yield i, self.value(pos + v)
+    def value(self, pos) :
+        """Returns the value at 'pos', which is Lazy if it is a
+        dictionary or list."""
+        tag = self.map[pos]
+        if tag == "D" or tag == "L" :
+            return Lazy(self, pos)
+        elif tag == "s" :
+            n, = length.unpack_from(self.map, pos + 1)
+            start = pos + 1 + length.size
+            return self.map[start:start + n].decode("utf-8")
+        elif tag == "i" :
+            return integer.unpack_from(self.map, pos + 1)[0]
+        elif tag == "d" :
+            return double.unpack_from(self.map, pos + 1)[0]
+        elif tag == "n" :
+            return None
+        elif tag == "t" :
+            return True
+        elif tag == "f" :
+            return False
+        elif tag == "l" :
+            n, = length.unpack_from(self.map, pos + 1)
+            start = pos + 1 + length.size
+            return int(self.map[start:start + n])
+        raise StorageError("Bad tag %r at %d" % (tag, pos))
+    def decode(self, pos) :
+        """Returns the dictionary or list at 'pos', decoded
+        completely."""
+        with self.lock :
+            o = self.decoded.get(pos)
+            if o is None :
+                if self.map[pos] == "D" :
+                    o = dict((k, v.load() if type(v) is Lazy else v) for k, v in self.entries(pos))
+                else :
+                    o = [v.load() if type(v) is Lazy else v for k, v in self.entries(pos)]
+                self.decoded[pos] = o
+            return o
+    def lookup(self, pos, key) :
+        """Returns the entry at 'key' of the dictionary or list at
+        'pos' like 'value' does, decoding only what it needs to find
+        it."""
+        size, count = header.unpack_from(self.map, pos + 1)
+        table = pos + 1 + header.size
+        if self.map[pos] == "L" :
+            if type(key) not in (int, long) :
+                raise TypeError("list indices must be integers")
+            if key < 0 :
+                key += count
+            if not 0 <= key < count :
+                raise IndexError(key)
+            v, = offset.unpack_from(self.map, table + key * offset.size)
+            return self.value(pos + v)
+        if not isinstance(key, basestring) :
+            raise KeyError(key)
+        target = utf8(key)
+        # binary search on the sorted keys
+        lo, hi = 0, count
+        while lo < hi :
+            mid = (lo + hi) // 2
+            k, v = entry.unpack_from(self.map, table + mid * entry.size)
+            n, = length.unpack_from(self.map, pos + k + 1)
+            start = pos + k + 1 + length.size
+            found = self.map[start:start + n]
+            if found == target :
+                return self.value(pos + v)
+            elif found < target :
+                lo = mid + 1
+            else :
+                hi = mid
+        raise KeyError(key)
+    def size(self, pos) :
+        return header.unpack_from(self.map, pos + 1)[0]
+
+class Lazy(object) :
+    """A dictionary or list in a MappedFile which has not been decoded.
+    Looking up an entry only decodes what is needed to find it, and
+    'load' gives the decoded dictionary or list."""
+    __slots__ = ["file", "pos"]
+    def __init__(self, file, pos) :
+        self.file = file
+        self.pos = pos
+    def load(self) :
+        return self.file.decode(self.pos)
+    def __getitem__(self, key) :
+        o = self.file.decoded.get(self.pos)
+        if o is not None :
+            return o[key]
+        return self.file.lookup(self.pos, key)
+    def __contains__(self, key) :
+        try :
+            self[key]
+            return True
+        except (KeyError, IndexError, TypeError) :
+            return False
+    def __iter__(self) :
+        raise TypeError("a Lazy must be loaded before going through it")
+    def raw(self) :
+        """Returns the encoding of the dictionary or list."""
+        return self.file.map[self.pos:self.pos + self.file.size(self.pos)]
+    def __repr__(self) :
+        return "Lazy(%r, %d)" % (self.file, self.pos)
+
+def is_binary(filename) :
+    """Returns whether the file is in this format."""
+    with open(filename, "rb") as f :
+        return f.read(len(magic)) == magic
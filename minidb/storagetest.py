@@ -0,0 +1,130 @@
+# storagetest.py
+# 2013 Kyle Miller
+# checks that what is written to the backing file of a minidb is what
+# is read back from it
+
+from minidb import *
+from plantest import fresh
+import shards
+import shutil
+import storage
+
+if __name__=="__main__" :
+    from queries import *
+
+    @queryfunc
+    def ages(db) :
+        return (Do()
+                .foreach(a, Get(db, "users"))
+                .require(Op("eq", Get(a, "age"), 3))
+                .ret(Get(a, "name")))
+
+    # the binary format round-trips, and a part of the database is
+    # only decoded once something looks inside it
+    users = dict(("u%d" % i, {"name" : u"user %d \xe9" % i, "age" : i % 7, "f" : i / 3.0})
+                 for i in xrange(2000))
+    db = fresh("storagetest.db", binary=True)
+    with db.transaction() as tx :
+        tx.insert(path("users"), users)
+        tx.insert(path("meta"), {"version" : 1, "tags" : ["a", None, True, 2 ** 40]})
+    db.close()
+    assert storage.is_binary("storagetest.db")
+    db = Database("storagetest.db", binary=True)
+    assert type(db.data["users"]) is storage.Lazy
+    assert db.select(lambda db : Return(Get(db, "meta"))) == [{"version" : 1, "tags" : ["a", None, True, 2 ** 40]}]
+    assert type(db.data["users"]) is storage.Lazy
+    assert db.select(lambda db : Return(db), subpath=path("users", "u10")) == [users["u10"]]
+    assert sorted(db.select(ages)) == sorted(u["name"] for u in users.itervalues() if u["age"] == 3)
+    db.insert(path("users", "u3", "age"), 4, overwrite=True)
+    db.close()
+    db = Database("storagetest.db", binary=True)
+    users["u3"]["age"] = 4
+    assert db.select(lambda db : Return(db)) == [{"users" : users,
+                                                  "meta" : {"version" : 1, "tags" : ["a", None, True, 2 ** 40]}}]
+    db.close()
+
+    # a json database opened over a binary file converts it
+    db = Database("storagetest.db")
+    db.insert(path("meta", "version"), 2, overwrite=True)
+    db.close()
+    assert not storage.is_binary("storagetest.db")
+    assert Database("storagetest.db", binary=True).data["meta"]["version"] == 2
+
+    # only what the codecs can write gets in, and insert_many puts in
+    # all of its objects or none of them
+    for journaled in [False, True] :
+        db = fresh("storagetest.db", journaled=journaled)
+        db.insert(path("users"), {})
+        db.create_index(path("users"), path("age"))
+        db.insert_many([(path("users", "u%d" % i), {"name" : "u%d" % i, "age" : i % 7})
+                        for i in xrange(1000)])
+        for bad in [(1,), set([1]), {(1,) : "a"}, {"a" : [object()]}] :
+            try :
+                db.insert_many([(path("users", "x"), {"age" : 1}), (path("users", "y"), {"age" : bad})])
+                assert False, bad
+            except TypeError :
+                pass
+        try :
+            db.insert_many([(path("users", "x"), {"age" : 1}), (path("users", "u1"), {"age" : 2})])
+            assert False
+        except Exception as x :
+            assert "over another" in str(x), x
+        assert "x" not in db.data["users"]
+        assert len(db.select(ages)) == len([i for i in xrange(1000) if i % 7 == 3])
+        db.insert_many([(path("l"), 1), (path("l"), 2)], append=True)
+        db.close()
+        db = Database("storagetest.db", journaled=journaled)
+        assert len(db.data["users"]) == 1000 and db.data["l"] == [1, 2]
+        db.close()
+
+    # a path keeps the types of its keys, even when an equal path with
+    # keys of other types was made first
+    db = fresh("storagetest.db", journaled=True)
+    db.insert(path("types"), ["a", "b"])
+    floating = path("types", 1.0)
+    assert db.select(lambda db : Return(Get(db, "types", 1))) == ["b"]
+    db.insert(path("types", 1), "c", overwrite=True)
+    assert map(type, path("types", 1)) == [str, int] and map(type, floating) == [str, float]
+    db.close()
+    assert Database("storagetest.db", journaled=True).data["types"] == ["a", "c"]
+
+    # a sharded database writes each shard to its own file, from
+    # several threads at once, and finds the shards again when opened;
+    # shard names may be byte strings in utf-8 but must be strings
+    import threading
+    def group(key) :
+        return key.split("/")[0].encode("utf-8")
+    shutil.rmtree("storagetest.shards", ignore_errors=True)
+    sdb = shards.ShardedDatabase("storagetest.shards", shard_of=group)
+    keys = [u"a", u"\xe9/1", u"\xe9/2"]
+    for key in keys :
+        sdb.insert(path(key), {})
+    def writer(key) :
+        for i in xrange(200) :
+            sdb.insert(path(key, "k%d" % i), i)
+    threads = [threading.Thread(target=writer, args=(key,)) for key in keys]
+    for t in threads :
+        t.start()
+    for t in threads :
+        t.join()
+    assert sorted(sdb.shards) == [u"a", u"\xe9"]
+    try :
+        shards.ShardedDatabase("storagetest.shards").insert(path(5), 1)
+        assert False
+    except TypeError :
+        pass
+    sdb.close()
+    sdb = shards.ShardedDatabase("storagetest.shards", shard_of=group)
+    assert sorted(sdb.shards) == [u"a", u"\xe9"]
+    sdb.insert(path(u"\xe9/3"), 3)
+    assert sorted(sdb.shards) == [u"a", u"\xe9"]
+    for key in keys :
+        assert sdb.select(lambda db : Return(Get(db, key, "k199"))) == [199]
+    assert len(sdb.select(lambda db : Return(db))[0]) == 4
+    sdb.close()
+    shutil.rmtree("storagetest.shards")
+
+    for f in ["storagetest.db", "storagetest.db.journal", "storagetest.db.indexes"] :
+        if os.path.isfile(f) :
+            os.remove(f)
+    print "ok"
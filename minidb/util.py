@@ -2,8 +2,10 @@
 # 2013 Kyle Miller
 # utility objects and functions for the minidb
 
+import logging
 import operator
 import threading
+import time
 import types
 
 assert_type_coercions = {}
@@ -68,15 +70,146 @@ def check_type_is_ok(o) :
     part of the database.  That is, whether it's string, number,
     boolean, None, or a dictionary or array of such."""
     t = type(o)
-    if t in allowed_types :
-        return True
-    elif t is list :
-        return all(check_type_is_ok(elt) for elt in o)
-    elif t is dict :
-        return all(type(k) in allowed_types and check_type_is_ok(v)
-                   for k, v in o.iteritems())
+    if t is dict or t is list :
+        return check_container(o, t)
+    return t in allowed_types
+
+def check_container(o, t) :
+    # check_type_is_ok for a dictionary or list, in one pass with no
+    # generators, and recursing only into dictionaries and lists
+    allowed = allowed_types
+    if t is dict :
+        for k in o :
+            if type(k) not in allowed :
+                return False
+        values = o.itervalues()
+    else :
+        values = o
+    for v in values :
+        t = type(v)
+        if t is dict or t is list :
+            if not check_container(v, t) :
+                return False
+        elif t not in allowed :
+            return False
+    return True
+
+def apply_change(data, op, keys, value=None) :
+    """Applies a primitive change to 'data' in place.  The entry being
+    changed is found by following the list 'keys' from 'data'.  The
+    operations are
+
+    "set": the entry is set to 'value',
+    "append": 'value' is appended to the entry, which must be a list
+      (a missing entry is taken to be an empty list),
+    "del": the entry is deleted, and
+    "rename": the entry is moved to the key 'value' of its parent.
+
+    Every modification of the database is a sequence of these."""
+    parent = data
+    for k in keys[:-1] :
+        parent = parent[k]
+    key = keys[-1]
+    if op == "set" :
+        parent[key] = value
+    elif op == "append" :
+        l = parent.setdefault(key, [])
+        if type(l) is not list :
+            raise Exception("Cannot append to non-list")
+        l.append(value)
+    elif op == "del" :
+        del parent[key]
+    elif op == "rename" :
+        parent[value] = parent.pop(key)
     else :
-        return False
+        raise Exception("Unknown change operation " + op)
+
+def own_path(root, op, keys, owned) :
+    """Prepares for applying a primitive change to 'root' without
+    touching any dictionary or list which someone else might be
+    looking at.  Each one which the change would modify is replaced by
+    a shallow copy, unless it is already one of the copies in 'owned'
+    (a dictionary from ids, which keeps the copies alive).  Returns the
+    new root."""
+    def own(o) :
+        if id(o) in owned or type(o) not in (dict, list) :
+            return o
+        o = list(o) if type(o) is list else dict(o)
+        owned[id(o)] = o
+        return o
+    root = own(root)
+    parent = root
+    for k in keys[:-1] :
+        child = own(parent[k])
+        parent[k] = child
+        parent = child
+    if op == "append" :
+        # an append modifies the list itself rather than its parent
+        key = keys[-1]
+        if type(parent) is list or key in parent :
+            parent[key] = own(parent[key])
+    return root
+
+class UndoLog(object) :
+    """Applies primitive changes (see apply_change) while remembering
+    how to undo each of them, which takes time proportional to the
+    number of changes."""
+    def __init__(self) :
+        self.undos = []
+    def mark(self) :
+        """Returns a point which 'undo' can go back to."""
+        return len(self.undos)
+    def apply(self, data, op, keys, value=None) :
+        parent = data
+        for k in keys[:-1] :
+            parent = parent[k]
+        key = keys[-1]
+        if type(parent) is list and op == "rename" :
+            saved = list(parent)
+            def undo() :
+                parent[:] = saved
+        elif op == "set" or op == "del" :
+            if type(parent) is list :
+                old = parent[key]
+                if op == "set" :
+                    def undo() :
+                        parent[key] = old
+                else :
+                    def undo() :
+                        parent.insert(key, old)
+            elif key in parent :
+                old = parent[key]
+                def undo() :
+                    parent[key] = old
+            else :
+                def undo() :
+                    del parent[key]
+        elif op == "append" :
+            if type(parent) is dict and key not in parent :
+                def undo() :
+                    del parent[key]
+            else :
+                l = parent[key]
+                def undo() :
+                    l.pop()
+        elif op == "rename" :
+            old = parent[key]
+            had_new = value in parent
+            prev = parent.get(value)
+            def undo() :
+                if had_new :
+                    parent[value] = prev
+                else :
+                    del parent[value]
+                parent[key] = old
+        else :
+            undo = None
+        apply_change(data, op, keys, value)
+        self.undos.append(undo)
+    def undo(self, mark=0) :
+        """Undoes every change made since 'mark'."""
+        while len(self.undos) > mark :
+            self.undos.pop()()
 
 class RWLock(object) :
     """A lock which lets as many things read as they want, but limits
@@ -91,6 +224,7 @@ class RWLock(object) :
     def __init__(self) :
         self.readers = 0
         self.writers_read_locks = 0
+        self.write_depth = 0
         internal_lock = threading.Condition(threading.RLock())
         self.read_lock = self.ReadLock(self, internal_lock)
         self.write_lock = self.WriteLock(self, internal_lock)
@@ -129,15 +263,251 @@ class RWLock(object) :
             self.release()
         def acquire(self) :
             self.internal_lock.acquire()
-            while self.rwlock.readers > 0 :
-                self.internal_lock.wait()
-            self.readers = -1 # used as a sentinel for re-entrance
+            if self.rwlock.write_depth == 0 :
+                while self.rwlock.readers > 0 :
+                    self.internal_lock.wait()
+                self.rwlock.readers = -1 # used as a sentinel for re-entrance
+            self.rwlock.write_depth += 1
         def release(self) :
             # invariants:
             # - we have the inner_lock
             # - readers == -1
             # - writers_read_locks is the number of read locks taken while inner_lock is held
-            self.rwlock.readers = self.rwlock.writers_read_locks
-            self.rwlock.writers_read_locks = 0
+            self.rwlock.write_depth -= 1
+            if self.rwlock.write_depth == 0 :
+                self.rwlock.readers = self.rwlock.writers_read_locks
+                self.rwlock.writers_read_locks = 0
             self.internal_lock.notify()
             self.internal_lock.release()
+
+class PathLock(object) :
+    """Locks on parts of the database, each named by the tuple of keys
+    of its path, for letting writers of different parts go at the same
+    time.  Locking a path "S" (shared) or "X" (exclusive) also locks
+    each of its ancestors "IS" or "IX", meaning that something under
+    it is locked.  So a writer of ("users", "kmill") keeps out readers
+    and writers of ("users",) and of the whole database (), but not
+    those of ("users", "bob") or ("orders",).
+
+    The locks a thread holds never keep it from getting more, so like
+    with RWLock, 'read_lock' and 'write_lock' (which lock the whole
+    database) can be taken by a writer."""
+    compatible = {
+        "IS" : frozenset(["IS", "IX", "S"]),
+        "IX" : frozenset(["IS", "IX"]),
+        "S" : frozenset(["IS", "S"]),
+        "X" : frozenset(),
+        }
+    def __init__(self) :
+        self.cond = threading.Condition(threading.Lock())
+        # for each locked path, the modes each thread holds it in,
+        # with how many times
+        self.holders = {}
+        self.read_lock = self.hold([()], "S")
+        self.write_lock = self.hold([()], "X")
+    def hold(self, paths, mode) :
+        """Returns a lock (to be used like RWLock.read_lock) on each
+        of the paths, which are tuples of keys, in the mode "S" or
+        "X".  The paths are locked all at once."""
+        requests = []
+        for keys in paths :
+            keys = tuple(keys)
+            for i in xrange(len(keys)) :
+                requests.append((keys[:i], "I" + mode))
+            requests.append((keys, mode))
+        return PathHold(self, requests)
+    def grantable(self, requests, me) :
+        for keys, mode in requests :
+            for thread, modes in self.holders.get(keys, {}).iteritems() :
+                if thread != me and not self.compatible[mode].issuperset(modes) :
+                    return False
+        return True
+    def acquire(self, requests) :
+        me = threading.current_thread()
+        with self.cond :
+            while not self.grantable(requests, me) :
+                self.cond.wait()
+            for keys, mode in requests :
+                modes = self.holders.setdefault(keys, {}).setdefault(me, {})
+                modes[mode] = modes.get(mode, 0) + 1
+    def release(self, requests) :
+        me = threading.current_thread()
+        with self.cond :
+            for keys, mode in requests :
+                threads = self.holders[keys]
+                modes = threads[me]
+                modes[mode] -= 1
+                if modes[mode] == 0 :
+                    del modes[mode]
+                    if not modes :
+                        del threads[me]
+                        if not threads :
+                            del self.holders[keys]
+            self.cond.notify_all()
+
+class PathHold(object) :
+    """A lock from PathLock.hold."""
+    def __init__(self, pathlock, requests) :
+        self.pathlock = pathlock
+        self.requests = requests
+    def __enter__(self) :
+        self.acquire()
+        return self
+    def __exit__(self, type, value, traceback) :
+        self.release()
+    def acquire(self) :
+        self.pathlock.acquire(self.requests)
+    def release(self) :
+        self.pathlock.release(self.requests)
+
+class GroupCommit(object) :
+    """Lets many writers share one flush to disk.  Writers 'add' their
+    items and get a Ticket back.  A background thread waits until
+    either 'window' seconds have passed or 'maxops' additions are
+    pending, and then calls 'flush', which must call 'take' to get
+    every pending item and make them durable.  A writer which needs
+    its items to be durable waits on its ticket.
+
+    If a flush fails, its exception is kept in 'error' until 'reset',
+    and items added meanwhile are dropped, since they would be flushed
+    without the ones that were lost.  Their tickets raise the
+    exception.
+
+    'close' flushes what is pending and stops the thread."""
+    def __init__(self, flush, window, maxops) :
+        self.flush = flush
+        self.window = window
+        self.maxops = maxops
+        self.cond = threading.Condition()
+        self.flushlock = threading.RLock()
+        self.pending = []
+        self.ops = 0
+        self.submitted = 0
+        self.taken = 0
+        self.durable = 0
+        self.error = None
+        self.closed = False
+        # the tickets which are not durable yet
+        self.tickets = []
+        self.thread = threading.Thread(target=self.run, name="GroupCommit")
+        self.thread.daemon = True
+        self.thread.start()
+    def add(self, items) :
+        """Adds items to be flushed, returning a Ticket for them."""
+        with self.cond :
+            if self.closed :
+                raise Exception("Cannot add to a closed group commit")
+            if self.error is not None :
+                ticket = Ticket(self, self.submitted)
+                ticket.error = self.error
+                return ticket
+            self.pending.extend(items)
+            self.ops += 1
+            self.submitted += 1
+            self.cond.notify_all()
+            return self.ticket(self.submitted)
+    def ticket(self, seq) :
+        ticket = Ticket(self, seq)
+        if seq > self.durable :
+            self.tickets.append(ticket)
+        return ticket
+    def take(self) :
+        """Takes every pending item.  The caller must be flushing (that
+        is, hold 'flushlock'), and the items count as durable once the
+        flush is done."""
+        with self.cond :
+            items, self.pending = self.pending, []
+            self.ops = 0
+            self.taken = self.submitted
+            return items
+    def sync(self) :
+        """Waits until everything added so far is durable, raising the
+        exception of a failed flush if there was one since 'reset'."""
+        with self.cond :
+            ticket = self.ticket(self.submitted)
+        ticket.wait()
+        with self.cond :
+            if self.error is not None :
+                raise self.error
+    def reset(self) :
+        """Forgets a failed flush, once what it failed to make durable
+        is gone."""
+        with self.cond :
+            self.error = None
+    def discard(self, exception) :
+        """Drops every pending item.  Their tickets raise 'exception'."""
+        with self.cond :
+            self.pending = []
+            self.ops = 0
+            self.fail(self.taken + 1, self.submitted, exception)
+            self.taken = self.submitted
+            self.made_durable(self.submitted)
+    def fail(self, first, last, exception) :
+        for ticket in self.tickets :
+            if first <= ticket.seq <= last :
+                ticket.error = exception
+    def made_durable(self, seq) :
+        self.durable = max(self.durable, seq)
+        self.tickets = [t for t in self.tickets if t.seq > self.durable]
+        self.cond.notify_all()
+    def close(self) :
+        """Flushes what is pending and waits for the thread to stop,
+        raising the exception of a failed flush if there was one since
+        'reset'."""
+        with self.cond :
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread is not threading.current_thread() :
+            self.thread.join()
+        with self.cond :
+            if self.error is not None :
+                raise self.error
+    def run(self) :
+        while True :
+            with self.cond :
+                while self.submitted == self.durable and not self.closed :
+                    self.cond.wait()
+                if self.submitted == self.durable :
+                    return
+                deadline = time.time() + self.window
+                while self.ops < self.maxops and not self.closed :
+                    remaining = deadline - time.time()
+                    if remaining <= 0 :
+                        break
+                    self.cond.wait(remaining)
+            self.flush_now()
+    def flush_now(self, flush=None) :
+        """Flushes in this thread, using 'flush' instead of the usual
+        flush function if it is given."""
+        with self.flushlock :
+            with self.cond :
+                first = self.taken + 1
+            try :
+                (flush or self.flush)()
+            except Exception as x :
+                logging.exception("group commit failed")
+                self.take()
+                with self.cond :
+                    self.error = x
+                    self.fail(first, self.taken, x)
+            with self.cond :
+                self.made_durable(self.taken)
+
+class Ticket(object) :
+    """An acknowledgement that some items were submitted to a
+    GroupCommit."""
+    def __init__(self, group, seq) :
+        self.group = group
+        self.seq = seq
+        self.error = None
+    def done(self) :
+        return self.error is not None or self.group.durable >= self.seq
+    def wait(self) :
+        """Waits until the items are durable.  If the flush failed, its
+        exception is raised."""
+        group = self.group
+        with group.cond :
+            while self.error is None and group.durable < self.seq :
+                group.cond.wait()
+            if self.error is not None :
+                raise self.error
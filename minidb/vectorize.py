@@ -0,0 +1,438 @@
+# vectorize.py
+# 2013 Kyle Miller
+# batch execution of simple filters for the minidb, using numpy
+
+import itertools
+import operator
+
+try :
+    import numpy
+except ImportError :
+    numpy = None
+
+import util
+from queries import (Query, Func, Bind, Union, Return, Require, OrderBy, Take, GroupBy,
+                     Get, Constant, Var, Op, Or, And, Do, UseJoin)
+
+# whether plan rewrites queries at all, which needs numpy
+enabled = numpy is not None
+
+# how many results are worked on at once (starting from first_chunk
+# and doubling, so that a scan which is stopped early, say by Take,
+# does little more work than it needs), and how few are done one at a
+# time anyway
+first_chunk = 64
+chunk_size = 4096
+small_chunk = 16
+
+# integers are kept in int64 arrays while every value which could come
+# out of the arithmetic is at most this big, and compared with floats
+# in float64 while they are at most float_exact
+int_bound = 2 ** 62
+float_exact = 2 ** 53
+
+comparisons = {"lt" : "less", "le" : "less_equal", "eq" : "equal",
+               "ne" : "not_equal", "ge" : "greater_equal", "gt" : "greater"}
+arithmetic = {"add" : "add", "sub" : "subtract", "mul" : "multiply"}
+unary = {"neg" : "negative", "abs" : "absolute"}
+
+class Unvectorizable(Exception) :
+    pass
+
+class Fallback(Exception) :
+    pass
+
+def plan(queryfunc) :
+    """Returns a query function equivalent to 'queryfunc' in which each
+    'foreach' followed by 'require's (and perhaps a final 'ret') which
+    only look at scalar fields of the variable through Get, Constant
+    and the arithmetic and comparison operations is run by a
+    VectorScan, or 'queryfunc' itself."""
+    if not enabled :
+        return queryfunc
+    query = plan_query(queryfunc.query)
+    if query is queryfunc.query :
+        return queryfunc
+    return Func(queryfunc.var, query)
+
+def plan_query(query) :
+    if isinstance(query, Do) :
+        query.buildQuery()
+        return plan_query(query.query)
+    elif isinstance(query, Union) :
+        planned = [plan_query(q) for q in query.queries]
+        if all(p is q for p, q in zip(planned, query.queries)) :
+            return query
+        return Union(*planned)
+    elif isinstance(query, OrderBy) :
+        source = plan_query(query.query)
+        return query if source is query.query else OrderBy(source, query.key, query.reverse)
+    elif isinstance(query, Take) :
+        source = plan_query(query.query)
+        return query if source is query.query else Take(query.n, source)
+    elif isinstance(query, UseJoin) :
+        source = plan_query(query.query)
+        return query if source is query.query else UseJoin(query.kind, source)
+    elif isinstance(query, GroupBy) :
+        source = plan_query(query.query)
+        if source is query.query :
+            return query
+        return GroupBy(query.key, source, query.aggregate, query.value)
+    elif isinstance(query, Bind) :
+        source = plan_query(query.query)
+        var = query.func.var
+        vectorized = vectorize_bind(source, var, query.func.query)
+        if vectorized is not None :
+            return vectorized
+        body = plan_query(query.func.query)
+        if source is query.query and body is query.func.query :
+            return query
+        return Bind(source, Func(var, body))
+    else :
+        return query
+
+def vectorize_bind(source, var, body) :
+    """Returns a VectorScan doing the work of a bind of 'var' to the
+    results of 'source' for 'body', or None."""
+    if var is None :
+        return None
+    tests = []
+    while True :
+        if isinstance(body, Do) :
+            body.buildQuery()
+            body = body.query
+        if not (isinstance(body, Bind) and body.func.var is None
+                and isinstance(body.query, Require) and vectorizable(body.query.value, var, True)) :
+            break
+        tests.append(body.query.value)
+        body = body.func.query
+    if (isinstance(body, Return) and isinstance(body.value, Op)
+        and vectorizable(body.value, var, False)) :
+        # the values come from the database only through Gets and Vars,
+        # which are cheap enough without numpy and carry paths
+        return VectorScan(source, var, tests, body.value)
+    if not tests :
+        return None
+    return Bind(VectorScan(source, var, tests), Func(var, plan_query(body)))
+
+def vectorizable(value, var, truthy) :
+    try :
+        kernel(value, var, truthy)
+        return True
+    except Unvectorizable :
+        return False
+
+def kernel(value, var, truthy) :
+    """Returns a function of a Columns giving the value for every row
+    at once, as (kind, data, bound), where 'kind' is "int", "float" or
+    "bool" for data in a numpy array of that type, "object" for a numpy
+    array of python objects, or "const" for one python value.  For
+    integers, 'bound' is at least the absolute value of every one.
+    'truthy' is whether only the truth of the value matters.  Raises
+    Unvectorizable for values which are not understood."""
+    if isinstance(value, Var) :
+        if value.name != var :
+            raise Unvectorizable(value)
+        return lambda cols : cols.column(())
+    elif isinstance(value, Get) :
+        if not (isinstance(value.source, Var) and value.source.name == var) :
+            raise Unvectorizable(value)
+        keys = tuple(value.path)
+        return lambda cols : cols.column(keys)
+    elif isinstance(value, Constant) :
+        o = value.o
+        if type(o) not in util.allowed_types :
+            raise Unvectorizable(value)
+        r = ("const", o, abs(o) if type(o) in (int, long, bool) else None)
+        return lambda cols : r
+    elif isinstance(value, Op) :
+        name = value.name
+        if name in comparisons or name in arithmetic :
+            if len(value.params) != 2 :
+                raise Unvectorizable(value)
+            x, y = [kernel(p, var, False) for p in value.params]
+            if name in comparisons :
+                f = getattr(numpy, comparisons[name])
+                return lambda cols : compare(f, value.op, x(cols), y(cols))
+            f = getattr(numpy, arithmetic[name])
+            return lambda cols : combine(f, name, value.op, x(cols), y(cols))
+        elif name in unary or name in ("not", "truth") :
+            if len(value.params) != 1 :
+                raise Unvectorizable(value)
+            if name in unary :
+                x = kernel(value.params[0], var, False)
+                f = getattr(numpy, unary[name])
+                return lambda cols : negate(f, value.op, x(cols))
+            x = kernel(value.params[0], var, True)
+            if name == "not" :
+                return lambda cols : ("bool", ~truth(cols, x(cols)), 1)
+            return lambda cols : ("bool", truth(cols, x(cols)), 1)
+        raise Unvectorizable(value)
+    elif isinstance(value, (Or, And)) and truthy and value.params :
+        # Or and And give one of their arguments, which is only the
+        # same as the logical operation when used as a truth value
+        params = [kernel(p, var, True) for p in value.params]
+        f = numpy.logical_or if isinstance(value, Or) else numpy.logical_and
+        def _logical(cols) :
+            return ("bool", reduce(f, [truth(cols, p(cols)) for p in params]), 1)
+        return _logical
+    else :
+        raise Unvectorizable(value)
+
+def numeric(x) :
+    """Returns x with booleans as integers, or None if it is not a
+    number or array of numbers."""
+    kind, data, bound = x
+    if kind == "bool" :
+        return ("int", data.astype(numpy.int64), 1)
+    elif kind == "const" :
+        t = type(data)
+        if t is bool :
+            return ("const", int(data), 1)
+        elif t in (int, long) and bound > int_bound :
+            return None
+        elif t not in (int, long, float) :
+            return None
+    elif kind == "object" :
+        return None
+    return x
+
+def as_object(x) :
+    kind, data, bound = x
+    if kind == "const" or kind == "object" :
+        return data
+    return data.astype(object)
+
+def compare(f, op, x, y) :
+    if x[0] == "const" and y[0] == "const" :
+        return ("const", op(x[1], y[1]), 1)
+    nx, ny = numeric(x), numeric(y)
+    if nx is not None and ny is not None :
+        kinds = (type(nx[1]) if nx[0] == "const" else nx[0], type(ny[1]) if ny[0] == "const" else ny[0])
+        exact = True
+        if float in kinds or "float" in kinds :
+            # integers compare exactly with floats only while they are
+            # exactly floats themselves
+            exact = all(n[2] is None or n[2] <= float_exact for n in (nx, ny))
+        if exact :
+            return ("bool", f(nx[1], ny[1]), 1)
+    return ("bool", numpy.asarray(f(as_object(x), as_object(y)), dtype=bool), 1)
+
+def combine(f, name, op, x, y) :
+    if x[0] == "const" and y[0] == "const" :
+        o = op(x[1], y[1])
+        return ("const", o, abs(o) if type(o) in (int, long) else None)
+    nx, ny = numeric(x), numeric(y)
+    if nx is not None and ny is not None :
+        isint = [n[0] == "int" or (n[0] == "const" and type(n[1]) in (int, long)) for n in (nx, ny)]
+        if all(isint) :
+            if name == "mul" :
+                bound = nx[2] * ny[2]
+            else :
+                bound = nx[2] + ny[2]
+            if bound <= int_bound :
+                return ("int", f(nx[1], ny[1]), bound)
+        else :
+            return ("float", f(nx[1], ny[1]), None)
+    return ("object", f(as_object(x), as_object(y)), None)
+
+def negate(f, op, x) :
+    if x[0] == "const" :
+        return ("const", op(x[1]), x[2])
+    nx = numeric(x)
+    if nx is not None :
+        return (nx[0], f(nx[1]), nx[2])
+    return ("object", f(as_object(x)), None)
+
+def truth(cols, x) :
+    kind, data, bound = x
+    if kind == "const" :
+        return numpy.repeat(bool(data), cols.n)
+    elif kind == "bool" :
+        return data
+    elif kind == "object" :
+        return numpy.array([bool(v) for v in data], dtype=bool)
+    return data != 0
+
+class Columns(object) :
+    """The values of a chunk of results, from which arrays of their
+    fields are made as they are needed."""
+    def __init__(self, values) :
+        self.values = values
+        self.n = len(values)
+        self.columns = {}
+    def column(self, keys) :
+        c = self.columns.get(keys)
+        if c is None :
+            c = self.columns[keys] = column(self.values, keys)
+        return c
+
+def column(values, keys) :
+    """Returns the array of the entries at 'keys' in each of the
+    values (see kernel).  Raises Fallback if they are not all
+    scalars."""
+    entries = values
+    for k in keys :
+        entries = map(operator.itemgetter(k), entries)
+    types = set(map(type, entries))
+    if types and types <= set([int, long]) :
+        bound = max(abs(min(entries)), abs(max(entries)))
+        if bound <= int_bound :
+            return ("int", numpy.array(entries, dtype=numpy.int64), bound)
+    elif types == set([float]) :
+        return ("float", numpy.array(entries, dtype=numpy.float64), None)
+    elif types == set([bool]) :
+        return ("bool", numpy.array(entries, dtype=bool), 1)
+    if not types <= util.allowed_types :
+        raise Fallback()
+    data = numpy.empty(len(entries), dtype=object)
+    data[:] = entries
+    return ("object", data, None)
+
+def results(x, n) :
+    """Returns the python values of the kernel result 'x' for n rows."""
+    kind, data, bound = x
+    if kind == "const" :
+        return [data] * n
+    return data.tolist()
+
+class VectorScan(Query) :
+    """Gives the results of 'query' for which each of the values
+    'tests' is true when 'var' is bound to the result, or, if 'value'
+    is given, gives the value for each of those instead.  The tests
+    and the value are computed for chunks of results at once with
+    numpy (see plan), and the results of a chunk are given before the
+    next chunk is looked at.  A chunk which numpy cannot handle exactly, say
+    because a field is missing or is not a scalar, is done one result
+    at a time like a chain of binds would."""
+    def __init__(self, query, var, tests, value=None) :
+        self.query = query
+        self.var = var
+        self.tests = list(tests)
+        self.value = value
+        self.kernels = [kernel(t, var, True) for t in self.tests]
+        self.valuekernel = kernel(value, var, False) if value is not None else None
+    def execute(self, fuel, bindings) :
+        var = self.var
+        def evaluate(v) :
+            def _evaluate(fuel, r) :
+                return v.eval(fuel, bindings.extend(var, r))
+            return _evaluate
+        tests = [evaluate(t) for t in self.tests]
+        value = evaluate(self.value) if self.value is not None else None
+        return self.scan(fuel, chunks(self.query.execute(fuel, bindings)), tests, value)
+    def freevars(self) :
+        return self.query.freevars()
+    def compile_query(self, scope) :
+        if isinstance(self.query, Get) :
+            # the collection is read directly, and only the paths of
+            # the results which pass are made
+            path = self.query.path
+            collection = self.query.source.compile_value(scope)
+            def source(fuel, frame) :
+                pathprime, data = collection(fuel, frame)
+                return collection_chunks(pathprime.concat(path) if pathprime is not None else None,
+                                         path.get(data))
+        else :
+            results = self.query.compile_query(scope)
+            def source(fuel, frame) :
+                return chunks(results(fuel, frame))
+        subscope, slot = scope.bind(self.var)
+        tests = [t.compile_value(subscope) for t in self.tests]
+        value = self.value.compile_value(subscope) if self.value is not None else None
+        scan = self.scan
+        def _vectorscan(fuel, frame) :
+            def evaluate(v) :
+                def _evaluate(fuel, r) :
+                    frame[slot] = r
+                    return v(fuel, frame)
+                return _evaluate
+            return scan(fuel, source(fuel, frame), [evaluate(t) for t in tests],
+                        evaluate(value) if value is not None else None)
+        return _vectorscan
+    def scan(self, fuel, chunks, tests, value) :
+        for paths, values in chunks :
+            fuel.consume_many(len(values))
+            out = None
+            if len(values) >= small_chunk :
+                try :
+                    with numpy.errstate(all="raise") :
+                        out = self.run_chunk(paths, values)
+                except Exception :
+                    pass
+            if out is None :
+                out = self.run_rows(fuel, paths, values, tests, value)
+            for r in out :
+                yield r
+    def run_chunk(self, paths, values) :
+        cols = Columns(values)
+        mask = None
+        for k in self.kernels :
+            t = truth(cols, k(cols))
+            mask = t if mask is None else mask & t
+        if mask is None :
+            selected = range(len(values))
+        else :
+            selected = numpy.flatnonzero(mask).tolist()
+        if self.valuekernel is None :
+            return [(paths[i], values[i]) for i in selected]
+        cols = Columns([values[i] for i in selected])
+        return [(None, v) for v in results(self.valuekernel(cols), cols.n)]
+    def run_rows(self, fuel, paths, values, tests, value) :
+        for i, v in enumerate(values) :
+            r = (paths[i], v)
+            if all(test(fuel, r)[1] for test in tests) :
+                yield r if value is None else value(fuel, r)
+    def __repr__(self) :
+        return "VectorScan(%r, %r, %r, value=%r)" % (self.query, self.var, self.tests, self.value)
+
+def chunk_sizes() :
+    """Gives the sizes of successive chunks: first_chunk, doubling up
+    to chunk_size."""
+    size = first_chunk
+    while True :
+        yield size
+        size = min(2 * size, chunk_size)
+
+def chunks(results) :
+    """Gives the results in chunks of (paths, values)."""
+    for size in chunk_sizes() :
+        chunk = list(itertools.islice(results, size))
+        if not chunk :
+            return
+        paths, values = zip(*chunk)
+        yield paths, values
+        if len(chunk) < size :
+            return
+
+def collection_chunks(base, data) :
+    """Gives the entries of the dictionary or list 'data' in chunks of
+    (paths, values) like chunks, where the path of each entry is made
+    from the path 'base' of the collection only when it is asked for."""
+    if type(data) is dict :
+        entries = data.iteritems()
+        for size in chunk_sizes() :
+            chunk = list(itertools.islice(entries, size))
+            if not chunk :
+                return
+            keys, values = zip(*chunk)
+            yield Paths(base, keys), values
+    else :
+        start = 0
+        for size in chunk_sizes() :
+            if start >= len(data) :
+                return
+            values = data[start:start + size]
+            yield Paths(base, xrange(start, start + len(values))), values
+            start += len(values)
+
+class Paths(object) :
+    """The paths of the entries at 'keys' in the collection at 'base',
+    made when they are looked up."""
+    def __init__(self, base, keys) :
+        self.base = base
+        self.keys = keys
+    def __getitem__(self, i) :
+        if self.base is None :
+            return None
+        return self.base[self.keys[i]]
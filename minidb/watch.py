@@ -0,0 +1,197 @@
+# watch.py
+# 2013 Kyle Miller
+# a feed of the changes made to the minidb, for watching parts of it
+
+import collections
+import logging
+import threading
+
+import queries
+import storage
+from cache import copied
+
+class Lost(object) :
+    """The old value of a change which stands for changes that were
+    not kept (see Watch)."""
+    def __repr__(self) :
+        return "lost"
+
+lost = Lost()
+
+def change_events(data, op, keys, value) :
+    """Returns the events (keys, old, new, shifts) of a primitive
+    change (see util.apply_change) about to be made to 'data', where a
+    missing entry is None and 'shifts' is whether the entries after
+    'keys' in its list move down.  An append is the setting of the new
+    last entry of the list, and a rename is the deletion of the entry
+    and the setting of the one it is moved to."""
+    try :
+        parent = data
+        for k in keys[:-1] :
+            parent = parent[k]
+        key = keys[-1]
+        old = entry(parent, key)
+    except (KeyError, IndexError, TypeError) :
+        # the change will fail
+        return []
+    shifts = type(parent) is list
+    if op == "set" :
+        return [(keys, old, value, False)]
+    elif op == "del" :
+        return [(keys, old, None, shifts)]
+    elif op == "append" :
+        return [(keys + [len(old) if type(old) is list else 0], None, value, False)]
+    elif op == "rename" :
+        return [(keys, old, None, shifts), (keys[:-1] + [value], entry(parent, value), old, False)]
+    return []
+
+def entry(parent, key) :
+    if type(parent) is list :
+        return parent[key] if -len(parent) <= key < len(parent) else None
+    return parent.get(key)
+
+def value_at(data, keys) :
+    try :
+        for k in keys :
+            data = data[k]
+    except (KeyError, IndexError, TypeError) :
+        return None
+    if type(data) is storage.Lazy :
+        data = data.load()
+    return data
+
+class Feed(object) :
+    """The watches of a Database, which 'publish' gives the events of
+    each commit to.  If 'copying', the values in events are copies,
+    since the database changes its dictionaries and lists in place
+    (without the 'mvcc' option), and a watch may look at them later."""
+    def __init__(self, copying=False) :
+        self.lock = threading.Lock()
+        self.copying = copying
+        # replaced rather than changed, so it can be read without the lock
+        self.watches = ()
+    def watch(self, keys, maxsize=1000, callback=None) :
+        w = Watch(self, keys, maxsize, callback)
+        with self.lock :
+            self.watches = self.watches + (w,)
+        return w
+    def remove(self, w) :
+        with self.lock :
+            self.watches = tuple(o for o in self.watches if o is not w)
+    def events(self, data, op, keys, value) :
+        """Returns the events of a primitive change about to be made to
+        'data' (see change_events) which some watch wants."""
+        watches = self.watches
+        events = [e for e in change_events(data, op, keys, value)
+                  if any(w.covers(e[0], e[3]) for w in watches)]
+        if self.copying :
+            events = [(changed, copied(old), copied(new), shifts)
+                      for changed, old, new, shifts in events]
+        return events
+    def publish(self, events, data) :
+        """Gives each watch the events which are about the part of the
+        database it watches, where 'data' is the database after
+        them."""
+        for w in self.watches :
+            mine = [e[:3] for e in events if w.covers(e[0], e[3])]
+            if mine :
+                w.put(mine, data)
+
+class Watch(object) :
+    """The changes to the part of a database at 'keys' (and to the
+    entries it is in, and to the earlier entries of lists it is in,
+    which move it), as events (path, old, new), where 'path' is the
+    queries.Path of the entry which changed and 'old' and 'new' are
+    its values before and after (None if it is missing).  The values
+    are the database's own, and must not be changed.
+
+    Events wait in the watch until they are asked for.  If an entry
+    changes again before then, the two events are made into one, with
+    the first old value and the last new one.  If there are already
+    'maxsize' events waiting, they are all replaced by one event for
+    the whole watched part, whose old value is 'lost'.
+
+    If 'callback' is given, a thread calls it with each event."""
+    def __init__(self, feed, keys, maxsize=1000, callback=None) :
+        self.feed = feed
+        self.keys = tuple(keys)
+        self.path = queries.path(*self.keys)
+        self.maxsize = maxsize
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.overflowed = False
+        self.closed = False
+        if callback is not None :
+            thread = threading.Thread(target=self.run, args=(callback,), name="Watch %r" % (self.path,))
+            thread.daemon = True
+            thread.start()
+    def covers(self, keys, shifts=False) :
+        """Returns whether a change to the entry at 'keys' can change
+        the watched part, where 'shifts' is whether the entries after
+        it in its list move down."""
+        n = min(len(keys), len(self.keys))
+        if tuple(keys[:n]) == self.keys[:n] :
+            return True
+        if shifts and len(keys) <= len(self.keys) and tuple(keys[:-1]) == self.keys[:n - 1] :
+            k = self.keys[n - 1]
+            return type(k) in (int, long) and (k < 0 or keys[-1] < 0 or k > keys[-1])
+        return False
+    def put(self, events, data) :
+        with self.cond :
+            if self.closed :
+                return
+            for keys, old, new in events :
+                if self.overflowed :
+                    break
+                p = queries.path(*keys)
+                waiting = self.pending.pop(p, None)
+                if waiting is not None :
+                    old = waiting[1]
+                elif len(self.pending) >= self.maxsize :
+                    self.overflowed = True
+                    break
+                self.pending[p] = (p, old, new)
+            if self.overflowed :
+                self.pending.clear()
+                value = value_at(data, self.keys)
+                if self.feed.copying :
+                    value = copied(value)
+                self.pending[self.path] = (self.path, lost, value)
+            self.cond.notify_all()
+    def get(self, timeout=None) :
+        """Returns the events waiting, after waiting up to 'timeout'
+        seconds (or until the watch is closed) for there to be some."""
+        with self.cond :
+            if not self.pending and not self.closed :
+                self.cond.wait(timeout)
+            events = self.pending.values()
+            self.pending.clear()
+            self.overflowed = False
+            return events
+    def __iter__(self) :
+        """Gives the events as they come, until the watch is closed."""
+        while True :
+            events = self.get()
+            if not events and self.closed :
+                return
+            for e in events :
+                yield e
+    def run(self, callback) :
+        for path, old, new in self :
+            try :
+                callback(path, old, new)
+            except Exception :
+                logging.exception("Exception in the callback of %r", self)
+    def close(self) :
+        """Stops the watch.  Events already waiting can still be
+        gotten."""
+        self.feed.remove(self)
+        with self.cond :
+            self.closed = True
+            self.cond.notify_all()
+    def __enter__(self) :
+        return self
+    def __exit__(self, type, value, traceback) :
+        self.close()
+    def __repr__(self) :
+        return "Watch(%r)" % (self.path,)
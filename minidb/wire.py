@@ -0,0 +1,113 @@
+# wire.py
+# 2013 Kyle Miller
+# a json form of queries for the minidb, for sending them over rpc
+
+import queries
+from queries import Func, ValueFunc, Do
+
+# How each kind of node is written: the attributes which go in the
+# list after its name, and how each is written.  "node" is a query or
+# value, "nodes" is the rest of the list of them, "func" is a Func or
+# ValueFunc (or None), "path" is a Path as a list of keys, "aggregate"
+# is the name of an Aggregate in queries.aggregates, and "plain" is
+# written as it is.
+fields = {
+    "Bind" : [("query", "node"), ("func", "func")],
+    "Union" : [("queries", "nodes")],
+    "Return" : [("value", "node")],
+    "Require" : [("value", "node")],
+    "OrderBy" : [("query", "node"), ("key", "func"), ("reverse", "plain")],
+    "Take" : [("n", "plain"), ("query", "node")],
+    "UseJoin" : [("kind", "plain"), ("query", "node")],
+    "GroupBy" : [("key", "func"), ("query", "node"), ("aggregate", "aggregate"), ("value", "func")],
+    "Get" : [("source", "node"), ("path", "path")],
+    "Apply" : [("value", "node"), ("func", "func")],
+    "Constant" : [("o", "plain")],
+    "Var" : [("name", "plain")],
+    "AsList" : [("query", "node")],
+    "AsDict" : [("query", "node")],
+    "First" : [("query", "node"), ("default", "node")],
+    "Exists" : [("query", "node")],
+    "AnyOf" : [("query", "node")],
+    "AllOf" : [("query", "node")],
+    "Count" : [("query", "node")],
+    "Sum" : [("query", "node")],
+    "Min" : [("query", "node")],
+    "Max" : [("query", "node")],
+    "Avg" : [("query", "node")],
+    "Op" : [("name", "plain"), ("params", "nodes")],
+    "Or" : [("params", "nodes")],
+    "And" : [("params", "nodes")],
+    }
+
+class WireError(Exception) :
+    pass
+
+def dump(node) :
+    """Returns the json form of a query, value, Func or ValueFunc,
+    which is a list of the name of the kind of node followed by its
+    parts.  For instance, Get(Var("db"), "users") is ["Get", ["Var",
+    "db"], ["users"]]."""
+    if isinstance(node, Do) :
+        node.buildQuery()
+        return dump(node.query)
+    elif isinstance(node, Func) :
+        return ["Func", node.var, dump(node.query)]
+    elif isinstance(node, ValueFunc) :
+        return ["ValueFunc", node.var, dump(node.value)]
+    name = type(node).__name__
+    if name not in fields :
+        raise WireError("Cannot send a " + name)
+    o = [name]
+    for attr, how in fields[name] :
+        part = getattr(node, attr)
+        if how == "nodes" :
+            o.extend(dump(p) for p in part)
+        elif how == "node" or how == "func" :
+            o.append(None if part is None else dump(part))
+        elif how == "path" :
+            o.append(list(part))
+        elif how == "aggregate" :
+            o.append(part.__name__.lower())
+        else :
+            o.append(part)
+    return o
+
+def load(o) :
+    """Returns the query, value, Func or ValueFunc whose json form is
+    'o' (see dump)."""
+    if (type(o) is not list or not o or not isinstance(o[0], basestring)
+        or o[0] not in fields and o[0] not in ("Func", "ValueFunc")) :
+        raise WireError("Not a query: %r" % (o,))
+    name = o[0]
+    try :
+        if name == "Func" :
+            var, query = o[1:]
+            return Func(var, load(query))
+        elif name == "ValueFunc" :
+            var, value = o[1:]
+            return ValueFunc(var, load(value))
+        args = []
+        parts = o[1:]
+        for i, (attr, how) in enumerate(fields[name]) :
+            if how == "nodes" :
+                args.extend(load(p) for p in parts[i:])
+                break
+            part = parts[i]
+            if how == "node" or how == "func" :
+                args.append(None if part is None else load(part))
+            elif how == "path" :
+                args.append(queries.path(*part))
+            else :
+                args.append(part)
+        return getattr(queries, name)(*args)
+    except WireError :
+        raise
+    except Exception as x :
+        raise WireError("Malformed %s: %r" % (name, x))
+
+def load_path(keys) :
+    """Returns the Path for a list of keys, or None for None."""
+    if keys is None :
+        return None
+    return queries.path(*keys)
@@ -1,27 +1,46 @@
+import os
 import socket
-import struct
-import json
+import sys
 import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "minidb"))
+import serialize
+
 class RPCException(Exception) :
     pass
 
 class RPCClient(object) :
-    def __init__(self, ip, port) :
+    def __init__(self, ip, port, codec="json") :
+        """A client for the server at 'ip' and 'port', sending
+        messages with 'codec' (see serialize.codecs)."""
         self.__data__ = (ip, port)
+        self.__codec__ = serialize.get_codec(codec)
     def __send_request__(self, object) :
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         ip, port = self.__data__
         sock.settimeout(222)
         try :
             sock.connect((ip, port))
-            ostring = json.dumps(object)
-            sock.sendall(struct.pack("<I", len(ostring)))
-            sock.sendall(ostring)
-            
-            size = struct.unpack("<I", sock.recv(4))
-            data = sock.recv(size[0])
-            return json.loads(data)
+            serialize.write_frame(sock, self.__codec__.encode(object))
+            data = serialize.read_frame(sock)
+            return serialize.detect(data).decode(data)
+        finally:
+            sock.close()
+    def __stream_request__(self, object) :
+        """Sends a request for a streaming method, and gives each
+        message of the reply until the last one."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        ip, port = self.__data__
+        sock.settimeout(222)
+        try :
+            sock.connect((ip, port))
+            serialize.write_frame(sock, self.__codec__.encode(object))
+            while True :
+                data = serialize.read_frame(sock)
+                res = serialize.detect(data).decode(data)
+                yield res
+                if "partial" not in res :
+                    return
         finally:
             sock.close()
     def __getattr__(self, name) :
@@ -34,14 +53,26 @@ class RPCFunction(object) :
     def __call__(self, **kwargs) :
         msg = {"action" : self.funcname,
                "params" : kwargs}
-        res = self.client.__send_request__(msg)
-        if "result" in res :
-            return res["result"]
-        elif "error" in res :
-            error = res["error"]
-            raise RPCException(error["type"], error["args"])
-        else :
-            raise RPCException("Malformed result")
+        return result_of(self.client.__send_request__(msg))
+    def stream(self, **kwargs) :
+        """Calls a streaming method (such as watch), giving each of
+        its results as it comes."""
+        msg = {"action" : self.funcname,
+               "params" : kwargs}
+        for res in self.client.__stream_request__(msg) :
+            if "partial" in res :
+                yield res["partial"]
+            else :
+                result_of(res)
+
+def result_of(res) :
+    if "result" in res :
+        return res["result"]
+    elif "error" in res :
+        error = res["error"]
+        raise RPCException(error["type"], error["args"])
+    else :
+        raise RPCException("Malformed result")
 
 client = RPCClient("127.0.0.1", 22322)
 print client.hello(name="Kyle")
@@ -0,0 +1,97 @@
+# rpctest.py
+# checks the rpc server by talking to it over a socket
+
+import os
+import socket
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "minidb"))
+import minidb
+import serialize
+import server
+import wire
+from queries import *
+
+def call(address, action, **params) :
+    """Sends one request to the server at 'address', and returns the
+    reply."""
+    sock = socket.create_connection(address)
+    try :
+        codec = serialize.get_codec("json")
+        serialize.write_frame(sock, codec.encode({"id" : 1, "action" : action, "params" : params}))
+        data = serialize.read_frame(sock)
+        return serialize.detect(data).decode(data)
+    finally :
+        sock.close()
+
+if __name__=="__main__" :
+    tcp = server.ThreadedTCPServer(("localhost", 0), server.RPCHandler)
+    thread = threading.Thread(target=tcp.serve_forever)
+    thread.start()
+    address = tcp.server_address
+    try :
+        @queryfunc
+        def numbers(db) :
+            return Get(db, "numbers")
+
+        # there is nothing to select from until a database is served
+        reply = call(address, "select", query=wire.dump(numbers))
+        assert reply["error"]["type"] == "Exception", reply
+
+        for f in ["rpctest.db", "rpctest.db.indexes"] :
+            if os.path.isfile(f) :
+                os.remove(f)
+        server.DATABASE = minidb.Database("rpctest.db")
+        server.DATABASE.insert(path("numbers"), range(25))
+
+        # results come a page at a time, with a token for the next page
+        server.PAGE_SIZE = 10
+        results = []
+        token = None
+        while True :
+            reply = call(address, "select", query=wire.dump(numbers), token=token)["result"]
+            assert len(reply["results"]) <= 10
+            results.extend(reply["results"])
+            token = reply["token"]
+            if token is None :
+                break
+        assert results == range(25)
+        reply = call(address, "select", query=wire.dump(numbers), limit=3, offset=5)["result"]
+        assert reply["results"] == [5, 6, 7]
+
+        # aggregates are computed by the server
+        reply = call(address, "select", query=wire.dump(Func("db", Return(Sum(Get(Var("db"), "numbers"))))))
+        assert reply["result"]["results"] == [300]
+
+        # queries which are not queries are refused
+        for query in [[["Constant"], 1], ["Op", "system", ["Constant", 1]], 5, []] :
+            reply = call(address, "select", query=query)
+            assert reply["error"]["type"] == "WireError", reply
+
+        # changes are streamed to a watcher as they are made, with empty
+        # lists in between when nothing changes
+        sock = socket.create_connection(address)
+        try :
+            codec = serialize.get_codec("json")
+            serialize.write_frame(sock, codec.encode({"id" : 2, "action" : "watch",
+                                                      "params" : {"path" : ["numbers", 3],
+                                                                  "heartbeat" : 0.05}}))
+            def _next() :
+                data = serialize.read_frame(sock)
+                return serialize.detect(data).decode(data)["partial"]
+            assert _next() == []
+            server.DATABASE.remove(lambda db : Return(Get(db, "numbers", 0)))
+            events = []
+            while not events :
+                events = _next()
+            assert events == [{"path" : ["numbers", 0], "old" : 0, "new" : None}], events
+        finally :
+            sock.close()
+
+        server.DATABASE.close()
+    finally :
+        tcp.shutdown()
+        thread.join()
+    os.remove("rpctest.db")
+    print "ok"
@@ -1,14 +1,29 @@
 # server.py
-# a simple json-based rpc server
+# a simple rpc server, speaking json or any other codec in
+# minidb/serialize.py
 
 import SocketServer
-import json
-import struct
+import os
+import socket
+import sys
 import time
+import types
 import logging
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "minidb"))
+import minidb
+import serialize
+import watch
+import wire
+
 logging.basicConfig(level=logging.INFO)
 
+# the database being served, if any
+DATABASE = None
+
+# the most results rpc_select sends at once
+PAGE_SIZE = 1000
+
 METHODS = {}
 
 def rpc(name) :
@@ -18,40 +33,56 @@ def rpc(name) :
     return _rpc
 
 class RPCHandler(SocketServer.StreamRequestHandler) :
+    """Each message is a 4-byte little-endian length followed by that
+    many bytes in some codec.  The reply is in the codec of the
+    request.
+
+    A method which is a generator streams its results: each one is sent
+    as {"id" : ..., "partial" : ...}, and then the reply is sent with
+    a result of None."""
     def handle(self):
         self.request.settimeout(5)
+        self.codec = serialize.get_codec("json")
         ident = None
         action = None
         params = None
         try :
-            message = self.read_json()
+            message = self.read_message()
             logging.info("Got message %r" % message)
             ident = message.get("id", None)
             action = message.get("action", None)
             params = message.get("params", None)
 
             result = METHODS[action](**params)
+            if isinstance(result, types.GeneratorType) :
+                try :
+                    for part in result :
+                        self.write_message({"id" : ident, "partial" : part})
+                except socket.error as x :
+                    logging.info("Stream ended: %r" % x)
+                    return
+                finally :
+                    result.close()
+                result = None
             self.write_result(ident, result)
         except Exception as x :
             logging.error("Exception %r" % x)
             self.write_exception(ident, x)
-    def read_json(self) :
-        size = struct.unpack("<I", self.request.recv(4))
-        data = self.request.recv(size[0])
-        return json.loads(data)
-    def write_json(self, o) :
-        ostring = json.dumps(o)
-        self.request.sendall(struct.pack("<I", len(ostring)))
-        self.request.sendall(ostring)
+    def read_message(self) :
+        data = serialize.read_frame(self.request)
+        self.codec = serialize.detect(data)
+        return self.codec.decode(data)
+    def write_message(self, o) :
+        serialize.write_frame(self.request, self.codec.encode(o))
     def write_result(self, ident, result) :
         msg = {"id" : ident,
                "result" : result}
-        self.write_json(msg)
+        self.write_message(msg)
     def write_exception(self, ident, exception) :
         msg = {"id" : ident,
                "error" : {"type" : exception.__class__.__name__,
                           "args" : exception.args }}
-        self.write_json(msg)
+        self.write_message(msg)
 
 class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer) :
     allow_reuse_address = True
@@ -64,8 +95,47 @@ def rpc_hello(name) :
 def rpc_failure() :
     return 1/0
 
+def served() :
+    """Returns the database being served, raising an exception if
+    there is none."""
+    if DATABASE is None :
+        raise Exception("No database is being served")
+    return DATABASE
+
+@rpc("select")
+def rpc_select(query, subpath=None, limit=None, offset=None, token=None) :
+    """Runs a query function in the json form of wire.dump.  At most
+    'limit' results (and never more than PAGE_SIZE) are sent, along
+    with a page token for getting the rest (see Database.select_iter),
+    which is None if there are no more.  Aggregates such as Count and
+    GroupBy are computed here, so only their results are sent."""
+    limit = PAGE_SIZE if limit is None else min(limit, PAGE_SIZE)
+    cursor = served().select_iter(wire.load(query), limit=limit, offset=offset,
+                                  subpath=wire.load_path(subpath), token=token)
+    results = cursor.fetch()
+    return {"results" : results, "token" : cursor.token()}
+
+@rpc("watch")
+def rpc_watch(path=None, maxsize=1000, heartbeat=10) :
+    """Streams the changes to the part of the database at 'path' (see
+    Database.watch) as they are made, as lists of {"path" : keys, "old"
+    : old, "new" : new}, where "old" is missing if it was lost.  An
+    empty list is sent every 'heartbeat' seconds when nothing has
+    changed, which is how a client that has gone away is noticed."""
+    with served().watch(wire.load_path(path), maxsize=maxsize) as w :
+        while True :
+            events = []
+            for p, old, new in w.get(timeout=heartbeat) :
+                event = {"path" : list(p), "new" : new}
+                if old is not watch.lost :
+                    event["old"] = old
+                events.append(event)
+            yield events
+
 if __name__ == "__main__" :
     HOST, PORT = "localhost", 22322
+    if len(sys.argv) > 1 :
+        DATABASE = minidb.Database(sys.argv[1])
     print "Serving at %s:%s" % (HOST, PORT)
     server = ThreadedTCPServer((HOST, PORT), RPCHandler)
     try :